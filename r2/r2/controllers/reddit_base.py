@@ -48,6 +48,7 @@ from pylons.i18n.translation import LanguageError
 from r2.config import feature
 from r2.config.extensions import is_api, set_extension
 from r2.lib import (
+    access_ledger,
     baseplate_integration,
     filters,
     geoip,
@@ -133,7 +134,7 @@ from r2.models import (
     valid_feed,
     valid_otp_cookie,
 )
-from r2.lib.db import tdb_cassandra
+from r2.lib.db import batch_loader, tdb_cassandra, write_tokens
 
 
 # Cookies which may be set in a response without making it uncacheable
@@ -900,6 +901,9 @@ class MinimalController(BaseController):
         c.start_time = datetime.now(g.tz)
         c.request_timer.start()
         g.reset_caches()
+        access_ledger.start_request()
+        batch_loader.start_request()
+        write_tokens.start_request()
 
         c.domain_prefix = request.environ.get("reddit-domain-prefix",
                                               g.domain_prefix)
@@ -1001,6 +1005,9 @@ class MinimalController(BaseController):
         if c.loid:
             c.loid.save(domain=g.domain)
 
+        # remember recent writes so the next requests can read them
+        write_tokens.finish_request()
+
         # send cookies
         secure_cookies = feature.is_enabled("force_https")
         for k, v in c.cookies.iteritems():
@@ -1022,6 +1029,8 @@ class MinimalController(BaseController):
             c.user.update_last_visit(c.start_time)
 
         hooks.get_hook("reddit.request.end").call()
+        access_ledger.finish_request()
+        batch_loader.finish_request()
 
         # this thread is probably going to be reused, but it could be
         # a while before it is. So we might as well dump the cache in
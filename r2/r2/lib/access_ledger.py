@@ -0,0 +1,187 @@
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of
+# the Original Code is reddit Inc.
+#
+# All portions of the code written by reddit are Copyright (c) 2006-2016 reddit
+# Inc. All Rights Reserved.
+###############################################################################
+"""Per-request record of cache and database reads.
+
+When a request is sampled (see start_request) every key fetched from a cache
+chain, Cassandra, or Postgres is written to an AccessLedger on the request
+context. At the end of the request the ledger reports:
+
+* duplicate fetches: the same key fetched more than once, e.g. an Account
+  loaded by _byID in several places.
+* N+1 patterns: many separate single-key fetches of the same kind of key,
+  which could have been one get_multi or query.
+
+The summary is logged and, in debug mode or for admins and employees, added
+to the response as the X-Reddit-Access-Ledger header. It names cache keys and
+tables, so it isn't shown to anyone else.
+
+"""
+
+from collections import Counter
+import random
+import re
+
+from pylons import app_globals as g
+from pylons import request, response
+from pylons import tmpl_context as c
+
+
+HEADER_NAME = "X-Reddit-Access-Ledger"
+
+# runs of digits and md5 hashes vary between keys of the same kind
+_key_shape_re = re.compile(r"[0-9a-f]{32}|\d+")
+_sql_tables_re = re.compile(r"\bFROM\s+(.+?)(?:\s+WHERE\b|\s+ORDER\b|$)",
+                            re.IGNORECASE | re.DOTALL)
+
+
+def key_shape(key):
+    """Return the kind of cache key this is, e.g. Link_N for Link_123."""
+    return _key_shape_re.sub("N", str(key))
+
+
+def sql_shape(statement):
+    """Shorten a SQL statement to the tables it reads from."""
+    match = _sql_tables_re.search(statement)
+    if not match:
+        return statement[:40]
+    tables = [t.strip().split(" ")[0] for t in match.group(1).split(",")]
+    return "select:" + "+".join(tables)
+
+
+class AccessLedger(object):
+    def __init__(self, n_plus_one_threshold=5):
+        self.n_plus_one_threshold = n_plus_one_threshold
+        # (kind, source, key) -> number of times it was fetched
+        self.fetches = Counter()
+        # (kind, source) -> number of fetches made
+        self.calls = Counter()
+        # (kind, source) -> number of fetches of a single key
+        self.single_key_calls = Counter()
+        # (kind, source) -> friendlier name for the summary
+        self.labels = {}
+
+    def record(self, kind, source, keys, label=None):
+        """Record a fetch of keys from source.
+
+        `kind` is the type of backend ("cache", "cassandra", "sql") and
+        `source` identifies what was read from within it, such that repeated
+        fetches from the same source are worth batching.
+
+        """
+
+        call = (kind, source)
+        self.calls[call] += 1
+        if len(keys) == 1:
+            self.single_key_calls[call] += 1
+        for key in keys:
+            self.fetches[(kind, source, key)] += 1
+        if label:
+            self.labels[call] = label
+
+    def record_cache(self, chain_name, keys):
+        keys_by_shape = {}
+        for key in keys:
+            keys_by_shape.setdefault(key_shape(key), []).append(key)
+
+        for shape, shape_keys in keys_by_shape.iteritems():
+            source = "%s:%s" % (chain_name, shape)
+            self.record("cache", source, shape_keys)
+
+    def record_query(self, statement, params):
+        params = repr(sorted(params.iteritems()))
+        self.record("sql", statement, [params], label=sql_shape(statement))
+
+    def _label(self, kind, source):
+        return self.labels.get((kind, source), source)
+
+    def duplicates(self):
+        """Return [(kind, source, key, count)] for keys fetched repeatedly."""
+        return sorted(
+            ((kind, self._label(kind, source), key, count)
+             for (kind, source, key), count in self.fetches.iteritems()
+             if count > 1),
+            key=lambda dup: -dup[3],
+        )
+
+    def n_plus_one(self):
+        """Return [(kind, source, count)] for sources fetched key by key."""
+        return sorted(
+            ((kind, self._label(kind, source), count)
+             for (kind, source), count in self.single_key_calls.iteritems()
+             if count >= self.n_plus_one_threshold),
+            key=lambda n: -n[2],
+        )
+
+    def summary(self, limit=5):
+        totals = Counter()
+        for (kind, source), count in self.calls.iteritems():
+            totals[kind] += count
+
+        duplicates = self.duplicates()
+        dup_totals = Counter()
+        for kind, source, key, count in duplicates:
+            dup_totals[kind] += count - 1
+
+        parts = ["%s=%d/dup=%d" % (kind, totals[kind], dup_totals[kind])
+                 for kind in sorted(totals)]
+        parts.extend("n+1 %s %s x%d" % n_plus_one
+                     for n_plus_one in self.n_plus_one()[:limit])
+        parts.extend("dup %s %s x%d" % (kind, source, count)
+                     for kind, source, key, count in duplicates[:limit])
+        return "; ".join(parts)
+
+
+def get_ledger():
+    """Return the current request's AccessLedger, if it has one."""
+    try:
+        return getattr(c, "access_ledger", None) or None
+    except TypeError:
+        # not in a request
+        return None
+
+
+def start_request():
+    sample_rate = g.access_ledger_sample_rate
+    force = g.debug and request.GET.get("access_ledger") == "1"
+    if force or (sample_rate and random.random() < sample_rate):
+        c.access_ledger = AccessLedger()
+    else:
+        c.access_ledger = None
+
+
+def can_see_summary():
+    """Return whether the summary may go in the response headers."""
+    if g.debug:
+        return True
+    return bool(c.user_is_loggedin and (c.user_is_admin or c.user.employee))
+
+
+def finish_request():
+    ledger = get_ledger()
+    if not ledger:
+        return
+
+    summary = ledger.summary()
+    g.log.info("access ledger for %s: %s", request.fullpath, summary)
+    if can_see_summary():
+        response.headers[HEADER_NAME] = summary.replace("\n", " ")
+    c.access_ledger = None
@@ -286,10 +286,12 @@ def consume_items(queue, callback, verbose=True):
             chan.close()
 
 def handle_items(queue, callback, ack=True, limit=1, min_size=0,
-                 drain=False, verbose=True, sleep_time=1):
+                 drain=False, verbose=True, sleep_time=1, idle_fn=None):
     """Call callback() on every item in a particular queue. If the
     connection to the queue is lost, it will die. Intended to be
-    used as a long-running process."""
+    used as a long-running process.
+
+    If given, idle_fn(chan) is called whenever the queue is found empty."""
     if limit < min_size:
         raise ValueError("min_size must be less than limit")
     from pylons import tmpl_context as c
@@ -303,6 +305,9 @@ def handle_items(queue, callback, ack=True, limit=1, min_size=0,
             break
 
         msg = chan.basic_get(queue)
+        if not msg and idle_fn:
+            idle_fn(chan)
+
         if not msg and drain:
             return
         elif not msg:
@@ -25,6 +25,7 @@ from urlparse import urlparse
 
 import base64
 import ConfigParser
+import functools
 import locale
 import json
 import logging
@@ -50,16 +51,21 @@ import r2.lib.amqp
 from r2.lib.baseplate_integration import R2BaseplateObserver
 from r2.lib.cache import (
     CacheChain,
+    CacheCodec,
     CL_ONE,
     CL_QUORUM,
     CMemcache,
+    CodecCache,
     HardCache,
     HardcacheChain,
+    HotKeyTracker,
     LocalCache,
+    LRUCache,
     Mcrouter,
     MemcacheChain,
+    ParallelFetcher,
     Permacache,
-    SelfEmptyingCache,
+    SingleFlight,
     StaleCacheChain,
     TransitionalCache,
 )
@@ -67,6 +73,7 @@ from r2.lib.configparse import ConfigValue, ConfigValueParser
 from r2.lib.contrib import ipaddress
 from r2.lib.contrib.activity_thrift import ActivityService
 from r2.lib.contrib.activity_thrift.ttypes import ActivityInfo
+from r2.lib.db import write_tokens
 from r2.lib.eventcollector import EventQueue
 from r2.lib.lock import make_lock_factory
 from r2.lib.manager import db_manager
@@ -183,6 +190,8 @@ class Globals(object):
             'MIN_RATE_LIMIT_KARMA',
             'MIN_RATE_LIMIT_COMMENT_KARMA',
             'HOT_PAGE_AGE',
+            'normalized_hot_cache_time',
+            'normalized_hot_refresh_interval',
             'ADMIN_COOKIE_TTL',
             'ADMIN_COOKIE_MAX_IDLE',
             'OTP_COOKIE_TTL',
@@ -225,6 +234,16 @@ class Globals(object):
             'frequency_cap_min',
             'frequency_cap_default',
             'eu_cookie_max_attempts',
+            'localcache_max_items',
+            'localcache_max_bytes',
+            'single_flight_lease_time',
+            'hot_key_threshold',
+            'hot_key_ttl',
+            'cache_codec_compress_len',
+            'parallel_cache_threads',
+            'hardcache_partition_hours',
+            'hardcache_partition_count',
+            'sql_statement_cache_size',
         ],
 
         ConfigValue.float: [
@@ -236,6 +255,16 @@ class Globals(object):
             'RL_LOGIN_IP_AVG_PER_SEC',
             'RL_SHARE_AVG_PER_SEC',
             'tracing_sample_rate',
+            'hot_key_sample_rate',
+            'access_ledger_sample_rate',
+            'parallel_cache_hedge_delay',
+            'db_replica_lag_check_interval',
+            'db_replica_max_lag',
+            'db_replica_lag_check_timeout',
+            'db_read_your_writes_window',
+            'incr_buffer_window',
+            'cassandra_read_timeout',
+            'query_queue_coalesce_window',
         ],
 
         ConfigValue.bool: [
@@ -266,6 +295,14 @@ class Globals(object):
             'RL_SITEWIDE_ENABLED',
             'RL_OAUTH_SITEWIDE_ENABLED',
             'enable_loggedout_experiments',
+            'localcache_lru',
+            'permacache_cas_mutate',
+            'parallel_cache_reads',
+            'parallel_thing_lookups',
+            'parallel_cassandra_reads',
+            'rel_negative_filters',
+            'querycache_presorted',
+            'single_flight',
         ],
 
         ConfigValue.tuple: [
@@ -351,6 +388,7 @@ class Globals(object):
 
         ConfigValue.dict(ConfigValue.str, ConfigValue.str): [
             'emr_traffic_tags',
+            'cache_codecs',
         ],
     }
 
@@ -741,11 +779,13 @@ class Globals(object):
         # memcaches used in front of the permacache CF in cassandra.
         # XXX: this is a legacy thing; permacache was made when C* didn't have
         # a row cache.
+        permacache_cas_mutate = self.config.get("permacache_cas_mutate")
         permacache_memcaches = CMemcache(
             "perma",
             self.permacache_memcaches,
             min_compress_len=1400,
             num_clients=num_mc_clients,
+            cas=permacache_cas_mutate,
         )
 
         # the stalecache is a memcached local to the current app server used
@@ -762,11 +802,26 @@ class Globals(object):
         self.startup_timer.intermediate("memcache")
 
         ################# MCROUTER
+        # keys read often enough to overload their memcached server get
+        # replicated briefly in-process.
+        hot_key_sample_rate = self.config.get("hot_key_sample_rate", 0)
+        if hot_key_sample_rate:
+            hot_key_tracker = HotKeyTracker(
+                "mcrouter",
+                self.stats,
+                sample_rate=hot_key_sample_rate,
+                threshold=self.config.get("hot_key_threshold", 1000),
+                ttl=self.config.get("hot_key_ttl", 1),
+            )
+        else:
+            hot_key_tracker = None
+
         self.mcrouter = Mcrouter(
             "mcrouter",
             self.mcrouter_addr,
             min_compress_len=1400,
             num_clients=num_mc_clients,
+            hot_key_tracker=hot_key_tracker,
         )
 
         ################# THRIFT-BASED SERVICES
@@ -799,6 +854,13 @@ class Globals(object):
                 ),
         }
 
+        # used by tdb_cassandra.multiget to read several column families at once
+        if self.config.get("parallel_cassandra_reads"):
+            self.cassandra_fetcher = ParallelFetcher(
+                pool_size=self.cassandra_pool_size)
+        else:
+            self.cassandra_fetcher = None
+
         permacache_cf = Permacache._setup_column_family(
             'permacache',
             self.cassandra_pools[self.cassandra_default_pool],
@@ -815,77 +877,161 @@ class Globals(object):
         # to cache_chains (closed around by reset_caches) so that they
         # can properly reset their local components
         cache_chains = {}
-        localcache_cls = (SelfEmptyingCache if self.running_as_script
-                          else LocalCache)
+        # long-running scripts never reset their caches, so they always get
+        # a bounded local cache. request handlers reset theirs every request
+        # but can opt in to the same bounds with localcache_lru.
+        if self.running_as_script or self.config.get("localcache_lru"):
+            localcache_cls = functools.partial(
+                LRUCache,
+                max_items=self.config.get("localcache_max_items", 10*1000),
+                max_bytes=self.config.get("localcache_max_bytes", 0),
+            )
+        else:
+            localcache_cls = LocalCache
+
+        # coalesce concurrent loads of keys that missed the cache. the lease
+        # on mcrouter extends this across processes.
+        def make_single_flight():
+            if not self.config.get("single_flight"):
+                return None
+            lease_time = self.config.get("single_flight_lease_time", 0)
+            return SingleFlight(
+                lease_cache=self.mcrouter if lease_time else None,
+                lease_time=lease_time,
+            )
+
+        # values are encoded with the chain's codec from cache_codecs. chains
+        # without one still decode values written by other codecs.
+        cache_codecs = self.config.get("cache_codecs", {})
+        def mcrouter_with_codec(chain_name):
+            codec_spec = cache_codecs.get(chain_name)
+            if codec_spec:
+                codec = CacheCodec.from_spec(
+                    codec_spec,
+                    min_compress_len=self.config.get(
+                        "cache_codec_compress_len", 1400),
+                )
+            else:
+                codec = CacheCodec()
+            return CodecCache(self.mcrouter, codec)
+
+        if self.config.get("parallel_cache_reads"):
+            parallel_fetcher = ParallelFetcher(
+                pool_size=self.config.get("parallel_cache_threads", 4),
+                hedge_delay=self.config.get(
+                    "parallel_cache_hedge_delay", 0.005),
+            )
+        else:
+            parallel_fetcher = None
+
+        # used by Thing._by_fullname to read misses of several types at once
+        if self.config.get("parallel_thing_lookups"):
+            self.thing_lookup_fetcher = ParallelFetcher(
+                pool_size=self.config.get("parallel_cache_threads", 4))
+        else:
+            self.thing_lookup_fetcher = None
 
+        single_flight = make_single_flight()
         if stalecaches:
             self.gencache = StaleCacheChain(
                 localcache_cls(),
                 stalecaches,
-                self.mcrouter,
+                mcrouter_with_codec("gencache"),
+                single_flight=single_flight,
+                parallel_fetcher=parallel_fetcher,
             )
         else:
-            self.gencache = CacheChain((localcache_cls(), self.mcrouter))
+            self.gencache = CacheChain(
+                (localcache_cls(), mcrouter_with_codec("gencache")),
+                single_flight=single_flight,
+            )
         cache_chains.update(gencache=self.gencache)
 
+        single_flight = make_single_flight()
         if stalecaches:
             self.thingcache = StaleCacheChain(
                 localcache_cls(),
                 stalecaches,
-                self.mcrouter,
+                mcrouter_with_codec("thingcache"),
+                single_flight=single_flight,
+                parallel_fetcher=parallel_fetcher,
+                require_fresh=write_tokens.wrote_recently,
             )
         else:
-            self.thingcache = CacheChain((localcache_cls(), self.mcrouter))
+            self.thingcache = CacheChain(
+                (localcache_cls(), mcrouter_with_codec("thingcache")),
+                single_flight=single_flight,
+            )
         cache_chains.update(thingcache=self.thingcache)
 
+        single_flight = make_single_flight()
         if stalecaches:
             self.memoizecache = StaleCacheChain(
                 localcache_cls(),
                 stalecaches,
-                self.mcrouter,
+                mcrouter_with_codec("memoizecache"),
+                single_flight=single_flight,
+                parallel_fetcher=parallel_fetcher,
             )
         else:
             self.memoizecache = MemcacheChain(
-                (localcache_cls(), self.mcrouter))
+                (localcache_cls(), mcrouter_with_codec("memoizecache")),
+                single_flight=single_flight,
+            )
         cache_chains.update(memoizecache=self.memoizecache)
 
         if stalecaches:
             self.srmembercache = StaleCacheChain(
                 localcache_cls(),
                 stalecaches,
-                self.mcrouter,
+                mcrouter_with_codec("srmembercache"),
+                parallel_fetcher=parallel_fetcher,
+                require_fresh=write_tokens.wrote_recently,
             )
         else:
             self.srmembercache = MemcacheChain(
-                (localcache_cls(), self.mcrouter))
+                (localcache_cls(), mcrouter_with_codec("srmembercache")))
         cache_chains.update(srmembercache=self.srmembercache)
 
+        single_flight = make_single_flight()
         if stalecaches:
             self.relcache = StaleCacheChain(
                 localcache_cls(),
                 stalecaches,
-                self.mcrouter,
+                mcrouter_with_codec("relcache"),
+                single_flight=single_flight,
+                parallel_fetcher=parallel_fetcher,
+                require_fresh=write_tokens.wrote_recently,
             )
         else:
             self.relcache = MemcacheChain(
-                (localcache_cls(), self.mcrouter))
+                (localcache_cls(), mcrouter_with_codec("relcache")),
+                single_flight=single_flight,
+            )
         cache_chains.update(relcache=self.relcache)
 
+        # relfiltercache holds the negative filters of relations. they're
+        # updated in place, so updates read them from memcache rather than
+        # the local cache.
+        self.relfiltercache = MemcacheChain(
+                (localcache_cls(), mcrouter_with_codec("relfiltercache")))
+        cache_chains.update(relfiltercache=self.relfiltercache)
+
         self.ratelimitcache = MemcacheChain(
-                (localcache_cls(), self.mcrouter))
+                (localcache_cls(), mcrouter_with_codec("ratelimitcache")))
         cache_chains.update(ratelimitcache=self.ratelimitcache)
 
         # rendercache holds rendered partial templates.
         self.rendercache = MemcacheChain((
             localcache_cls(),
-            self.mcrouter,
+            mcrouter_with_codec("rendercache"),
         ))
         cache_chains.update(rendercache=self.rendercache)
 
         # commentpanecaches hold fully rendered comment panes
         self.commentpanecache = MemcacheChain((
             localcache_cls(),
-            self.mcrouter,
+            mcrouter_with_codec("commentpanecache"),
         ))
         cache_chains.update(commentpanecache=self.commentpanecache)
 
@@ -893,15 +1039,19 @@ class Globals(object):
         self.cassandra_local_cache = localcache_cls()
         cache_chains.update(cassandra_local_cache=self.cassandra_local_cache)
 
+        single_flight = make_single_flight()
         if stalecaches:
             permacache_cache = StaleCacheChain(
                 localcache_cls(),
                 stalecaches,
                 permacache_memcaches,
+                single_flight=single_flight,
+                parallel_fetcher=parallel_fetcher,
             )
         else:
             permacache_cache = CacheChain(
                 (localcache_cls(), permacache_memcaches),
+                single_flight=single_flight,
             )
         cache_chains.update(permacache=permacache_cache)
 
@@ -909,6 +1059,7 @@ class Globals(object):
             permacache_cache,
             permacache_cf,
             lock_factory=self.make_lock,
+            cas_cache=permacache_memcaches if permacache_cas_mutate else None,
         )
 
         # hardcache is used for various things that tend to expire
@@ -930,11 +1081,16 @@ class Globals(object):
 
                 chain.reset()
                 if isinstance(chain, LocalCache):
+                    chain.stats = CacheStats(self.stats, name)
                     continue
                 elif isinstance(chain, StaleCacheChain):
                     chain.stats = StaleCacheStats(self.stats, name)
                 else:
                     chain.stats = CacheStats(self.stats, name)
+
+                # let the local tier report its evictions under the chain
+                if isinstance(chain.caches[0], LocalCache):
+                    chain.caches[0].stats = chain.stats
         self.cache_chains = cache_chains
 
         self.reset_caches = reset_caches
@@ -1008,7 +1164,12 @@ class Globals(object):
             from mock import MagicMock
             return MagicMock()
 
-        dbm = db_manager.db_manager()
+        dbm = db_manager.db_manager(
+            lag_check_interval=self.db_replica_lag_check_interval,
+            max_lag=self.db_replica_max_lag,
+            lag_check_timeout=self.db_replica_lag_check_timeout,
+            stats=self.stats,
+        )
         db_param_names = ('name', 'db_host', 'db_user', 'db_pass', 'db_port',
                           'pool_size', 'max_overflow')
         for db_name in self.databases:
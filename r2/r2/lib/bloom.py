@@ -0,0 +1,79 @@
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of
+# the Original Code is reddit Inc.
+#
+# All portions of the code written by reddit are Copyright (c) 2006-2016 reddit
+# Inc. All Rights Reserved.
+"""A small Bloom filter for caching set membership.
+
+A Bloom filter answers "is x in the set?" with either "definitely not" or
+"probably". It never gives false negatives, and gives false positives at
+about error_rate once capacity items have been added. The filter is
+picklable and compact (about 1.2 bytes per item at a 1% error rate) so it
+can be kept in memcache.
+
+"""
+
+import hashlib
+import math
+import struct
+
+
+class BloomFilter(object):
+    def __init__(self, capacity, error_rate=0.01):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.num_bits = max(8, int(math.ceil(
+            -capacity * math.log(error_rate) / math.log(2) ** 2)))
+        self.num_hashes = max(1, int(round(
+            self.num_bits / float(capacity) * math.log(2))))
+        self.bits = bytearray((self.num_bits + 7) // 8)
+        self.count = 0
+
+    def _positions(self, item):
+        # derive all the hashes from two halves of one digest
+        # (Kirsch and Mitzenmacher, "Less Hashing, Same Performance")
+        digest = hashlib.md5(str(item)).digest()
+        h1, h2 = struct.unpack("<QQ", digest)
+        for i in xrange(self.num_hashes):
+            yield (h1 + i * h2) % self.num_bits
+
+    def add(self, item):
+        for position in self._positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, item):
+        return all(self.bits[position >> 3] & (1 << (position & 7))
+                   for position in self._positions(item))
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def full(self):
+        """Whether the filter has reached the error rate it was sized for."""
+        return self.count >= self.capacity
+
+    def __getstate__(self):
+        return (self.capacity, self.error_rate, self.num_bits,
+                self.num_hashes, str(self.bits), self.count)
+
+    def __setstate__(self, state):
+        (self.capacity, self.error_rate, self.num_bits, self.num_hashes,
+         bits, self.count) = state
+        self.bits = bytearray(bits)
@@ -20,13 +20,23 @@
 # Inc. All Rights Reserved.
 ###############################################################################
 
-from threading import local
+from collections import OrderedDict
+import heapq
+from operator import itemgetter
+from thread import get_ident
+from threading import Event, local, Lock
 from hashlib import md5
 import cPickle as pickle
 from copy import copy
 from curses.ascii import isgraph
 import logging
-from time import sleep
+from multiprocessing import TimeoutError as PoolTimeoutError
+from multiprocessing.pool import ThreadPool
+import os
+import struct
+import sys
+import zlib
+from time import sleep, time as unix_time
 
 from pylons import app_globals as g
 
@@ -35,12 +45,25 @@ from _pylibmc import MemcachedError
 
 import random
 
+import snappy
 from pycassa import ColumnFamily
 from pycassa.cassandra.ttypes import ConsistencyLevel
 
+from r2.lib.access_ledger import get_ledger
+from r2.lib.lock import TimeoutExpired
 from r2.lib.utils import in_chunks, prefix_keys, trace, tup
 from r2.lib.hardcachebackend import HardCacheBackend
 
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import lz4.block
+except ImportError:
+    lz4 = None
+
 # This is for use in the health controller
 _CACHE_SERVERS = set()
 
@@ -66,6 +89,109 @@ class CacheUtils(object):
         return prefix_keys(keys, prefix, lambda k: self.simple_get_multi(k, **kw))
 
 
+class HotKeyTracker(object):
+    """Find the most read keys of a memcache client and replicate them.
+
+    A sample of reads is counted over `window` seconds. At the end of each
+    window the `report_top` most read keys are reported to `stats` and every
+    key estimated to be read more than `threshold` times per second is
+    promoted for the next window: reads of it are served from an in-process
+    replica that's refreshed from memcache every `ttl` seconds. This absorbs
+    load that would otherwise all land on the one memcached server the key
+    hashes to, at the cost of reads being up to `ttl` seconds stale.
+
+    """
+
+    def __init__(self, name, stats, sample_rate=0.01, threshold=1000,
+                 window=10, ttl=1, max_tracked=10*1000, report_top=10):
+        self.name = name
+        self.stats = stats
+        self.sample_rate = sample_rate
+        self.threshold = threshold
+        self.window = window
+        self.ttl = ttl
+        self.max_tracked = max_tracked
+        self.report_top = report_top
+
+        self.hot_keys = frozenset()
+        # replicas are stored pickled so that each reader gets its own copy
+        self.replicas = LRUCache(max_items=max_tracked)
+        self._counts = {}
+        self._window_start = unix_time()
+        self._replica_hits = 0
+        self._lock = Lock()
+
+    def record(self, keys):
+        """Count a read of keys (which must include any prefix)."""
+        if random.random() >= self.sample_rate:
+            return
+
+        with self._lock:
+            counts = self._counts
+            for key in keys:
+                if key in counts:
+                    counts[key] += 1
+                elif len(counts) < self.max_tracked:
+                    counts[key] = 1
+
+            now = unix_time()
+            if now - self._window_start >= self.window:
+                self._rotate(now)
+
+    def _rotate(self, now):
+        # estimated reads per second of each key in the window
+        scale = 1. / (self.sample_rate * (now - self._window_start))
+        counts = self._counts
+        self._counts = {}
+        self._window_start = now
+
+        self.hot_keys = frozenset(key for key, count in counts.iteritems()
+                                  if count * scale >= self.threshold)
+        for key in self.replicas.keys():
+            if key not in self.hot_keys:
+                self.replicas.delete(key)
+
+        top = heapq.nlargest(self.report_top, counts.iteritems(),
+                             key=itemgetter(1))
+        for key, count in top:
+            self.stats.count_string(
+                "cache.%s.top_keys" % self.name, key, count=int(count * scale))
+        self.stats.simple_event(
+            "cache.%s.hot_keys.promoted" % self.name, delta=len(self.hot_keys))
+        self.stats.simple_event(
+            "cache.%s.hot_keys.replica_hit" % self.name,
+            delta=self._replica_hits)
+        self._replica_hits = 0
+
+    def get_replicas(self, keys):
+        """Return the values of any hot keys we have a fresh replica of."""
+        hot_keys = self.hot_keys
+        if not hot_keys:
+            return {}
+
+        ret = {}
+        for key in keys:
+            if key in hot_keys:
+                pickled = self.replicas.get(key)
+                if pickled is not None:
+                    ret[key] = pickle.loads(pickled)
+        self._replica_hits += len(ret)
+        return ret
+
+    def replicate(self, values):
+        """Store replicas of any hot keys in values."""
+        hot_keys = self.hot_keys
+        for key, val in values.iteritems():
+            if key in hot_keys:
+                self.replicas.set(
+                    key, pickle.dumps(val, protocol=2), time=self.ttl)
+
+    def invalidate(self, keys):
+        """Drop replicas of keys that this process has just written."""
+        if self.hot_keys:
+            self.replicas.delete_multi(keys)
+
+
 class CMemcache(CacheUtils):
     def __init__(self,
                  name,
@@ -75,9 +201,12 @@ class CMemcache(CacheUtils):
                  no_block=False,
                  min_compress_len=512 * 1024,
                  num_clients=10,
-                 binary=False):
+                 binary=False,
+                 hot_key_tracker=None,
+                 cas=False):
         self.name = name
         self.servers = servers
+        self.hot_key_tracker = hot_key_tracker
         self.clients = pylibmc.ClientPool(n_slots = num_clients)
 
         for x in xrange(num_clients):
@@ -90,6 +219,9 @@ class CMemcache(CacheUtils):
             }
             if not binary:
                 behaviors['verify_keys'] = True
+            if cas:
+                # needed for gets() to return cas ids
+                behaviors['cas'] = True
 
             client.behaviors.update(behaviors)
             self.clients.put(client)
@@ -98,17 +230,53 @@ class CMemcache(CacheUtils):
 
         _CACHE_SERVERS.update(servers)
 
+    def _invalidate_hot_keys(self, keys, prefix=''):
+        if self.hot_key_tracker:
+            self.hot_key_tracker.invalidate(
+                [prefix + str(key) for key in keys])
+
     def get(self, key, default = None):
+        key = str(key)
+        tracker = self.hot_key_tracker
+        if tracker:
+            tracker.record((key,))
+            replicas = tracker.get_replicas((key,))
+            if replicas:
+                return replicas[key]
+
         with self.clients.reserve() as mc:
-            ret = mc.get(str(key))
-            if ret is None:
-                return default
-            return ret
+            ret = mc.get(key)
+
+        if ret is None:
+            return default
+        if tracker:
+            tracker.replicate({key: ret})
+        return ret
 
     def get_multi(self, keys, prefix = ''):
         str_keys = [str(key) for key in keys]
-        with self.clients.reserve() as mc:
-            return mc.get_multi(str_keys, key_prefix=prefix)
+        tracker = self.hot_key_tracker
+        if not tracker:
+            with self.clients.reserve() as mc:
+                return mc.get_multi(str_keys, key_prefix=prefix)
+
+        full_keys = [prefix + key for key in str_keys]
+        tracker.record(full_keys)
+        ret = {}
+        replicas = tracker.get_replicas(full_keys)
+        if replicas:
+            prefix_len = len(prefix)
+            ret.update((key[prefix_len:], val)
+                       for key, val in replicas.iteritems())
+            str_keys = [key for key in str_keys if key not in ret]
+
+        if str_keys:
+            with self.clients.reserve() as mc:
+                fetched = mc.get_multi(str_keys, key_prefix=prefix)
+            tracker.replicate({prefix + key: val
+                               for key, val in fetched.iteritems()})
+            ret.update(fetched)
+        return ret
 
     # simple_get_multi exists so that a cache chain can
     # single-instance the handling of prefixes for performance, but
@@ -118,23 +286,31 @@ class CMemcache(CacheUtils):
     # them, so here it is
     simple_get_multi = get_multi
 
-    def set(self, key, val, time=0):
+    def set(self, key, val, time=0, min_compress_len=None):
         # pylibmc converts this number to an unsigned integer without warning
         if time < 0:
             raise ValueError("Rejecting negative TTL for key %s" % key)
 
+        if min_compress_len is None:
+            min_compress_len = self.min_compress_len
+
+        self._invalidate_hot_keys((key,))
         with self.clients.reserve() as mc:
             return mc.set(str(key), val, time=time,
-                            min_compress_len = self.min_compress_len)
+                            min_compress_len = min_compress_len)
 
-    def set_multi(self, keys, prefix='', time=0):
+    def set_multi(self, keys, prefix='', time=0, min_compress_len=None):
         if time < 0:
             raise ValueError("Rejecting negative TTL for key %s" % key)
 
+        if min_compress_len is None:
+            min_compress_len = self.min_compress_len
+
         str_keys = {str(k): v for k, v in keys.iteritems()}
+        self._invalidate_hot_keys(str_keys, prefix)
         with self.clients.reserve() as mc:
             return mc.set_multi(str_keys, key_prefix=prefix, time=time,
-                                min_compress_len=self.min_compress_len)
+                                min_compress_len=min_compress_len)
 
     def add_multi(self, keys, prefix='', time=0):
         # pylibmc converts this number to an unsigned integer without warning
@@ -142,11 +318,13 @@ class CMemcache(CacheUtils):
             raise ValueError("Rejecting negative TTL for key %s" % key)
 
         str_keys = {str(k): v for k, v in keys.iteritems()}
+        self._invalidate_hot_keys(str_keys, prefix)
         with self.clients.reserve() as mc:
             return mc.add_multi(str_keys, key_prefix=prefix, time=time)
 
     def incr_multi(self, keys, prefix='', delta=1):
         str_keys = [str(key) for key in keys]
+        self._invalidate_hot_keys(str_keys, prefix)
         with self.clients.reserve() as mc:
             return mc.incr_multi(str_keys, key_prefix=prefix, delta=delta)
 
@@ -155,11 +333,13 @@ class CMemcache(CacheUtils):
         if time < 0:
             raise ValueError("Rejecting negative TTL for key %s" % key)
 
+        self._invalidate_hot_keys((key,))
         with self.clients.reserve() as mc:
             return mc.append(str(key), val, time=time)
 
     def incr(self, key, delta=1, time=0):
         # ignore the time on these
+        self._invalidate_hot_keys((key,))
         with self.clients.reserve() as mc:
             return mc.incr(str(key), delta)
 
@@ -168,6 +348,7 @@ class CMemcache(CacheUtils):
         if time < 0:
             raise ValueError("Rejecting negative TTL for key %s" % key)
 
+        self._invalidate_hot_keys((key,))
         try:
             with self.clients.reserve() as mc:
                 return mc.add(str(key), val, time=time)
@@ -175,14 +356,34 @@ class CMemcache(CacheUtils):
             return None
 
     def delete(self, key, time=0):
+        self._invalidate_hot_keys((key,))
         with self.clients.reserve() as mc:
             return mc.delete(str(key))
 
     def delete_multi(self, keys, prefix=''):
         str_keys = [str(key) for key in keys]
+        self._invalidate_hot_keys(str_keys, prefix)
         with self.clients.reserve() as mc:
             return mc.delete_multi(str_keys, key_prefix=prefix)
 
+    def gets(self, key):
+        """Return (value, cas_id) for key, or (None, None) if it's missing.
+
+        Only works if the cache was created with cas=True.
+
+        """
+        with self.clients.reserve() as mc:
+            return mc.gets(str(key))
+
+    def cas(self, key, val, cas_id, time=0):
+        """Set key only if it hasn't changed since gets returned cas_id."""
+        if time < 0:
+            raise ValueError("Rejecting negative TTL for key %s" % key)
+
+        self._invalidate_hot_keys((key,))
+        with self.clients.reserve() as mc:
+            return mc.cas(str(key), val, cas_id, time)
+
     def __repr__(self):
         return '<%s(%r)>' % (self.__class__.__name__,
                              self.servers)
@@ -231,8 +432,8 @@ class Mcrouter(CMemcache):
 
     """
 
-    def set(self, key, val, time=0):
-        success = CMemcache.set(self, key, val, time)
+    def set(self, key, val, time=0, min_compress_len=None):
+        success = CMemcache.set(self, key, val, time, min_compress_len)
 
         if not success:
             # If we are using prefix routing and the key doesn't match any
@@ -242,6 +443,223 @@ class Mcrouter(CMemcache):
             return True
 
 
+# header at the start of values encoded by a CacheCodec: a magic string, the
+# format version, and the ids of the serializer and compressor that were used
+CODEC_MAGIC = "\xfe\xca"
+CODEC_VERSION = 1
+CODEC_HEADER = struct.Struct("!2sBBB")
+
+
+def _msgpack_safe(val):
+    """Return whether msgpack will give back exactly the same value.
+
+    Strings and unicode survive the round trip with use_bin_type, and
+    unpacking with use_list=False turns arrays back into tuples, so lists
+    and other types have to be pickled instead.
+
+    """
+
+    if val is None or isinstance(val, (basestring, bool, float)):
+        return True
+    elif isinstance(val, (int, long)):
+        return -2**63 <= val < 2**64
+    elif type(val) is tuple:
+        return all(_msgpack_safe(item) for item in val)
+    elif type(val) is dict:
+        return all(_msgpack_safe(k) and _msgpack_safe(v)
+                   for k, v in val.iteritems())
+    return False
+
+
+class CacheCodec(object):
+    """Serialize and compress values before they're stored in memcached.
+
+    `serializer` is "pickle" or "msgpack" (falling back to pickle for values
+    msgpack can't round trip) and `compressor` is None, "zlib", "snappy" or
+    "lz4". Values are only compressed when they're at least
+    `min_compress_len` bytes and compression actually makes them smaller.
+
+    Encoded values start with a header naming the format version,
+    serializer and compressor, so any codec can decode any other codec's
+    values and unknown future formats are treated as misses. Ints are left
+    to pylibmc so that incr and decr keep working, and short strings are
+    stored as is. A codec with no serializer only decodes: deploy that
+    everywhere before turning on encoding so that no reader ever sees an
+    encoded value it can't decode.
+
+    Encoded values can't be appended to or prepended to.
+
+    """
+
+    RAW, PICKLE, MSGPACK = 0, 1, 2
+    SERIALIZERS = {"pickle": PICKLE, "msgpack": MSGPACK}
+
+    NONE, ZLIB, SNAPPY, LZ4 = 0, 1, 2, 3
+    COMPRESSORS = {None: NONE, "zlib": ZLIB, "snappy": SNAPPY, "lz4": LZ4}
+
+    def __init__(self, serializer=None, compressor=None,
+                 min_compress_len=1400):
+        if serializer is not None and serializer not in self.SERIALIZERS:
+            raise ValueError("unknown serializer %r" % serializer)
+        if compressor not in self.COMPRESSORS:
+            raise ValueError("unknown compressor %r" % compressor)
+        if serializer == "msgpack" and not msgpack:
+            raise ValueError("msgpack serializer needs msgpack installed")
+        if compressor == "lz4" and not lz4:
+            raise ValueError("lz4 compressor needs lz4 installed")
+
+        self.serializer = serializer
+        self.compressor = compressor
+        self.min_compress_len = min_compress_len
+
+    @classmethod
+    def from_spec(cls, spec, **kw):
+        """Make a codec from a "serializer[+compressor]" string."""
+        serializer, _, compressor = spec.partition("+")
+        return cls(serializer, compressor or None, **kw)
+
+    def __repr__(self):
+        return "<%s(%s+%s)>" % (self.__class__.__name__,
+                                self.serializer, self.compressor)
+
+    def _compress(self, data):
+        compressor = self.compressor
+        if not compressor or len(data) < self.min_compress_len:
+            return self.NONE, data
+
+        if compressor == "zlib":
+            compressed = zlib.compress(data)
+        elif compressor == "snappy":
+            compressed = snappy.compress(data)
+        else:
+            compressed = lz4.block.compress(data)
+
+        if len(compressed) >= len(data):
+            return self.NONE, data
+        return self.COMPRESSORS[compressor], compressed
+
+    def encode(self, val):
+        if not self.serializer or isinstance(val, (int, long)):
+            return val
+
+        if isinstance(val, str):
+            if (len(val) < self.min_compress_len and
+                    not val.startswith(CODEC_MAGIC)):
+                return val
+            serializer_id, data = self.RAW, val
+        elif self.serializer == "msgpack" and _msgpack_safe(val):
+            serializer_id = self.MSGPACK
+            data = msgpack.packb(val, use_bin_type=True)
+        else:
+            serializer_id = self.PICKLE
+            data = pickle.dumps(val, protocol=2)
+
+        compressor_id, data = self._compress(data)
+        header = CODEC_HEADER.pack(
+            CODEC_MAGIC, CODEC_VERSION, serializer_id, compressor_id)
+        return header + data
+
+    @classmethod
+    def decode(cls, val):
+        """Decode a value written by any codec.
+
+        Returns None (a miss) for values in a format we don't understand.
+
+        """
+
+        if not isinstance(val, str) or not val.startswith(CODEC_MAGIC):
+            return val
+
+        try:
+            magic, version, serializer_id, compressor_id = \
+                CODEC_HEADER.unpack_from(val)
+        except struct.error:
+            return val
+
+        if version > CODEC_VERSION:
+            return None
+
+        data = val[CODEC_HEADER.size:]
+        if compressor_id == cls.ZLIB:
+            data = zlib.decompress(data)
+        elif compressor_id == cls.SNAPPY:
+            data = snappy.uncompress(data)
+        elif compressor_id == cls.LZ4 and lz4:
+            data = lz4.block.decompress(data)
+        elif compressor_id != cls.NONE:
+            return None
+
+        if serializer_id == cls.RAW:
+            return data
+        elif serializer_id == cls.PICKLE:
+            return pickle.loads(data)
+        elif serializer_id == cls.MSGPACK and msgpack:
+            return msgpack.unpackb(data, raw=False, use_list=False)
+        return None
+
+
+class CodecCache(CacheUtils):
+    """Wrap a memcache client to encode values with a CacheCodec.
+
+    Everything other than getting and setting values is passed straight
+    through to the wrapped client.
+
+    """
+
+    def __init__(self, cache, codec):
+        self.cache = cache
+        self.codec = codec
+        if codec.compressor:
+            # don't let pylibmc compress what we've already compressed
+            self.min_compress_len = 0
+        else:
+            self.min_compress_len = None
+
+    def __getattr__(self, attr):
+        return getattr(self.cache, attr)
+
+    def __repr__(self):
+        return '<%s(%r, %r)>' % (self.__class__.__name__,
+                                 self.cache, self.codec)
+
+    def _decode_multi(self, values):
+        ret = {}
+        for key, val in values.iteritems():
+            val = self.codec.decode(val)
+            if val is not None:
+                ret[key] = val
+        return ret
+
+    def get(self, key, default=None):
+        val = self.cache.get(key)
+        if val is not None:
+            val = self.codec.decode(val)
+        if val is None:
+            return default
+        return val
+
+    def get_multi(self, keys, prefix=''):
+        return self._decode_multi(self.cache.get_multi(keys, prefix=prefix))
+
+    simple_get_multi = get_multi
+
+    def set(self, key, val, time=0):
+        return self.cache.set(key, self.codec.encode(val), time=time,
+                              min_compress_len=self.min_compress_len)
+
+    def set_multi(self, keys, prefix='', time=0):
+        encoded = {k: self.codec.encode(v) for k, v in keys.iteritems()}
+        return self.cache.set_multi(encoded, prefix=prefix, time=time,
+                                    min_compress_len=self.min_compress_len)
+
+    def add(self, key, val, time=0):
+        return self.cache.add(key, self.codec.encode(val), time=time)
+
+    def add_multi(self, keys, prefix='', time=0):
+        encoded = {k: self.codec.encode(v) for k, v in keys.iteritems()}
+        return self.cache.add_multi(encoded, prefix=prefix, time=time)
+
+
 class HardCache(CacheUtils):
     backend = None
     permanent = True
@@ -267,17 +685,15 @@ class HardCache(CacheUtils):
 
     def simple_get_multi(self, keys):
         results = {}
-        category_bundles = {}
-        for key in keys:
-            category, ids = self._split_key(key)
-            category_bundles.setdefault(category, []).append(ids)
+        for chunk in in_chunks(keys, size=200):
+            # all the categories in a chunk are fetched in one query
+            category_bundles = {}
+            for key in chunk:
+                category, ids = self._split_key(key)
+                category_bundles.setdefault(category, []).append(ids)
 
-        for category in category_bundles:
-            idses = category_bundles[category]
-            chunks = in_chunks(idses, size=50)
-            for chunk in chunks:
-                new_results = self.backend.get_multi(category, chunk)
-                results.update(new_results)
+            new_results = self.backend.get_multi_by_category(category_bundles)
+            results.update(new_results)
 
         return results
 
@@ -308,9 +724,16 @@ class HardCache(CacheUtils):
 
 
 class LocalCache(dict, CacheUtils):
+    # set by reset_caches so subclasses that evict can report it
+    stats = None
+
     def __init__(self, *a, **kw):
         return dict.__init__(self, *a, **kw)
 
+    def fresh(self):
+        """Return a new, empty cache configured like this one."""
+        return self.__class__()
+
     def _check_key(self, key):
         if isinstance(key, unicode):
             key = str(key) # try to convert it first
@@ -385,6 +808,345 @@ class LocalCache(dict, CacheUtils):
         return "<LocalCache(%d)>" % (len(self),)
 
 
+# memcached treats expiration times longer than this as absolute timestamps
+MAX_RELATIVE_TTL = 60 * 60 * 24 * 30
+
+
+def estimate_size(val, depth=3):
+    """Roughly estimate the memory footprint of `val` in bytes.
+
+    This follows containers and instance dicts down to `depth` levels, so
+    it's cheap enough to run on every local cache write but won't account
+    for deeply nested structures.
+
+    """
+
+    size = sys.getsizeof(val, 0)
+    if depth <= 0 or isinstance(val, basestring):
+        return size
+
+    depth -= 1
+    if isinstance(val, dict):
+        for k, v in val.iteritems():
+            size += estimate_size(k, depth) + estimate_size(v, depth)
+    elif isinstance(val, (list, tuple, set, frozenset)):
+        for item in val:
+            size += estimate_size(item, depth)
+    elif hasattr(val, "__dict__"):
+        size += estimate_size(val.__dict__, depth)
+    return size
+
+
+class LRUCache(LocalCache):
+    """A LocalCache with a bounded size and per-key expiration.
+
+    Once more than `max_items` keys are stored, or the estimated size of the
+    stored values exceeds `max_bytes`, the least recently used keys are
+    evicted. Either limit can be disabled by setting it to 0.
+
+    Unlike LocalCache, the `time` argument to the setters is honored with
+    the same semantics as memcached: 0 means never expire and values longer
+    than 30 days are absolute unix timestamps.
+
+    Evictions are reported to `stats` (a CacheStats) when it is set.
+
+    """
+
+    def __init__(self, max_items=10*1000, max_bytes=0):
+        LocalCache.__init__(self)
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.size_bytes = 0
+        # key -> estimated size, ordered from least to most recently used
+        self._recency = OrderedDict()
+        self._expirations = {}
+        self._lock = Lock()
+
+    def fresh(self):
+        cache = self.__class__(max_items=self.max_items,
+                               max_bytes=self.max_bytes)
+        cache.stats = self.stats
+        return cache
+
+    def _report_evictions(self, count, reason):
+        if count and self.stats:
+            self.stats.cache_eviction(count, reason)
+
+    def _is_expired(self, key, now=None):
+        expiration = self._expirations.get(key)
+        if expiration is None:
+            return False
+        return expiration <= (now or unix_time())
+
+    def _remove(self, key):
+        dict.__delitem__(self, key)
+        self.size_bytes -= self._recency.pop(key, 0)
+        self._expirations.pop(key, None)
+
+    def _lookup(self, key):
+        """Return the value for key and mark it as recently used.
+
+        Raises KeyError if the key is missing or has expired.
+
+        """
+
+        with self._lock:
+            value = dict.__getitem__(self, key)
+            if self._is_expired(key):
+                self._remove(key)
+                self._report_evictions(1, "expired")
+                raise KeyError(key)
+            self._recency[key] = self._recency.pop(key)
+            return value
+
+    def _store(self, key, val, time=None):
+        """Store val under key.
+
+        `time` is the TTL as passed to set(). None leaves any existing
+        expiration in place, which is what incr() and friends expect.
+
+        """
+
+        size = estimate_size(val) if self.max_bytes else 0
+
+        with self._lock:
+            if dict.__contains__(self, key):
+                self.size_bytes -= self._recency.pop(key)
+
+            dict.__setitem__(self, key, val)
+            self._recency[key] = size
+            self.size_bytes += size
+
+            if time is not None:
+                if time > MAX_RELATIVE_TTL:
+                    self._expirations[key] = time
+                elif time > 0:
+                    self._expirations[key] = unix_time() + time
+                else:
+                    self._expirations.pop(key, None)
+
+            self._evict()
+
+    def _evict(self):
+        evicted = 0
+        while self._recency and (
+                (self.max_items and len(self._recency) > self.max_items) or
+                (self.max_bytes and self.size_bytes > self.max_bytes)):
+            key = next(iter(self._recency))
+            self._remove(key)
+            evicted += 1
+        self._report_evictions(evicted, "size")
+
+    def expire(self):
+        """Remove all expired keys from the cache."""
+        with self._lock:
+            now = unix_time()
+            expired = [key for key in self._expirations
+                       if self._is_expired(key, now)]
+            for key in expired:
+                self._remove(key)
+            self._report_evictions(len(expired), "expired")
+
+    def __getitem__(self, key):
+        return self._lookup(key)
+
+    def __setitem__(self, key, val):
+        self._store(key, val)
+
+    def __delitem__(self, key):
+        with self._lock:
+            self._remove(key)
+
+    def __contains__(self, key):
+        with self._lock:
+            if not dict.__contains__(self, key):
+                return False
+            elif self._is_expired(key):
+                self._remove(key)
+                self._report_evictions(1, "expired")
+                return False
+            return True
+
+    has_key = __contains__
+
+    def get(self, key, default=None):
+        try:
+            r = self._lookup(key)
+        except KeyError:
+            return default
+        if r is None:
+            return default
+        return r
+
+    def set(self, key, val, time=0):
+        self._check_key(key)
+        self._store(key, val, time)
+
+    def add(self, key, val, time=0):
+        self._check_key(key)
+        if key in self:
+            return False
+        self._store(key, val, time)
+        return True
+
+    def setdefault(self, key, default=None):
+        try:
+            return self._lookup(key)
+        except KeyError:
+            self._store(key, default)
+            return default
+
+    def update(self, *a, **kw):
+        for key, val in dict(*a, **kw).iteritems():
+            self._store(key, val)
+
+    def pop(self, key, *default):
+        with self._lock:
+            if dict.__contains__(self, key):
+                val = dict.__getitem__(self, key)
+                self._remove(key)
+                return val
+        if default:
+            return default[0]
+        raise KeyError(key)
+
+    def clear(self):
+        with self._lock:
+            dict.clear(self)
+            self._recency.clear()
+            self._expirations.clear()
+            self.size_bytes = 0
+
+    def __repr__(self):
+        return "<LRUCache(%d/%d, %d bytes)>" % (
+            len(self), self.max_items, self.size_bytes)
+
+
+class ParallelFetcher(object):
+    """Run independent backend requests concurrently on a thread pool.
+
+    The requests run on pool threads, so the backends must not be
+    thread-local (cache chains are); see can_run.
+
+    A hedged call that's given up on keeps its pool thread until it returns,
+    so calls are never queued behind busy threads: when there aren't enough
+    free threads they're made one after another on the calling thread.
+
+    """
+
+    def __init__(self, pool_size=4, hedge_delay=0.005):
+        self.pool_size = pool_size
+        self.hedge_delay = hedge_delay
+        self._pool = None
+        self._pid = None
+        self._lock = Lock()
+        self._in_flight = 0
+        self._in_flight_lock = Lock()
+
+    @property
+    def pool(self):
+        # threads don't survive a fork, so each worker starts its own pool
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pool = ThreadPool(self.pool_size)
+                self._pid = os.getpid()
+                with self._in_flight_lock:
+                    self._in_flight = 0
+            return self._pool
+
+    @staticmethod
+    def can_run(*backends):
+        return not any(isinstance(backend, local) for backend in backends)
+
+    @staticmethod
+    def _timed(fn, args):
+        start = unix_time()
+        ret = fn(*args)
+        return ret, start, unix_time()
+
+    def _reserve(self, n):
+        """Claim n pool threads, returning False if there aren't n free."""
+        # start the pool first, which resets the count in a new worker
+        self.pool
+        with self._in_flight_lock:
+            if self._in_flight + n > self.pool_size:
+                g.stats.simple_event("parallel_fetcher.pool_busy")
+                return False
+            self._in_flight += n
+            return True
+
+    def _apply_async(self, fn, args):
+        def pooled():
+            try:
+                return self._timed(fn, args)
+            finally:
+                with self._in_flight_lock:
+                    self._in_flight -= 1
+        return self.pool.apply_async(pooled)
+
+    def run(self, calls, stats=None):
+        """Make each call and return their results in the same order.
+
+        `calls` is a list of (backend_name, fn, args). The first call runs
+        on the calling thread while the rest run on the pool, or on the
+        calling thread too if the pool is busy. The time taken by each
+        backend is reported to `stats` if given.
+
+        """
+
+        if len(calls) > 1 and self._reserve(len(calls) - 1):
+            pending = [self._apply_async(fn, args)
+                       for name, fn, args in calls[1:]]
+            name, fn, args = calls[0]
+            timed_results = [self._timed(fn, args)]
+            timed_results.extend(async_result.get() for async_result in pending)
+        else:
+            timed_results = [self._timed(fn, args) for name, fn, args in calls]
+
+        results = []
+        for (name, fn, args), (ret, start, end) in zip(calls, timed_results):
+            if stats:
+                stats.backend_timing(name, start, end)
+            results.append(ret)
+        return results
+
+    def hedge(self, first, second, stats=None):
+        """Make the first call, and the second too if the first is slow.
+
+        `first` and `second` are (backend_name, fn, args). The second call is
+        only made (on the calling thread) if the first hasn't returned within
+        hedge_delay seconds. Once the second call returns the first is given
+        at most another hedge_delay seconds. Returns the results of the calls
+        that were made, with None for the first if it was given up on.
+
+        When the pool is busy only the first call is made, on the calling
+        thread.
+
+        """
+
+        name, fn, args = first
+        if not self._reserve(1):
+            return self.run([first], stats=stats)
+
+        pending = self._apply_async(fn, args)
+        try:
+            ret, start, end = pending.get(self.hedge_delay)
+        except PoolTimeoutError:
+            results = self.run([second], stats=stats)
+            try:
+                ret, start, end = pending.get(self.hedge_delay)
+            except PoolTimeoutError:
+                # it carries on in the pool but nobody waits for it
+                return [None] + results
+            results.insert(0, ret)
+        else:
+            results = [ret]
+
+        if stats:
+            stats.backend_timing(name, start, end)
+        return results
+
+
 class TransitionalCache(CacheUtils):
     """A cache "chain" for moving keys to a new cluster live.
 
@@ -585,10 +1347,187 @@ def cache_timer_decorator(fn_name):
     return wrap
 
 
+class _Flight(object):
+    """A batch of keys being loaded by one thread."""
+    def __init__(self):
+        self.owner = get_ident()
+        self.done = Event()
+        # whether any other thread is waiting for these keys
+        self.waited_on = False
+        # set to the dict of pickled values if the load succeeded
+        self.results = None
+
+
+class SingleFlight(object):
+    """Coalesce concurrent loads of keys that missed the cache.
+
+    When several threads miss on the same keys at once, only the first runs
+    the load function and the others wait for its results instead of all
+    going to the database. Values are pickled before the loader returns
+    them and waiters unpickle their own copies, so threads never share
+    mutable objects.
+
+    If `lease_cache` is set, a short lease is added there for every key we
+    load so that other processes missing on the same key wait up to
+    `lease_time` seconds for it to show up in the cache rather than loading
+    it themselves.
+
+    """
+
+    POLL_INTERVAL = 0.05
+
+    def __init__(self, lease_cache=None, lease_time=2, timeout=5):
+        self.lease_cache = lease_cache
+        self.lease_time = lease_time
+        self.timeout = timeout
+        self._lock = Lock()
+        self._flights = {}
+
+    def load_multi(self, cache, keys, load_fn, prefix=''):
+        """Return load_fn(keys), sharing the work with concurrent callers.
+
+        `load_fn` takes a list of keys and returns a dict of the ones it
+        found. It is expected to write what it loads to `cache` under
+        `prefix` so that waiters in other processes can find it.
+
+        """
+
+        me = get_ident()
+        my_flight = _Flight()
+        owned = []
+        reentrant = []
+        flights = {}
+
+        with self._lock:
+            for key in keys:
+                flight_key = prefix + str(key)
+                flight = self._flights.get(flight_key)
+                if flight is None:
+                    self._flights[flight_key] = my_flight
+                    owned.append(key)
+                elif flight.owner == me:
+                    # load_fn is looking up a key this thread is already
+                    # loading further up the stack, it can't wait on itself
+                    reentrant.append(key)
+                else:
+                    flight.waited_on = True
+                    flights.setdefault(flight, []).append(key)
+
+        ret = {}
+        loaded = coalesced = 0
+        succeeded = False
+        try:
+            if owned:
+                values, loaded = self._load_leased(
+                    cache, owned, load_fn, prefix)
+                ret.update(values)
+                coalesced += len(owned) - loaded
+            succeeded = True
+        finally:
+            with self._lock:
+                for key in owned:
+                    del self._flights[prefix + str(key)]
+            try:
+                # no one can start waiting now, and our caller can change
+                # the values once we return so copy them for the waiters
+                if succeeded and my_flight.waited_on:
+                    my_flight.results = {
+                        key: pickle.dumps(value, protocol=2)
+                        for key, value in ret.iteritems()
+                    }
+            finally:
+                my_flight.done.set()
+
+        need = reentrant
+        for flight, flight_keys in flights.iteritems():
+            flight.done.wait(self.timeout)
+            if flight.results is None:
+                # the other thread failed or is taking too long, don't
+                # make our caller pay for it
+                need.extend(flight_keys)
+                continue
+
+            for key in flight_keys:
+                if key in flight.results:
+                    ret[key] = pickle.loads(flight.results[key])
+            coalesced += len(flight_keys)
+
+        if need:
+            ret.update(load_fn(need))
+            loaded += len(need)
+
+        stats = getattr(cache, "stats", None)
+        if stats:
+            stats.single_flight(loaded=loaded, coalesced=coalesced)
+
+        return ret
+
+    def _load_leased(self, cache, keys, load_fn, prefix):
+        """Load keys, waiting on those another process holds a lease for.
+
+        Returns the loaded values and the number of keys we had to load
+        ourselves.
+
+        """
+
+        if not self.lease_cache:
+            return load_fn(keys), len(keys)
+
+        lease_prefix = "singleflight-" + prefix
+        leases = {str(key): get_ident() for key in keys}
+        try:
+            leased_elsewhere = set(self.lease_cache.add_multi(
+                leases, prefix=lease_prefix, time=self.lease_time))
+        except MemcachedError:
+            leased_elsewhere = set()
+
+        to_load = [key for key in keys if str(key) not in leased_elsewhere]
+        to_wait = [key for key in keys if str(key) in leased_elsewhere]
+
+        ret = {}
+        if to_load:
+            try:
+                ret.update(load_fn(to_load))
+            finally:
+                try:
+                    self.lease_cache.delete_multi(
+                        [str(key) for key in to_load], prefix=lease_prefix)
+                except MemcachedError:
+                    # the leases will expire on their own soon anyway
+                    pass
+
+        waited = 0
+        while to_wait and waited < self.lease_time:
+            sleep(self.POLL_INTERVAL)
+            waited += self.POLL_INTERVAL
+            found = cache.get_multi(to_wait, prefix=prefix)
+            ret.update(found)
+            to_wait = [key for key in to_wait if key not in found]
+
+        if to_wait:
+            # the lease holder didn't fill these in time
+            ret.update(load_fn(to_wait))
+            to_load.extend(to_wait)
+
+        return ret, len(to_load)
+
+
+def load_coalesced(cache, keys, load_fn, prefix=''):
+    """Run load_fn(keys), coalesced through cache's SingleFlight if any."""
+    single_flight = getattr(cache, "single_flight", None)
+    if isinstance(single_flight, SingleFlight):
+        return single_flight.load_multi(cache, keys, load_fn, prefix=prefix)
+    return load_fn(list(keys))
+
+
 class CacheChain(CacheUtils, local):
-    def __init__(self, caches, cache_negative_results=False):
+    def __init__(self, caches, cache_negative_results=False,
+                 single_flight=None):
         self.caches = caches
         self.cache_negative_results = cache_negative_results
+        # shared by all threads (unlike the rest of the chain's state) so
+        # that they can coalesce their loads
+        self.single_flight = single_flight
         self.stats = None
 
     def make_set_fn(fn_name):
@@ -621,8 +1560,18 @@ class CacheChain(CacheUtils, local):
     flush_all = make_set_fn('flush_all')
     cache_negative_results = False
 
+    def _record_access(self, keys):
+        # only chains registered in g.cache_chains have stats, which keeps
+        # chains nested within them from recording the same fetch twice
+        if not self.stats:
+            return
+        ledger = get_ledger()
+        if ledger:
+            ledger.record_cache(self.stats.cache_name, keys)
+
     @cache_timer_decorator("get")
     def get(self, key, default = None, allow_local = True, stale=None):
+        self._record_access([key])
         stat_outcome = False  # assume a miss until a result is found
         is_localcache = False
         try:
@@ -668,6 +1617,7 @@ class CacheChain(CacheUtils, local):
     @cache_timer_decorator("get_multi")
     def simple_get_multi(self, keys, allow_local = True, stale=None,
                          stat_subname=None):
+        self._record_access(keys)
         out = {}
         need = set(keys)
         hits = 0
@@ -734,7 +1684,7 @@ class CacheChain(CacheUtils, local):
 
     def reset(self):
         # the first item in a cache chain is a LocalCache
-        self.caches = (self.caches[0].__class__(),) +  self.caches[1:]
+        self.caches = (self.caches[0].fresh(),) +  self.caches[1:]
 
 class MemcacheChain(CacheChain):
     pass
@@ -779,21 +1729,55 @@ class StaleCacheChain(CacheChain):
        cache. Probably doesn't play well with NoneResult cacheing"""
     staleness = 30
 
-    def __init__(self, localcache, stalecache, realcache):
+    def __init__(self, localcache, stalecache, realcache, single_flight=None,
+                 parallel_fetcher=None, require_fresh=None):
         self.localcache = localcache
         self.stalecache = stalecache
         self.realcache = realcache
         self.caches = (localcache, realcache) # for the other
                                               # CacheChain machinery
+        self.single_flight = single_flight
+        # if the stale cache is slow to answer, ask the real cache too rather
+        # than waiting to only ask it for the stale cache's misses
+        self.parallel_fetcher = parallel_fetcher
+        # a function returning True when the current request mustn't be
+        # given stale data (e.g. the user has just written something)
+        self.require_fresh = require_fresh
         self.stats = None
 
+    def _fetch_in_parallel(self):
+        return bool(self.parallel_fetcher and
+            self.parallel_fetcher.can_run(self.stalecache, self.realcache))
+
+    def _allow_stale(self, stale):
+        return stale and not (self.require_fresh and self.require_fresh())
+
     @cache_timer_decorator("get")
     def get(self, key, default=None, stale = False, **kw):
-        if kw.get('allow_local', True) and key in self.localcache:
-            return self.localcache[key]
-
+        self._record_access([key])
+        stale = self._allow_stale(stale)
+        if kw.get('allow_local', True):
+            # a single lookup so an expiring localcache can't drop the key
+            # between checking for it and reading it
+            local_value = self.localcache.get(key)
+            if local_value is not None:
+                return local_value
+
+        fetched_real = False
         if stale:
-            stale_value = self._getstale([key]).get(key, None)
+            if self._fetch_in_parallel():
+                results = self.parallel_fetcher.hedge(
+                    ("stale", self._getstale, ([key],)),
+                    ("real", self.realcache.get, (key,)),
+                    stats=self.stats)
+                stale_values = results[0] or {}
+                if len(results) > 1:
+                    fetched_real = True
+                    value = results[1]
+            else:
+                stale_values = self._getstale([key])
+
+            stale_value = stale_values.get(key, None)
             if stale_value is not None:
                 if self.stats:
                     self.stats.cache_hit()
@@ -805,7 +1789,8 @@ class StaleCacheChain(CacheChain):
             else:
                 self.stats.stale_miss()
 
-        value = self.realcache.get(key)
+        if not fetched_real:
+            value = self.realcache.get(key)
         if value is None:
             if self.stats:
                 self.stats.cache_miss()
@@ -825,19 +1810,31 @@ class StaleCacheChain(CacheChain):
     def simple_get_multi(self, keys, stale=False, stat_subname=None, **kw):
         if not isinstance(keys, set):
             keys = set(keys)
+        self._record_access(keys)
+        stale = self._allow_stale(stale)
 
         ret = {}
         local_hits = 0
 
         if kw.get('allow_local'):
-            for k in list(keys):
-                if k in self.localcache:
-                    ret[k] = self.localcache[k]
-                    keys.remove(k)
-                    local_hits += 1
+            local_values = self.localcache.simple_get_multi(keys)
+            ret.update(local_values)
+            keys -= set(local_values)
+            local_hits += len(local_values)
 
+        real_values = None
         if keys and stale:
-            stale_values = self._getstale(keys)
+            if self._fetch_in_parallel():
+                results = self.parallel_fetcher.hedge(
+                    ("stale", self._getstale, (set(keys),)),
+                    ("real", self.realcache.simple_get_multi, (set(keys),)),
+                    stats=self.stats)
+                stale_values = results[0] or {}
+                if len(results) > 1:
+                    real_values = results[1]
+            else:
+                stale_values = self._getstale(keys)
+
             # never put stale data into the localcache
             for k, v in stale_values.iteritems():
                 ret[k] = v
@@ -850,7 +1847,14 @@ class StaleCacheChain(CacheChain):
                 self.stats.stale_miss(stale_misses, subname=stat_subname)
 
         if keys:
-            values = self.realcache.simple_get_multi(keys)
+            if real_values is None:
+                values = self.realcache.simple_get_multi(keys)
+            else:
+                # stale values take precedence, as they would have if we'd
+                # only asked the real cache for the rest
+                values = {key: value
+                          for key, value in real_values.iteritems()
+                          if key in keys}
             if values and stale:
                 self.stalecache.set_multi(values, time=self.staleness)
             self.localcache.update(values)
@@ -870,7 +1874,7 @@ class StaleCacheChain(CacheChain):
         return self.stalecache.simple_get_multi(keys)
 
     def reset(self):
-        newcache = self.localcache.__class__()
+        newcache = self.localcache.fresh()
         self.localcache = newcache
         self.caches = (newcache,) +  self.caches[1:]
         if isinstance(self.realcache, CacheChain):
@@ -895,10 +1899,24 @@ class Permacache(object):
 
     COLUMN_NAME = 'value'
 
-    def __init__(self, cache_chain, column_family, lock_factory):
+    def __init__(self, cache_chain, column_family, lock_factory,
+                 cas_cache=None, max_cas_attempts=10):
         self.cache_chain = cache_chain
         self.make_lock = lock_factory
         self.cf = column_family
+        # when set, mutate uses compare-and-set on this memcache (the one in
+        # cache_chain that sits in front of cassandra) and only holds the
+        # lock while writing
+        self.cas_cache = cas_cache
+        self.max_cas_attempts = max_cas_attempts
+
+    @property
+    def single_flight(self):
+        return self.cache_chain.single_flight
+
+    @property
+    def stats(self):
+        return self.cache_chain.stats
 
     @classmethod
     def _setup_column_family(cls, column_family_name, client):
@@ -909,6 +1927,9 @@ class Permacache(object):
 
     def _backend_get(self, keys):
         keys, is_single = tup(keys, ret_is_single=True)
+        ledger = get_ledger()
+        if ledger:
+            ledger.record("cassandra", self.cf.column_family, keys)
         rows = self.cf.multiget(keys, columns=[self.COLUMN_NAME])
         ret = {
             key: pickle.loads(columns[self.COLUMN_NAME])
@@ -922,18 +1943,18 @@ class Permacache(object):
         else:
             return ret
 
-    def _backend_set(self, key, val):
+    def _backend_set(self, key, val, timestamp=None):
         keys = {key: val}
-        ret = self._backend_set_multi(keys)
+        ret = self._backend_set_multi(keys, timestamp=timestamp)
         return ret.get(key)
 
-    def _backend_set_multi(self, keys, prefix=''):
+    def _backend_set_multi(self, keys, prefix='', timestamp=None):
         ret = {}
         with self.cf.batch():
             for key, val in keys.iteritems():
                 rowkey = "%s%s" % (prefix, key)
                 column = {self.COLUMN_NAME: pickle.dumps(val, protocol=2)}
-                ret[key] = self.cf.insert(rowkey, column)
+                ret[key] = self.cf.insert(rowkey, column, timestamp=timestamp)
         return ret
 
     def _backend_delete(self, key):
@@ -988,6 +2009,12 @@ class Permacache(object):
 
     def mutate(self, key, mutation_fn, default=None, willread=True):
         """Mutate a Cassandra key as atomically as possible"""
+        if self.cas_cache:
+            return self._mutate_cas(key, mutation_fn, willread)
+
+        return self._mutate_locked(key, mutation_fn, willread)
+
+    def _mutate_locked(self, key, mutation_fn, willread):
         with self.make_lock("permacache_mutate", "mutate_%s" % key):
             # This has an edge-case where the cache chain was populated by a ONE
             # read rather than a QUORUM one just before running this. All reads
@@ -1007,6 +2034,81 @@ class Permacache(object):
             self.cache_chain.set(key, new_value, use_timer=False)
         return new_value
 
+    def _mutate_cas(self, key, mutation_fn, willread):
+        """Mutate a key optimistically, retrying if another writer wins.
+
+        The value in cas_cache is treated as the latest version of the key:
+        a writer reads it with gets, applies mutation_fn, and stores the
+        result with cas, which fails if anyone else stored a new version in
+        the meantime. Only the writer whose cas succeeded writes cassandra.
+
+        memcached can drop the key at any time, including between a writer's
+        cas and its cassandra write. A writer that then finds the key missing
+        must not rebuild it from cassandra before that write lands, so the
+        cas and the cassandra write are done holding the same lock as
+        _mutate_locked, and a missing key is mutated with _mutate_locked.
+        Only reading the value and running mutation_fn happen unlocked. If
+        the cassandra write fails the key is deleted from cas_cache so the
+        next writer reads cassandra rather than building on a value that was
+        never stored.
+
+        The cassandra writes are ordered by their timestamps, which come from
+        each writer's own clock. Writers must keep their clocks in sync to
+        well within the time between two mutations of a key: a writer whose
+        clock is behind can have its write lost under an earlier one even
+        though its cas came later.
+
+        """
+
+        retries = 0
+        exhausted = False
+        try:
+            for attempt in xrange(self.max_cas_attempts):
+                if attempt:
+                    retries += 1
+                    # back off with jitter so writers that collided don't
+                    # collide again on their next attempt
+                    sleep(random.uniform(0, 0.005 * 2 ** min(attempt, 6)))
+
+                value, cas_id = self.cas_cache.gets(key)
+                if cas_id is None:
+                    # not in memcached: a writer whose cas succeeded may
+                    # still be writing cassandra, so wait for it on the lock
+                    return self._mutate_locked(key, mutation_fn, willread)
+
+                # send in a copy in case they mutate it in-place
+                new_value = mutation_fn(copy(value))
+
+                with self.make_lock("permacache_mutate", "mutate_%s" % key):
+                    # take the timestamp before claiming the key so that
+                    # anyone claiming it after us also writes cassandra after
+                    # us, no matter whose write gets there first
+                    timestamp = int(unix_time() * 1e6)
+                    if not self.cas_cache.cas(key, new_value, cas_id):
+                        continue
+
+                    if not willread or value != new_value:
+                        try:
+                            self._backend_set(key, new_value,
+                                              timestamp=timestamp)
+                        except:
+                            self.cas_cache.delete(key)
+                            raise
+
+                # cas_cache already has the value, the closer caches don't
+                for cache in self.cache_chain.caches:
+                    if cache is self.cas_cache:
+                        break
+                    cache.set(key, new_value)
+                return new_value
+
+            exhausted = True
+            raise TimeoutExpired("gave up mutating %s after %d attempts" %
+                                 (key, self.max_cas_attempts))
+        finally:
+            if self.stats:
+                self.stats.cas_mutation(retries, exhausted=exhausted)
+
     def __repr__(self):
         return '<%s %r %r>' % (self.__class__.__name__,
                             self.cache_chain, self.cf.column_family)
@@ -1084,6 +2186,9 @@ class SelfEmptyingCache(LocalCache):
     def __init__(self, max_size=10*1000):
         self.max_size = max_size
 
+    def fresh(self):
+        return self.__class__(max_size=self.max_size)
+
     def maybe_reset(self):
         if len(self) > self.max_size:
             self.clear()
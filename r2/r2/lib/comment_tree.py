@@ -26,6 +26,7 @@ from itertools import chain
 from pylons import tmpl_context as c
 from pylons import app_globals as g
 
+from r2.lib.db import sorts
 from r2.lib.sgm import sgm
 from r2.lib.utils import tup
 from r2.models.comment_tree import CommentTree
@@ -70,11 +71,23 @@ def add_comments(comments):
         timer.stop()
 
 
+BATCH_SORTS = {
+    "_controversy": sorts.batch_controversy,
+    "_confidence": sorts.batch_confidence,
+    "_score": sorts.batch_score,
+}
+
+
 def calculate_comment_scores(link, sort, comments):
-    if sort in ("_controversy", "_confidence", "_score"):
+    if sort in BATCH_SORTS:
+        batch_fn = BATCH_SORTS[sort]
+        values = batch_fn(
+            [comment._ups for comment in comments],
+            [comment._downs for comment in comments],
+        )
         scores = {
-            comment._id36: getattr(comment, sort)
-            for comment in comments
+            comment._id36: value
+            for comment, value in zip(comments, values)
         }
     elif sort == "_qa":
         comment_tree = CommentTree.by_link(link)
@@ -111,11 +124,49 @@ def _calculate_qa_comment_scores(link, cid_tree, comments):
             all_child_cids.extend(child_cids)
     all_child_comments = Comment._byID(all_child_cids)
 
-    comment_sorter = {}
+    # This scores all of the comments at once the same way Comment._qa
+    # scores a single comment.
+    op_children_by_comment = []
     for comment in comments:
         child_cids = cid_tree.get(comment._id, ())
         child_comments = (all_child_comments[cid] for cid in child_cids)
-        sort_value = comment._qa(child_comments, responder_ids)
+        op_children_by_comment.append(
+            [c for c in child_comments if c.author_id in responder_ids])
+
+    answers = list(chain.from_iterable(op_children_by_comment))
+    answer_confidences = iter(sorts.batch_confidence(
+        [answer._ups for answer in answers],
+        [answer._downs for answer in answers],
+    ))
+
+    answer_scores = []
+    answer_lengths = []
+    for op_children in op_children_by_comment:
+        # Only take into account the "best" answer from OP.
+        best_score = None
+        answer_length = 1
+        for answer in op_children:
+            score = next(answer_confidences)
+            if best_score is None or score > best_score:
+                best_score = score
+                answer_length = len(answer.body)
+        answer_scores.append(best_score or 0)
+        answer_lengths.append(answer_length)
+
+    qa_scores = sorts.batch_qa(
+        [comment._ups for comment in comments],
+        [comment._downs for comment in comments],
+        [len(comment.body) for comment in comments],
+        answer_scores,
+        answer_lengths,
+    )
+
+    comment_sorter = {}
+    for comment, op_children, sort_value in zip(
+            comments, op_children_by_comment, qa_scores):
+        # Rank replies from OP higher, as Comment._qa does.
+        if comment.author_id in responder_ids and not op_children:
+            sort_value *= 2
         comment_sorter[comment._id36] = sort_value
 
     return comment_sorter
@@ -413,7 +464,11 @@ def _populate(after_id = None, estimate=54301242):
     if after_id is not None:
         q._after(Comment._byID(after_id))
 
-    q = utils.fetch_things2(q, chunk_size=chunk_size)
+    def checkpoint(comment):
+        print "done through comment %d (resume with after_id)" % comment._id
+
+    q = utils.stream_things(q, batch_size=chunk_size,
+                            checkpoint_fn=checkpoint)
     q = utils.progress(q, verbosity=chunk_size, estimate = estimate)
 
     for chunk in utils.in_chunks(q, chunk_size):
@@ -0,0 +1,155 @@
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of
+# the Original Code is reddit Inc.
+#
+# All portions of the code written by reddit are Copyright (c) 2006-2016 reddit
+# Inc. All Rights Reserved.
+###############################################################################
+"""Request-scoped batching of Thing lookups.
+
+Code that knows it will need some things later in the request (e.g. a
+builder that's about to render authors and subreddits) can register their
+ids ahead of time:
+
+    Account._prefetch(author_ids)
+    Subreddit._prefetch(sr_ids)
+
+Nothing is fetched then. The next _byID of that type fetches the registered
+ids along with the ones it was asked for, in the same cache get_multi and
+database query, so later lookups of them are answered from the local cache
+(or, for stale lookups, which the local cache doesn't answer, from the
+loader itself). flush() resolves everything still pending in one round trip
+per type.
+
+"""
+
+from collections import defaultdict
+
+from pylons import app_globals as g
+from pylons import tmpl_context as c
+
+
+class BatchLoader(object):
+    def __init__(self):
+        # cls -> ids registered but not fetched yet
+        self.pending = defaultdict(set)
+        # cls -> {id: thing} fetched in a batch from a stale read
+        self.stale_things = defaultdict(dict)
+        # cls -> ids fetched in a batch that nothing has asked for yet, and
+        # whether they were fetched from a stale read
+        self.unclaimed = defaultdict(dict)
+        self.batches = 0
+        self.flushes = 0
+        # lookups answered entirely by things fetched in a batch
+        self.loads_served = 0
+
+    @property
+    def round_trips_saved(self):
+        # batches fetched along with another lookup cost nothing extra, but
+        # each flush is a round trip of its own
+        return self.loads_served - self.flushes
+
+    def prefetch(self, cls, ids):
+        if ids:
+            self.pending[cls].update(ids)
+
+    def take(self, cls, exclude=()):
+        """Return the ids pending for cls and forget about them.
+
+        The caller is expected to fetch them along with its own lookup and
+        pass what it found to store().
+
+        """
+
+        ids = self.pending.pop(cls, None)
+        if not ids:
+            return []
+
+        self.batches += 1
+        return list(ids.difference(exclude))
+
+    def store(self, cls, things_by_id, stale=False):
+        """Note the things fetched for ids returned by take()."""
+        for _id, thing in things_by_id.iteritems():
+            self.unclaimed[cls][_id] = stale
+            if stale:
+                self.stale_things[cls][_id] = thing
+
+    def claim(self, cls, ids, stale=False):
+        """Note a lookup of ids and return what a batch already has of them.
+
+        Only lookups that can take stale data get things back, the rest are
+        answered from the local cache. Lookups for which every id was
+        fetched in a batch (for the first time) count as served by it.
+
+        """
+
+        unclaimed = self.unclaimed.get(cls)
+        if ids and unclaimed and all(_id in unclaimed and (stale or not unclaimed[_id])
+                             for _id in ids):
+            self.loads_served += 1
+            for _id in ids:
+                del unclaimed[_id]
+
+        if not stale:
+            return {}
+        stale_things = self.stale_things.get(cls, {})
+        return {_id: stale_things[_id] for _id in ids if _id in stale_things}
+
+    def forget(self, cls, ids):
+        """Drop the batched copies of things that have since been changed."""
+        stale_things = self.stale_things.get(cls, {})
+        for _id in ids:
+            stale_things.pop(_id, None)
+
+    def flush(self):
+        """Fetch everything that's pending, one round trip per type."""
+        for cls in self.pending.keys():
+            ids = self.take(cls)
+            if ids:
+                self.flushes += 1
+                self.store(cls, cls._load_prefetched(ids))
+
+    def report(self):
+        return "%d round trips saved in %d batches" % (
+            self.round_trips_saved, self.batches)
+
+
+def get_loader():
+    """Return the current request's BatchLoader, if it has one."""
+    try:
+        return getattr(c, "batch_loader", None) or None
+    except TypeError:
+        # not in a request
+        return None
+
+
+def start_request():
+    c.batch_loader = BatchLoader()
+
+
+def finish_request():
+    loader = get_loader()
+    if not loader:
+        return
+
+    if loader.batches:
+        g.stats.simple_event("batch_loader.batches", delta=loader.batches)
+        g.stats.simple_event("batch_loader.round_trips_saved",
+                             delta=loader.round_trips_saved)
+        g.log.debug("batch loader: %s", loader.report())
+    c.batch_loader = None
@@ -0,0 +1,188 @@
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of
+# the Original Code is reddit Inc.
+#
+# All portions of the code written by reddit are Copyright (c) 2006-2016 reddit
+# Inc. All Rights Reserved.
+"""Write-behind buffering of Thing._incr.
+
+Every _incr is an UPDATE of the thing's row, so a popular link's
+num_comments or a busy user's karma has many processes queueing on the
+same row lock. Props a Thing class lists in _buffered_incr_props (or that
+end with its _buffered_incr_suffix) are instead added to a per-process
+buffer and written every incr_buffer_window seconds as one UPDATE per
+(type, thing, prop). _incr still updates the cached thing right away.
+
+A process that dies without flushing loses at most one window of buffered
+increments. Until then the database is behind the cache, which only
+matters if the thing falls out of the cache: when a thing is buffered a
+marker is set in its cache for pending_ttl() seconds, and a copy loaded
+from the database while the marker is there is only cached until then, so
+it's reloaded once the increments have been written.
+
+"""
+
+from collections import defaultdict
+import atexit
+import math
+import threading
+import time
+
+from pylons import app_globals as g
+from pylons import tmpl_context as c
+from pylons.util import AttribSafeContextObj
+
+from r2.lib.db import tdb_sql as tdb
+
+
+class IncrBuffer(object):
+    def __init__(self, window, write_fn):
+        self.window = window
+        self.write_fn = write_fn
+        # (type_id, thing_id, prop, is_base_prop) -> amount
+        self.pending = defaultdict(int)
+        self.increments = 0
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.thread = None
+
+    def add(self, key, amount):
+        """Buffer an increment, returning whether key is newly pending."""
+        with self.lock:
+            new = key not in self.pending
+            self.pending[key] += amount
+            self.increments += 1
+        return new
+
+    def take(self):
+        with self.lock:
+            pending, self.pending = self.pending, defaultdict(int)
+            increments, self.increments = self.increments, 0
+        return pending, increments
+
+    def flush(self):
+        """Write everything buffered, one update per key.
+
+        Keys that fail to write are put back to be retried by the next
+        flush.
+
+        """
+
+        with self.flush_lock:
+            pending, increments = self.take()
+            written = 0
+            for key, amount in pending.iteritems():
+                if not amount:
+                    continue
+
+                try:
+                    self.write_fn(key, amount)
+                except Exception:
+                    g.log.exception("incr_buffer: failed to write %r", key)
+                    self.add(key, amount)
+                else:
+                    written += 1
+
+        if increments:
+            g.stats.simple_event("incr_buffer.increments", delta=increments)
+            g.stats.simple_event("incr_buffer.updates", delta=written)
+        return written
+
+    def start(self, thread_setup=None):
+        """Flush every window seconds from a daemon thread."""
+        def run():
+            if thread_setup:
+                thread_setup()
+            while True:
+                time.sleep(self.window)
+                try:
+                    self.flush()
+                except Exception:
+                    g.log.exception("incr_buffer: flush failed")
+
+        self.thread = threading.Thread(target=run, name="incr_buffer")
+        self.thread.daemon = True
+        self.thread.start()
+
+
+def write_incr(key, amount):
+    type_id, thing_id, prop, is_base_prop = key
+    tdb.transactions.begin()
+    try:
+        if is_base_prop:
+            tdb.incr_thing_prop(type_id, thing_id, prop, amount)
+        else:
+            tdb.incr_thing_data(type_id, thing_id, prop, amount)
+    except:
+        tdb.transactions.rollback()
+        raise
+    else:
+        tdb.transactions.commit()
+
+
+def pending_ttl():
+    """How long buffered increments may take to reach the database."""
+    # one window until the flush and another for it to finish or retry
+    return int(math.ceil(2 * g.incr_buffer_window)) + 1
+
+
+_buffer = None
+_buffer_lock = threading.Lock()
+
+
+def get_buffer():
+    """Return this process's IncrBuffer, starting it if necessary.
+
+    Returns None if incr_buffer_window isn't set.
+
+    """
+
+    global _buffer
+
+    if not g.incr_buffer_window:
+        return None
+
+    if _buffer is None:
+        with _buffer_lock:
+            if _buffer is None:
+                _buffer = _make_buffer()
+    return _buffer
+
+
+def _make_buffer():
+    from r2.lib.app_globals import SHUTDOWN_CALLBACKS
+
+    buf = IncrBuffer(g.incr_buffer_window, write_incr)
+    app_globals = g._current_obj()
+
+    def push_context():
+        # tdb_sql expects the pylons globals a request would have
+        g._push_object(app_globals)
+        c._push_object(AttribSafeContextObj())
+
+    def flush_on_exit():
+        push_context()
+        try:
+            buf.flush()
+        finally:
+            c._pop_object()
+            g._pop_object()
+
+    buf.start(thread_setup=push_context)
+    SHUTDOWN_CALLBACKS.append(flush_on_exit)
+    atexit.register(flush_on_exit)
+    return buf
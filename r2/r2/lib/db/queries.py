@@ -28,6 +28,7 @@ from functools import partial
 import hashlib
 import itertools
 import pytz
+import time
 from time import mktime
 
 from pylons import app_globals as g
@@ -69,6 +70,7 @@ from r2.models.query_cache import (
     CachedQueryMutator,
     filter_thing,
     FakeQuery,
+    merge_sorted,
     merged_cached_query,
     MergedCachedQuery,
     SubredditQueryCache,
@@ -115,6 +117,11 @@ def filter_thing2(x):
 class CachedResults(object):
     """Given a query returns a list-like object that will lazily look up
     the query from the persistent cache. """
+
+    # a gencache key to stamp whenever the results change, so things built
+    # from them can tell when they're out of date
+    version_key = None
+
     def __init__(self, query, filter):
         self.query = query
         self.query._limit = precompute_limit
@@ -213,6 +220,11 @@ class CachedResults(object):
             willread=willread,
         )
         self._fetched=True
+        self._touch()
+
+    def _touch(self):
+        if self.version_key:
+            g.gencache.set(self.version_key, time.time())
 
     def insert(self, items):
         """Inserts the item into the cached data. This only works
@@ -277,6 +289,7 @@ class CachedResults(object):
             self._fetched = True
             self.data = tuples
             g.permacache.pessimistically_set(self.iden, tuples)
+            self._touch()
 
     def update(self):
         """Runs the query and stores the result in the cache. This is
@@ -296,7 +309,10 @@ class CachedResults(object):
 
 class MergedCachedResults(object):
     """Given two CachedResults, merges their lists based on the sorts
-       of their queries."""
+       of their queries.
+
+       Each list is already sorted, so they're merged lazily as they're
+       read rather than sorted together."""
     # normally we'd do this by having a superclass of CachedResults,
     # but we have legacy pickled CachedResults that we don't want to
     # break
@@ -305,28 +321,38 @@ class MergedCachedResults(object):
         self.cached_results = results
         CachedResults.fetch_multi([r for r in results
                                    if isinstance(r, CachedResults)])
-        CachedQuery._fetch_multi([r for r in results
-                                   if isinstance(r, CachedQuery)])
+        cached_queries = [r for r in results if isinstance(r, CachedQuery)]
+        CachedQuery._fetch_multi(cached_queries)
+        for q in cached_queries:
+            if not q._sorted:
+                q._sort_data()
+                q._sorted = True
         self._fetched = True
 
         self.sort = results[0].sort
-        comparator = ThingTupleComparator(self.sort)
         # make sure they're all the same
         assert all(r.sort == self.sort for r in results[1:])
 
-        all_items = []
-        for cr in results:
-            all_items.extend(cr.data)
-        all_items.sort(cmp=comparator)
-        self.data = all_items
-
+    @property
+    def data(self):
+        return list(merge_sorted([r.data for r in self.cached_results],
+                                 ThingTupleComparator(self.sort)))
 
     def __repr__(self):
         return '<MergedCachedResults %r>' % (self.cached_results,)
 
+    def iter_after(self, after=None, reverse=False):
+        """Return an iterator of the fullnames after `after`."""
+        merged = merge_sorted(
+            lists=[r.data for r in self.cached_results],
+            comparator=ThingTupleComparator(self.sort),
+            after=after,
+            reverse=reverse,
+        )
+        return (x[0] for x in merged)
+
     def __iter__(self):
-        for x in self.data:
-            yield x[0]
+        return self.iter_after()
 
     def update(self):
         for x in self.cached_results:
@@ -394,8 +420,16 @@ def _get_links(sr_id, sort, time):
 
     res = make_results(q)
 
+    # normalized_hot keeps merged hot listings up to date with these
+    if sort == 'hot' and time == 'all':
+        res.version_key = hot_links_version_key(sr_id)
+
     return res
 
+
+def hot_links_version_key(sr_id):
+    return "hot_links_version_%s" % sr_id
+
 @cached_query(SubredditQueryCache)
 def get_spam_links(sr_id):
     return Link._query(Link.c.sr_id == sr_id,
@@ -1022,6 +1056,101 @@ def add_queries(queries, insert_items=None, delete_items=None):
             for query in new_queries:
                 m.delete(query, tup(delete_items))
 
+
+class CoalescingQueryMutator(object):
+    """Buffer add_queries updates across queue batches and write them at once.
+
+    Updates are collected per query for g.query_queue_coalesce_window seconds
+    and an item updated several times in that window is only written as it
+    was last given, so a listing that's updated on every vote while a link is
+    popular gets one write per window.
+
+    This is meant for queue consumers run with handle_items(ack=False): call
+    flush_if_due(chan) at the end of each batch of messages and pass flush as
+    the idle_fn. The messages are acked once their updates are written.
+    The writes are timed as `timer`, query_coalescer.<name>.flush by default.
+
+    """
+
+    def __init__(self, name, window=None, timer=None):
+        self.name = name
+        if window is None:
+            window = g.query_queue_coalesce_window
+        self.window = window
+        self.timer = timer or "query_coalescer.%s.flush" % name
+        self.started = None
+        self.unacked = False
+        self.queries = {}
+        self.updates = collections.defaultdict(collections.OrderedDict)
+        self.requested = 0
+
+    def add_queries(self, queries, insert_items=None, delete_items=None):
+        """Buffer an add_queries call."""
+        if self.started is None:
+            self.started = time.time()
+
+        for q in queries:
+            if insert_items and q.can_insert():
+                items, insert = tup(insert_items), True
+            elif delete_items and q.can_delete():
+                items, insert = tup(delete_items), False
+            else:
+                raise Exception("Cannot update query %r!" % (q,))
+
+            self.queries[q.iden] = q
+            updates = self.updates[q.iden]
+            for item in items:
+                updates[q.filter(item)._fullname] = (item, insert)
+            self.requested += len(items)
+
+    def flush_if_due(self, chan):
+        """Write the buffered updates if the window has passed."""
+        self.unacked = True
+        if self.started is None or time.time() - self.started >= self.window:
+            self.flush(chan)
+
+    def flush(self, chan):
+        """Write the buffered updates and ack the messages they came from."""
+        if self.updates:
+            with g.stats.get_timer(self.timer):
+                written = self._write()
+
+            g.stats.simple_event("query_coalescer.%s.requested" % self.name,
+                                 delta=self.requested)
+            g.stats.simple_event("query_coalescer.%s.written" % self.name,
+                                 delta=written)
+
+        if self.unacked:
+            chan.basic_ack(0, multiple=True)
+
+        self.started = None
+        self.unacked = False
+        self.queries = {}
+        self.updates.clear()
+        self.requested = 0
+
+    def _write(self):
+        written = 0
+        with CachedQueryMutator() as m:
+            for iden, updates in self.updates.iteritems():
+                q = self.queries[iden]
+                new_query = getattr(q, "new_query", None)
+                inserts = [item for item, insert in updates.itervalues()
+                           if insert]
+                deletes = [item for item, insert in updates.itervalues()
+                           if not insert]
+
+                if inserts:
+                    q.insert(inserts)
+                    if new_query:
+                        m.insert(new_query, inserts)
+                if deletes:
+                    q.delete(deletes)
+                    if new_query:
+                        m.delete(new_query, deletes)
+                written += len(updates)
+        return written
+
 #can be rewritten to be more efficient
 def all_queries(fn, obj, *param_lists):
     """Given a fn and a first argument 'obj', calls the fn(obj, *params)
@@ -1779,12 +1908,10 @@ def get_stored_votes(user, things):
     results = {}
     things_by_type = _by_type(things)
 
-    for thing_class, items in things_by_type.iteritems():
-        if not thing_class.is_votable:
-            continue
-
-        rel_class = VotesByAccount.rel(thing_class)
-        votes = rel_class.fast_query(user, items)
+    queries = [(VotesByAccount.rel(thing_class), user, items)
+               for thing_class, items in things_by_type.iteritems()
+               if thing_class.is_votable]
+    for votes in tdb_cassandra.DenormalizedRelation.fast_query_multi(queries):
         for cross, direction in votes.iteritems():
             results[cross] = Vote.deserialize_direction(int(direction))
 
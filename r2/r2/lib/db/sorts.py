@@ -22,3 +22,5 @@
 
 from r2.lib.db._sorts import epoch_seconds, score, hot, _hot
 from r2.lib.db._sorts import controversy, confidence, qa
+from r2.lib.db._sorts import batch_score, batch_hot, batch_controversy
+from r2.lib.db._sorts import batch_confidence, batch_qa
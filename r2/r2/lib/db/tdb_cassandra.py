@@ -23,6 +23,8 @@
 import json
 import inspect
 import pytz
+import threading
+import time
 from datetime import datetime
 
 from pylons import app_globals as g
@@ -41,10 +43,13 @@ from pycassa.system_manager import (
 )
 from pycassa.types import DateType
 from pycassa.util import convert_uuid_to_time
+from r2.lib.access_ledger import get_ledger
+from r2.lib.db.batch_loader import get_loader
 from r2.lib.utils import tup, Storage
 from r2.lib.sgm import sgm
 from uuid import uuid1, UUID
 from itertools import chain
+from multiprocessing import TimeoutError
 import cPickle as pickle
 from pycassa.util import OrderedDict
 import base64
@@ -64,8 +69,6 @@ db_create_tables = g.db_create_tables
 
 thing_types = {}
 
-TRANSIENT_EXCEPTIONS = (MaximumRetryException,)
-
 # The available consistency levels
 CL = Storage(ANY    = ConsistencyLevel.ANY,
              ONE    = ConsistencyLevel.ONE,
@@ -104,6 +107,13 @@ class NotFound(CassandraException, NotFoundException):
        all. This is probably an end-user's fault."""
     pass
 
+class ReadTimeout(CassandraException):
+    """A concurrent read took longer than its column family's
+       _read_timeout."""
+    pass
+
+TRANSIENT_EXCEPTIONS = (MaximumRetryException, ReadTimeout)
+
 def will_write(fn):
     """Decorator to indicate that a given function intends to write
        out to Cassandra"""
@@ -269,6 +279,10 @@ class ThingBase(object):
     # the columns in a row when there are more than the per-call maximum.
     _fetch_all_columns = False
 
+    # seconds that multiget waits for this column family when it's read
+    # alongside others; None means g.cassandra_read_timeout
+    _read_timeout = None
+
     # request-local cache to avoid duplicate lookups from hitting C*
     _local_cache = g.cassandra_local_cache
 
@@ -296,6 +310,21 @@ class ThingBase(object):
         if not self._use_db:
             raise TdbException("Cannot make instances of %r" % (self.__class__,))
 
+    @classmethod
+    def _prefetch(cls, ids):
+        """Register ids to be fetched by the next _byID of this type.
+
+        Only has an effect within a request (see r2.lib.db.batch_loader).
+
+        """
+        loader = get_loader()
+        if loader:
+            loader.prefetch(cls, tup(ids))
+
+    @classmethod
+    def _load_prefetched(cls, ids):
+        return cls._byID(ids, return_dict=True)
+
     @classmethod
     def _byID(cls, ids, return_dict=True, properties=None):
         ids, is_single = tup(ids, True)
@@ -312,6 +341,16 @@ class ThingBase(object):
         # all keys must be strings or directly convertable to strings
         assert all(isinstance(_id, basestring) or str(_id) for _id in ids)
 
+        # fetch anything registered with _prefetch along with these, unless
+        # we're only after some of their properties
+        loader = get_loader() if properties is None else None
+        if loader:
+            # what was fetched in a batch is in the local cache already
+            loader.claim(cls, ids)
+            prefetch_ids = loader.take(cls, exclude=ids)
+        else:
+            prefetch_ids = []
+
         def reject_bad_partials(cached, still_need):
             # tell sgm that the match it found in the cache isn't good
             # enough if it's a partial that doesn't include our
@@ -342,22 +381,14 @@ class ThingBase(object):
                 still_need.add(k)
 
         def lookup(l_ids):
+            ledger = get_ledger()
+            if ledger:
+                ledger.record("cassandra", cls.__name__, l_ids)
+
             if properties is None:
-                rows = cls._cf.multiget(l_ids, column_count=max_column_count)
-
-                # if we got max_column_count columns back for a row, it was
-                # probably clipped. in this case, we should fetch the remaining
-                # columns for that row and add them to the result.
-                if cls._fetch_all_columns:
-                    for key, row in rows.iteritems():
-                        if len(row) == max_column_count:
-                            last_column_seen = next(reversed(row))
-                            cols = cls._cf.xget(key,
-                                                column_start=last_column_seen,
-                                                buffer_size=max_column_count)
-                            row.update(cols)
+                rows = _read_rows(cls, l_ids)
             else:
-                rows = cls._cf.multiget(l_ids, columns = willask_properties)
+                rows = _read_rows(cls, l_ids, willask_properties)
 
             l_ret = {}
             for t_id, row in rows.iteritems():
@@ -371,11 +402,14 @@ class ThingBase(object):
 
         ret = sgm(
             cache=cls._local_cache,
-            keys=ids,
+            keys=list(ids) + prefetch_ids if prefetch_ids else ids,
             miss_fn=lookup,
             prefix=cls._cache_prefix(),
             found_fn=reject_bad_partials,
         )
+        if prefetch_ids:
+            loader.store(cls, {_id: ret.pop(_id)
+                               for _id in prefetch_ids if _id in ret})
 
         if is_single and not ret:
             raise NotFound("<%s %r>" % (cls.__name__,
@@ -841,6 +875,179 @@ def view_of(cls):
     return view_of_decorator
 
 
+def _read_rows(cls, keys, columns=None):
+    """Read some rows of cls's column family, all columns unless given."""
+    if columns is not None:
+        return cls._cf.multiget(keys, columns=columns)
+
+    rows = cls._cf.multiget(keys, column_count=max_column_count)
+
+    # if we got max_column_count columns back for a row, it was
+    # probably clipped. in this case, we should fetch the remaining
+    # columns for that row and add them to the result.
+    if getattr(cls, "_fetch_all_columns", False):
+        for key, row in rows.iteritems():
+            if len(row) == max_column_count:
+                last_column_seen = next(reversed(row))
+                cols = cls._cf.xget(key,
+                                    column_start=last_column_seen,
+                                    buffer_size=max_column_count)
+                row.update(cols)
+    return rows
+
+
+def _read_timeout(cls):
+    timeout = cls._read_timeout
+    if timeout is None:
+        timeout = g.cassandra_read_timeout
+    return timeout or None
+
+
+class _ReadsInFlight(object):
+    """Count the reads on the fetcher's pool that haven't finished yet.
+
+    pycassa can't cancel a request, so a read multiget stops waiting for
+    keeps its pool thread until Cassandra answers. A slow node can tie up
+    the whole pool that way, so multiget won't queue more reads than there
+    are free threads.
+
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.count = 0
+
+    def reserve(self, n, limit):
+        with self.lock:
+            if self.count + n > limit:
+                return False
+            self.count += n
+            return True
+
+    def release(self):
+        with self.lock:
+            self.count -= 1
+
+_reads_in_flight = _ReadsInFlight()
+
+
+def _pooled_read_rows(cls, keys, columns):
+    try:
+        return _read_rows(cls, keys, columns)
+    finally:
+        _reads_in_flight.release()
+
+
+def multiget(requests, return_exceptions=False):
+    """Read rows from several column families at once.
+
+    `requests` is a list of (cls, keys, columns), with columns None to read
+    whole rows. Returns a list of {key: {column: value}} in the same order.
+    With `return_exceptions` a read that fails with one of
+    TRANSIENT_EXCEPTIONS has the exception in its place in the list instead
+    of failing the others.
+
+    With g.cassandra_fetcher the reads run concurrently on its pool and each
+    is waited on for at most its class's _read_timeout before ReadTimeout is
+    raised. Otherwise, or if the pool doesn't have a free thread for each
+    read, they are made one after the other.
+
+    """
+
+    ledger = get_ledger()
+    if ledger:
+        for cls, keys, columns in requests:
+            if columns is None:
+                ledger.record("cassandra", cls.__name__, keys)
+            else:
+                ledger.record("cassandra", cls.__name__,
+                              [(key, tuple(columns)) for key in keys])
+
+    fetcher = g.cassandra_fetcher
+    if fetcher and len(requests) > 1:
+        if _reads_in_flight.reserve(len(requests), fetcher.pool_size):
+            return _multiget_pooled(fetcher, requests, return_exceptions)
+        g.stats.simple_event("cassandra.multiget.pool_busy")
+
+    results = []
+    for request in requests:
+        try:
+            results.append(_read_rows(*request))
+        except TRANSIENT_EXCEPTIONS as e:
+            if not return_exceptions:
+                raise
+            results.append(e)
+    return results
+
+
+def _multiget_pooled(fetcher, requests, return_exceptions):
+    start = time.time()
+    pending = [fetcher.pool.apply_async(_pooled_read_rows, request)
+               for request in requests]
+
+    results = []
+    for (cls, keys, columns), async_result in zip(requests, pending):
+        timeout = _read_timeout(cls)
+        if timeout:
+            timeout = max(start + timeout - time.time(), 0)
+
+        try:
+            try:
+                results.append(async_result.get(timeout))
+            except TimeoutError:
+                # the read carries on in the pool but nobody waits for it
+                g.stats.simple_event("cassandra.read_timeout." + cls.__name__)
+                raise ReadTimeout("<%s %r>" % (cls.__name__, keys))
+        except TRANSIENT_EXCEPTIONS as e:
+            if not return_exceptions:
+                raise
+            results.append(e)
+    return results
+
+
+def byID_multi(requests):
+    """Look up things of several classes, reading misses concurrently.
+
+    `requests` is a list of (cls, ids). Returns a list of {id: thing} in the
+    same order, as from cls._byID(ids, return_dict=True) for each. The
+    request-local cache is read once for all of them and the things read
+    from Cassandra are added to it with one set_multi, so later _byID calls
+    in the request find them there.
+
+    """
+
+    cache = g.cassandra_local_cache
+    found = []
+    reads = []
+    read_into = []
+    for cls, ids in requests:
+        cached = cache.get_multi([str(_id) for _id in ids],
+                                 prefix=cls._cache_prefix())
+        # partials don't have every property _byID callers expect
+        by_id = {}
+        for _id in ids:
+            t = cached.get(str(_id))
+            if t is not None and t._partial is None:
+                by_id[_id] = t
+        found.append(by_id)
+
+        missing = [_id for _id in ids if _id not in by_id]
+        if missing:
+            reads.append((cls, missing, None))
+            read_into.append(by_id)
+
+    to_cache = {}
+    for (cls, keys, columns), rows, by_id in zip(reads, multiget(reads),
+                                                 read_into):
+        for t_id, row in rows.iteritems():
+            t = cls._from_serialized_columns(t_id, row)
+            by_id[t._id] = t
+            to_cache[t._cache_key()] = t
+
+    if to_cache:
+        cache.set_multi(to_cache)
+    return found
+
 
 class DenormalizedRelation(object):
     """A model of many-to-many relationships, indexed by thing1.
@@ -866,6 +1073,7 @@ class DenormalizedRelation(object):
     _extra_schema_creation_args = dict(key_validation_class=ASCII_TYPE,
                                        default_validation_class=UTF8_TYPE)
     _ttl = None
+    _read_timeout = None
 
     @classmethod
     def value_for(cls, thing1, thing2, **kw):
@@ -907,12 +1115,9 @@ class DenormalizedRelation(object):
             view.destroy(thing1, thing2s)
 
     @classmethod
-    def fast_query(cls, thing1, thing2s):
-        """Find relationships between thing1 and various thing2s."""
-        thing2s, thing2s_is_single = tup(thing2s, ret_is_single=True)
-
+    def _fast_query_thing2s(cls, thing1, thing2s):
         if not thing1:
-            return {}
+            return []
 
         # don't bother looking up relationships for items that were created
         # since the last time the thing1 created a relationship of this type
@@ -926,6 +1131,14 @@ class DenormalizedRelation(object):
             else:
                 thing2s = []
 
+        return thing2s
+
+    @classmethod
+    def fast_query(cls, thing1, thing2s):
+        """Find relationships between thing1 and various thing2s."""
+        thing2s, thing2s_is_single = tup(thing2s, ret_is_single=True)
+        thing2s = cls._fast_query_thing2s(thing1, thing2s)
+
         if not thing2s:
             return {}
 
@@ -933,6 +1146,10 @@ class DenormalizedRelation(object):
         # relation of this type to any thing2!
         try:
             columns = [thing2._id36 for thing2 in thing2s]
+            ledger = get_ledger()
+            if ledger:
+                ledger.record("cassandra", cls.__name__,
+                              [(thing1._id36, tuple(columns))])
             results = cls._cf.get(thing1._id36, columns)
         except NotFoundException:
             results = {}
@@ -949,7 +1166,59 @@ class DenormalizedRelation(object):
                 return results.values()[0]
             else:
                 raise NotFound("<%s %r>" % (cls.__name__, (thing1._id36,
-                                                           thing2._id36)))
+                                                           thing2s[0]._id36)))
+
+    @staticmethod
+    def fast_query_multi(queries, return_exceptions=False):
+        """Run several fast_querys, reading their rows concurrently.
+
+        `queries` is a list of (cls, thing1, thing2s). Returns a list of
+        {(thing1, thing2): value} in the same order. Like fast_query the
+        rows are always read from Cassandra. See multiget for
+        `return_exceptions`.
+
+        """
+
+        reads = []
+        thing2s_by_read = []
+        for cls, thing1, thing2s in queries:
+            try:
+                thing2s = cls._fast_query_thing2s(thing1, tup(thing2s))
+            except TRANSIENT_EXCEPTIONS as e:
+                if not return_exceptions:
+                    raise
+                reads.append(None)
+                thing2s_by_read.append(e)
+                continue
+
+            if thing2s:
+                columns = [thing2._id36 for thing2 in thing2s]
+                reads.append((cls, [thing1._id36], columns))
+                thing2s_by_read.append(thing2s)
+            else:
+                reads.append(None)
+                thing2s_by_read.append(None)
+
+        rows = iter(multiget(filter(None, reads), return_exceptions))
+        results = []
+        for (cls, thing1, _), read, thing2s in zip(queries, reads,
+                                                   thing2s_by_read):
+            if read is None:
+                # nothing to read, or finding what to read failed
+                results.append(thing2s or {})
+                continue
+
+            read_rows = next(rows)
+            if isinstance(read_rows, Exception):
+                results.append(read_rows)
+                continue
+
+            # a missing row means thing1 has no relation of this type at all
+            columns = read_rows.get(thing1._id36, {})
+            thing2s_by_id = {thing2._id36: thing2 for thing2 in thing2s}
+            results.append({(thing1, thing2s_by_id[k]): v
+                            for k, v in columns.iteritems()})
+        return results
 
 
 class ColumnQuery(object):
@@ -20,7 +20,8 @@
 # Inc. All Rights Reserved.
 ###############################################################################
 
-from copy import deepcopy
+from collections import OrderedDict
+from copy import copy, deepcopy
 from datetime import datetime
 import cPickle as pickle
 import logging
@@ -35,6 +36,8 @@ from pylons import app_globals as g
 import sqlalchemy as sa
 
 from r2.lib import filters
+from r2.lib.access_ledger import get_ledger
+from r2.lib.db import write_tokens
 from r2.lib.utils import (
     iters,
     Results,
@@ -48,6 +51,8 @@ dbm = g.dbm
 predefined_type_ids = g.predefined_type_ids
 log_format = logging.Formatter('sql: %(message)s')
 max_val_len = 1000
+# rows per statement in bulk inserts
+BULK_INSERT_ROWS = 1000
 
 
 class TransactionSet(threading.local):
@@ -219,6 +224,14 @@ def get_data_table(metadata, name):
                           sa.Column('kind', sa.String))
     return data_table
 
+def get_document_table(metadata, name):
+    document_table = sa.Table(g.db_app_name + '_doc_' + name, metadata,
+                              sa.Column('thing_id', sa.BigInteger,
+                                        primary_key = True),
+                              sa.Column('data', sa.LargeBinary,
+                                        nullable = False))
+    return document_table
+
 def get_rel_table(metadata, name):
     rel_table = sa.Table(g.db_app_name + '_rel_' + name, metadata,
                          sa.Column('rel_id', sa.BigInteger, primary_key = True),
@@ -255,6 +268,11 @@ rel_types_name = {}
 class ConfigurationError(Exception):
     pass
 
+# modes for keeping a thing type's data props in a document table as well
+# as the data table. "write" keeps the documents up to date, "read" also
+# loads data props from them. data queries always use the data table.
+DATA_DOCUMENT_MODES = (None, "write", "read")
+
 def check_type(table, name, insert_vals):
     # before hitting the db, check if we can get the type id from
     # the ini file
@@ -281,6 +299,11 @@ def build_thing_tables():
                              name,
                              dict(name = name))
 
+        data_documents = dbm.data_documents.get(name)
+        if data_documents not in DATA_DOCUMENT_MODES:
+            raise ConfigurationError("Unknown data_documents mode %r for %s" %
+                                     (data_documents, name))
+
         tables = []
         for engine in engines:
             metadata = make_metadata(engine)
@@ -295,11 +318,19 @@ def build_thing_tables():
             create_table(data_table,
                          index_commands(data_table, 'data'))
 
-            tables.append((thing_table, data_table))
+            #make document table
+            if data_documents:
+                document_table = get_document_table(metadata, name)
+                create_table(document_table)
+            else:
+                document_table = None
+
+            tables.append((thing_table, data_table, document_table))
 
         thing = storage(type_id = type_id,
                         name = name,
                         avoid_master_reads = dbm.avoid_master_reads.get(name),
+                        data_documents = data_documents,
                         tables = tables)
 
         types_id[type_id] = thing
@@ -359,7 +390,8 @@ def get_write_table(tables):
     else:
         return tables[0]
 
-def add_request_info(select):
+def request_comment():
+    """Return an SQL comment identifying the current request, if any."""
     def sanitize(txt):
         return "".join(x if x.isalnum() else "."
                        for x in filters._force_utf8(txt))
@@ -369,14 +401,24 @@ def add_request_info(select):
         if (hasattr(request, 'path') and
             hasattr(request, 'ip') and
             hasattr(request, 'user_agent')):
-            comment = '/*\n%s\n%s\n%s\n*/' % (
+            return '/*\n%s\n%s\n%s\n*/' % (
                 tb or "", 
                 sanitize(request.fullpath),
                 sanitize(request.ip))
-            return select.prefix_with(comment)
     except UnicodeDecodeError:
         pass
 
+    return None
+
+def add_request_info(select):
+    ledger = get_ledger()
+    if ledger:
+        compiled = select.compile()
+        ledger.record_query(str(compiled), compiled.params)
+
+    comment = request_comment()
+    if comment:
+        return select.prefix_with(comment)
     return select
 
 
@@ -387,6 +429,7 @@ def get_table(kind, action, tables, avoid_master_reads = False):
         if not isinstance(c.use_write_db, dict):
             c.use_write_db = {}
         c.use_write_db[kind] = True
+        write_tokens.record_write(kind)
 
         return get_write_table(tables)
     elif action == 'read':
@@ -394,9 +437,12 @@ def get_table(kind, action, tables, avoid_master_reads = False):
         if c.use_write_db and c.use_write_db.has_key(kind):
             return get_write_table(tables)
         else:
+            #or if the user wrote to it in a recent request
+            last_write = write_tokens.last_write(kind)
             if avoid_master_reads and len(tables) > 1:
-                return dbm.get_read_table(tables[1:])
-            return dbm.get_read_table(tables)
+                return dbm.get_read_table(tables[1:], master=tables[0],
+                                          last_write=last_write)
+            return dbm.get_read_table(tables, last_write=last_write)
 
 
 def get_thing_table(type_id, action = 'read' ):
@@ -442,6 +488,44 @@ def make_thing(type_id, ups, downs, date, deleted, spam, id=None):
         raise CreationError, "Thing exists (%s)" % str(params)
 
 
+def allocate_thing_ids(table, count):
+    """Reserve count ids from the sequence of a thing table in one query."""
+    q = sa.text("SELECT nextval(pg_get_serial_sequence(:table, 'thing_id')) "
+                "FROM generate_series(1, :count)")
+    r = table.bind.execute(q, table=table.name, count=count)
+    return [row[0] for row in r]
+
+
+def insert_rows(table, rows):
+    """Insert rows with as few multi-row INSERT statements as possible."""
+    transactions.add_engine(table.bind)
+    for i in xrange(0, len(rows), BULK_INSERT_ROWS):
+        table.insert().values(rows[i:i + BULK_INSERT_ROWS]).execute()
+
+
+def make_things(type_id, things):
+    """Create many things at once and return their new ids, in order.
+
+    things is a list of dicts of ups, downs, date, deleted and spam.
+
+    """
+
+    if not things:
+        return []
+
+    table = get_thing_table(type_id, action = 'write')[0]
+    ids = allocate_thing_ids(table, len(things))
+    rows = [dict(params, thing_id=_id) for _id, params in zip(ids, things)]
+    try:
+        insert_rows(table, rows)
+    except sa.exc.DBAPIError, e:
+        if not 'IntegrityError' in e.message:
+            raise
+        # wrap the error to prevent db layer bleeding out
+        raise CreationError, "Thing exists (%s)" % ids
+    return ids
+
+
 def set_thing_props(type_id, thing_id, **props):
     table = get_thing_table(type_id, action = 'write')[0]
 
@@ -571,6 +655,17 @@ def create_data(table, thing_id, **vals):
         i.execute(*inserts)
 
 
+def create_data_multi(table, vals_by_id):
+    rows = []
+    for thing_id, vals in vals_by_id.iteritems():
+        for key, val in vals.iteritems():
+            val, kind = py2db(val, return_kind=True)
+            rows.append(dict(thing_id=thing_id, key=key, value=val, kind=kind))
+
+    if rows:
+        insert_rows(table, rows)
+
+
 def incr_data_prop(table, type_id, thing_id, prop, amount):
     t = table
     transactions.add_engine(t.bind)
@@ -615,21 +710,97 @@ def get_data(table, thing_id):
 
     return res
 
+def dump_document(data):
+    """Serialize a thing's data props for the document table.
+
+    Strings are stored the way the data table hands them back so a thing
+    loads the same from either table.
+
+    """
+
+    doc = {}
+    for key, val in data.iteritems():
+        if isinstance(val, unicode):
+            val = val.encode('utf8')
+        doc[key] = val
+    return pickle.dumps(doc, pickle.HIGHEST_PROTOCOL)
+
+def load_document(doc):
+    return storage(pickle.loads(str(doc)))
+
+def write_document(table, thing_id, data):
+    transactions.add_engine(table.bind)
+
+    doc = dump_document(data)
+    u = table.update(table.c.thing_id == thing_id,
+                     values = {table.c.data: doc})
+    if not u.execute().rowcount:
+        table.insert().execute(thing_id = thing_id, data = doc)
+
+def sync_document(data_table, document_table, thing_id):
+    """Rewrite a thing's document from its rows in the data table."""
+    write_document(document_table, thing_id, get_data(data_table, thing_id))
+
+def get_document_data(data_table, document_table, thing_id):
+    """Load data props from the document table.
+
+    Things that don't have a document yet (because they haven't been
+    backfilled) are loaded from the data table.
+
+    """
+
+    r, single = fetch_query(document_table, document_table.c.thing_id,
+                            thing_id)
+    res = dict((row.thing_id, load_document(row.data)) for row in r)
+
+    thing_ids = (thing_id,) if single else thing_id
+    missing = [_id for _id in thing_ids if _id not in res]
+    if missing:
+        g.stats.simple_event('tdb_sql.document.miss', delta=len(missing))
+        res.update(get_data(data_table, missing))
+
+    if single:
+        return res.get(thing_id, storage())
+    return res
+
 def set_thing_data(type_id, thing_id, brand_new_thing, **vals):
-    table = get_thing_table(type_id, action = 'write')[1]
+    tables = get_thing_table(type_id, action = 'write')
+    table, document_table = tables[1], tables[2]
 
     if brand_new_thing:
-        return create_data(table, thing_id, **vals)
+        create_data(table, thing_id, **vals)
+        if document_table is not None:
+            write_document(document_table, thing_id, vals)
     else:
-        return update_data(table, thing_id, **vals)
+        update_data(table, thing_id, **vals)
+        if document_table is not None:
+            sync_document(table, document_table, thing_id)
+
+def create_things_data(type_id, vals_by_id):
+    """Write the data props of many brand new things at once."""
+    tables = get_thing_table(type_id, action = 'write')
+    table, document_table = tables[1], tables[2]
+
+    create_data_multi(table, vals_by_id)
+    if document_table is not None and vals_by_id:
+        insert_rows(document_table, [
+            dict(thing_id=thing_id, data=dump_document(vals))
+            for thing_id, vals in vals_by_id.iteritems()
+        ])
 
 def incr_thing_data(type_id, thing_id, prop, amount):
-    table = get_thing_table(type_id, action = 'write')[1]
-    return incr_data_prop(table, type_id, thing_id, prop, amount)    
+    tables = get_thing_table(type_id, action = 'write')
+    table, document_table = tables[1], tables[2]
+
+    incr_data_prop(table, type_id, thing_id, prop, amount)
+    if document_table is not None:
+        sync_document(table, document_table, thing_id)
 
 def get_thing_data(type_id, thing_id):
-    table = get_thing_table(type_id)[1]
-    return get_data(table, thing_id)
+    tables = get_thing_table(type_id)
+    if types_id[type_id].data_documents == "read":
+        return get_document_data(tables[1], tables[2], thing_id)
+    return get_data(tables[1], thing_id)
 
 def get_thing(type_id, thing_id):
     table = get_thing_table(type_id)[0]
@@ -802,38 +973,197 @@ def translate_thing_value(rval):
     else:
         return rval
 
-#will assume parameters start with a _ for consistency
-def find_things(type_id, sort, limit, offset, constraints):
-    table = get_thing_table(type_id)[0]
-    constraints = deepcopy(constraints)
+class StatementCache(object):
+    """An LRU cache of compiled selects keyed by the shape of the query.
 
-    s = sa.select([table.c.thing_id.label('thing_id')])
-    
+    Queries that differ only in the values they compare against share a
+    compiled statement, with the values passed as bind params.
+
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.statements = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            compiled = self.statements.pop(key, None)
+            if compiled is not None:
+                self.statements[key] = compiled
+            return compiled
+
+    def set(self, key, compiled):
+        if not self.max_size:
+            return
+
+        with self.lock:
+            self.statements.pop(key, None)
+            self.statements[key] = compiled
+            while len(self.statements) > self.max_size:
+                self.statements.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.statements.clear()
+
+statement_cache = StatementCache(g.sql_statement_cache_size)
+
+def lval_shape(lval):
+    funcs = []
+    while isinstance(lval, operators.query_func):
+        funcs.append(lval.__class__.__name__)
+        lval = lval.lval
+    return tuple(funcs)
+
+def rval_values(op, is_data):
+    """Return the values op compares against, as they're sent to the db.
+
+    Intervals and (for thing props) None are rendered into the statement
+    rather than bound, so they aren't values.
+
+    """
+
+    if isinstance(op.rval, operators.timeago):
+        return ()
+    vals = tup(op.rval)
+    if is_data(op):
+        return tuple(str(py2db(v)) for v in vals)
+    return tuple(v for v in vals if v is not None)
+
+def constraints_shape(constraints, is_data):
+    shape = []
+    for o in constraints:
+        if isinstance(o, operators.BooleanOp):
+            shape.append((o.__class__.__name__,
+                          constraints_shape(o.ops, is_data)))
+        elif isinstance(o.rval, operators.timeago):
+            shape.append((o.__class__.__name__, o.lval_name,
+                          lval_shape(o.lval), o.rval.interval))
+        else:
+            # the number of values, and which are None (rendered as NULL)
+            # for thing props
+            vals = tup(o.rval)
+            if is_data(o):
+                vals_shape = len(vals)
+            else:
+                vals_shape = tuple(v is None for v in vals)
+            shape.append((o.__class__.__name__, o.lval_name,
+                          lval_shape(o.lval), vals_shape))
+    return tuple(shape)
+
+def bind_constraints(constraints, is_data):
+    """Copy constraints, replacing their values with bind params.
+
+    Returns the copy and the params, named in the order of op_iter.
+
+    """
+
+    constraints = deepcopy(constraints)
+    params = {}
     for op in operators.op_iter(constraints):
-        #assume key starts with _
-        #if key.startswith('_'):
-        key = op.lval_name
-        op.lval = translate_sort(table, key[1:], op.lval)
-        op.rval = translate_thing_value(op.rval)
+        if isinstance(op.rval, operators.timeago):
+            continue
+
+        vals = tup(op.rval)
+        if is_data(op):
+            vals = [str(py2db(v)) for v in vals]
 
-    for op in constraints:
-        s.append_whereclause(sa_op(op))
+        bound = []
+        for v in vals:
+            if v is None:
+                bound.append(v)
+            else:
+                name = 'p%d' % len(params)
+                params[name] = v
+                bound.append(sa.bindparam(name))
+        op.rval = tuple(bound)
+    return constraints, params
 
-    if sort:
-        s, cols = add_sort(sort, {'_': table}, s)
+def sort_shape(sort):
+    if not sort:
+        return ()
+    return tuple((s.__class__.__name__, s.col) for s in tup(sort))
 
-    if limit:
-        s = s.limit(limit)
+def compile_select(key, engine, constraints, is_data, build):
+    """Return a compiled select and the params to execute it with.
+
+    key identifies everything about the query but its constraints.
+    build takes a copy of the constraints whose values are bind params
+    and returns the select, which is only called when the statement
+    cache doesn't already have it compiled.
+
+    """
 
-    if offset:
-        s = s.offset(offset)
+    key = key + (constraints_shape(constraints, is_data),)
+    compiled = statement_cache.get(key)
+    if compiled is not None:
+        g.stats.simple_event('tdb_sql.statement_cache.hit')
+        params = {}
+        for op in operators.op_iter(constraints):
+            for v in rval_values(op, is_data):
+                params['p%d' % len(params)] = v
+        return compiled, params
+
+    g.stats.simple_event('tdb_sql.statement_cache.miss')
+    bound, params = bind_constraints(constraints, is_data)
+    compiled = build(bound).compile(dialect=engine.dialect)
+    statement_cache.set(key, compiled)
+    return compiled, params
+
+def execute_compiled(engine, compiled, params, connection=None):
+    ledger = get_ledger()
+    if ledger:
+        ledger.record_query(compiled.string, compiled.construct_params(params))
+
+    comment = request_comment()
+    if comment:
+        compiled = copy(compiled)
+        compiled.string = comment + ' ' + compiled.string
 
     try:
-        r = add_request_info(s).execute()
+        return (connection or engine).execute(compiled, params)
     except Exception, e:
-        dbm.mark_dead(table.bind)
+        dbm.mark_dead(engine)
         # this thread must die so that others may live
         raise
+
+def prepare_things(type_id, sort, limit, offset, constraints):
+    table = get_thing_table(type_id)[0]
+
+    def build(constraints):
+        s = sa.select([table.c.thing_id.label('thing_id')])
+
+        for op in operators.op_iter(constraints):
+            #assume key starts with _
+            #if key.startswith('_'):
+            key = op.lval_name
+            op.lval = translate_sort(table, key[1:], op.lval)
+            op.rval = translate_thing_value(op.rval)
+
+        for op in constraints:
+            s.append_whereclause(sa_op(op))
+
+        if sort:
+            s, cols = add_sort(sort, {'_': table}, s)
+
+        if limit:
+            s = s.limit(limit)
+
+        if offset:
+            s = s.offset(offset)
+
+        return s
+
+    key = ('things', type_id, sort_shape(sort), limit, offset)
+    compiled, params = compile_select(
+        key, table.bind, constraints, lambda op: False, build)
+    return table.bind, compiled, params
+
+#will assume parameters start with a _ for consistency
+def find_things(type_id, sort, limit, offset, constraints):
+    r = execute_compiled(
+        *prepare_things(type_id, sort, limit, offset, constraints))
     return Results(r, lambda(row): row.thing_id)
 
 def translate_data_value(alias, op):
@@ -846,80 +1176,111 @@ def translate_data_value(alias, op):
         lval = sa.func.substring(lval, 1, max_val_len)
     
     op.lval = lval
-        
-    #convert the rval to db types
-    #convert everything to strings for pg8.3
-    op.rval = tuple(str(py2db(v)) for v in tup(op.rval))
+
+    #the rval has already been converted to db types (as strings, for pg8.3)
+    #by bind_constraints
+
+def stream_thing_ids(type_id, sort, constraints, batch_size, use_data=False):
+    """Yield lists of the ids of all the things matching constraints.
+
+    The query is run once, on a connection of its own, and its rows are
+    read batch_size at a time from a server-side cursor rather than all
+    at once or with a query per batch. The cursor is held until the
+    generator is exhausted or closed, so callers scanning big tables
+    should close it and re-open after the last row now and then (as
+    Things._stream does).
+
+    """
+
+    prepare = prepare_data if use_data else prepare_things
+    engine, compiled, params = prepare(type_id, sort, None, None, constraints)
+
+    conn = engine.connect()
+    try:
+        r = execute_compiled(engine, compiled, params,
+            connection=conn.execution_options(stream_results=True))
+        while True:
+            rows = r.fetchmany(batch_size)
+            if not rows:
+                break
+            yield [row.thing_id for row in rows]
+    finally:
+        conn.close()
+
+def is_data_op(op):
+    """Whether op constrains a data prop (rather than a thing or rel column)."""
+    return not op.lval_name.startswith('_')
 
 #TODO sort by data fields
 #TODO sort by id wants thing_id
-def find_data(type_id, sort, limit, offset, constraints):
-    t_table, d_table = get_thing_table(type_id)
-    constraints = deepcopy(constraints)
+def prepare_data(type_id, sort, limit, offset, constraints):
+    t_table, d_table = get_thing_table(type_id)[:2]
+
+    def build(constraints):
+        used_first = False
+        need_join = False
+        have_data_rule = False
+        first_alias = d_table.alias()
+        s = sa.select([first_alias.c.thing_id.label('thing_id')])#, distinct=True)
+
+        for op in operators.op_iter(constraints):
+            key = op.lval_name
+
+            if key == '_id':
+                op.lval = first_alias.c.thing_id
+            elif key.startswith('_'):
+                need_join = True
+                op.lval = translate_sort(t_table, key[1:], op.lval)
+                op.rval = translate_thing_value(op.rval)
+            else:
+                have_data_rule = True
+                id_col = None
+                if not used_first:
+                    alias = first_alias
+                    used_first = True
+                else:
+                    alias = d_table.alias()
+                    id_col = first_alias.c.thing_id
 
-    used_first = False
-    s = None
-    need_join = False
-    have_data_rule = False
-    first_alias = d_table.alias()
-    s = sa.select([first_alias.c.thing_id.label('thing_id')])#, distinct=True)
+                if id_col is not None:
+                    s.append_whereclause(id_col == alias.c.thing_id)
 
-    for op in operators.op_iter(constraints):
-        key = op.lval_name
-        vals = tup(op.rval)
+                s.append_column(alias.c.value.label(key))
+                s.append_whereclause(alias.c.key == key)
+
+                #add the substring constraint if no other functions are there
+                translate_data_value(alias, op)
+
+        for op in constraints:
+            s.append_whereclause(sa_op(op))
 
-        if key == '_id':
-            op.lval = first_alias.c.thing_id
-        elif key.startswith('_'):
+        if not have_data_rule:
+            raise Exception('Data queries must have at least one data rule.')
+
+        #TODO in order to sort by data columns, this is going to need to be smarter
+        if sort:
             need_join = True
-            op.lval = translate_sort(t_table, key[1:], op.lval)
-            op.rval = translate_thing_value(op.rval)
-        else:
-            have_data_rule = True
-            id_col = None
-            if not used_first:
-                alias = first_alias
-                used_first = True
-            else:
-                alias = d_table.alias()
-                id_col = first_alias.c.thing_id
-
-            if id_col is not None:
-                s.append_whereclause(id_col == alias.c.thing_id)
-            
-            s.append_column(alias.c.value.label(key))
-            s.append_whereclause(alias.c.key == key)
-            
-            #add the substring constraint if no other functions are there
-            translate_data_value(alias, op)
-
-    for op in constraints:
-        s.append_whereclause(sa_op(op))
-
-    if not have_data_rule:
-        raise Exception('Data queries must have at least one data rule.')
-
-    #TODO in order to sort by data columns, this is going to need to be smarter
-    if sort:
-        need_join = True
-        s, cols = add_sort(sort, {'_':t_table}, s)
-            
-    if need_join:
-        s.append_whereclause(first_alias.c.thing_id == t_table.c.thing_id)
+            s, cols = add_sort(sort, {'_':t_table}, s)
 
-    if limit:
-        s = s.limit(limit)
+        if need_join:
+            s.append_whereclause(first_alias.c.thing_id == t_table.c.thing_id)
 
-    if offset:
-        s = s.offset(offset)
+        if limit:
+            s = s.limit(limit)
 
-    try:
-        r = add_request_info(s).execute()
-    except Exception, e:
-        dbm.mark_dead(t_table.bind)
-        # this thread must die so that others may live
-        raise
+        if offset:
+            s = s.offset(offset)
+
+        return s
+
+    key = ('data', type_id, sort_shape(sort), limit, offset)
+    compiled, params = compile_select(
+        key, t_table.bind, constraints, is_data_op, build)
+    return t_table.bind, compiled, params
 
+def find_data(type_id, sort, limit, offset, constraints):
+    r = execute_compiled(
+        *prepare_data(type_id, sort, limit, offset, constraints))
     return Results(r, lambda(row): row.thing_id)
 
 
@@ -927,7 +1288,7 @@ def sort_thing_ids_by_data_value(type_id, thing_ids, value_name,
         limit=None, desc=False):
     """Order thing_ids by the value of a data column."""
 
-    thing_table, data_table = get_thing_table(type_id)
+    thing_table, data_table = get_thing_table(type_id)[:2]
 
     join = thing_table.join(data_table,
         data_table.c.thing_id == thing_table.c.thing_id)
@@ -957,103 +1318,114 @@ def sort_thing_ids_by_data_value(type_id, thing_ids, value_name,
     return Results(rows, lambda(row): row.thing_id)
 
 
-def find_rels(ret_props, rel_type_id, sort, limit, offset, constraints):
-    tables = get_rel_table(rel_type_id)
-    r_table, t1_table, t2_table, d_table = tables
-    constraints = deepcopy(constraints)
+def prepare_rels(ret_props, rel_type_id, sort, limit, offset, constraints,
+                 master=False):
+    if master:
+        tables = get_write_table(rel_types_id[rel_type_id].tables)
+    else:
+        tables = get_rel_table(rel_type_id)
+    r_table, d_table = tables[0], tables[3]
 
-    t1_table, t2_table = t1_table.alias(), t2_table.alias()
+    def build(constraints):
+        t1_table, t2_table = tables[1].alias(), tables[2].alias()
 
-    prop_to_column = {
-        "_rel_id": r_table.c.rel_id.label('rel_id'),
-        "_thing1_id": r_table.c.thing1_id.label('thing1_id'),
-        "_thing2_id": r_table.c.thing2_id.label('thing2_id'),
-        "_name": r_table.c.name.label('name'),
-        "_date": r_table.c.date.label('date'),
-    }
+        prop_to_column = {
+            "_rel_id": r_table.c.rel_id.label('rel_id'),
+            "_thing1_id": r_table.c.thing1_id.label('thing1_id'),
+            "_thing2_id": r_table.c.thing2_id.label('thing2_id'),
+            "_name": r_table.c.name.label('name'),
+            "_date": r_table.c.date.label('date'),
+        }
 
-    if not ret_props:
-        valid_props = ', '.join(prop_to_column.keys())
-        raise ValueError("ret_props must contain at least one of " + valid_props)
+        if not ret_props:
+            valid_props = ', '.join(prop_to_column.keys())
+            raise ValueError("ret_props must contain at least one of " + valid_props)
 
-    columns = []
-    for prop in ret_props:
-        if prop not in prop_to_column:
-            raise ValueError("ret_props got unrecognized %s" % prop)
+        columns = []
+        for prop in ret_props:
+            if prop not in prop_to_column:
+                raise ValueError("ret_props got unrecognized %s" % prop)
 
-        columns.append(prop_to_column[prop])
+            columns.append(prop_to_column[prop])
 
-    s = sa.select(columns)
-    need_join1 = ('thing1_id', t1_table)
-    need_join2 = ('thing2_id', t2_table)
-    joins_needed = set()
+        s = sa.select(columns)
+        need_join1 = ('thing1_id', t1_table)
+        need_join2 = ('thing2_id', t2_table)
+        joins_needed = set()
 
-    for op in operators.op_iter(constraints):
-        #vals = con.rval
-        key = op.lval_name
-        prefix = key[:4]
-        
-        if prefix in ('_t1_', '_t2_'):
-            #not a thing attribute
-            key = key[4:]
-
-            if prefix == '_t1_':
-                join = need_join1
-                joins_needed.add(join)
-            elif prefix == '_t2_':
-                join = need_join2
-                joins_needed.add(join)
-
-            table = join[1]
-            op.lval = translate_sort(table, key, op.lval)
-            op.rval = translate_thing_value(op.rval)
-            #ors = [sa_op(con, key, v) for v in vals]
-            #s.append_whereclause(sa.or_(*ors))
+        for op in operators.op_iter(constraints):
+            #vals = con.rval
+            key = op.lval_name
+            prefix = key[:4]
 
-        elif prefix.startswith('_'):
-            op.lval = r_table.c[key[1:]]
+            if prefix in ('_t1_', '_t2_'):
+                #not a thing attribute
+                key = key[4:]
 
-        else:
-            alias = d_table.alias()
-            s.append_whereclause(r_table.c.rel_id == alias.c.thing_id)
-            s.append_column(alias.c.value.label(key))
-            s.append_whereclause(alias.c.key == key)
+                if prefix == '_t1_':
+                    join = need_join1
+                    joins_needed.add(join)
+                elif prefix == '_t2_':
+                    join = need_join2
+                    joins_needed.add(join)
 
-            translate_data_value(alias, op)
+                table = join[1]
+                op.lval = translate_sort(table, key, op.lval)
+                op.rval = translate_thing_value(op.rval)
+                #ors = [sa_op(con, key, v) for v in vals]
+                #s.append_whereclause(sa.or_(*ors))
 
-    for op in constraints:
-        s.append_whereclause(sa_op(op))
+            elif prefix.startswith('_'):
+                op.lval = r_table.c[key[1:]]
 
-    if sort:
-        s, cols = add_sort(
-            sort=sort,
-            t_table={'_': r_table, '_t1_': t1_table, '_t2_': t2_table},
-            select=s,
-        )
+            else:
+                alias = d_table.alias()
+                s.append_whereclause(r_table.c.rel_id == alias.c.thing_id)
+                s.append_column(alias.c.value.label(key))
+                s.append_whereclause(alias.c.key == key)
 
-        #do we need more joins?
-        for (col, table) in cols:
-            if table == need_join1[1]:
-                joins_needed.add(need_join1)
-            elif table == need_join2[1]:
-                joins_needed.add(need_join2)
+                translate_data_value(alias, op)
 
-    for j in joins_needed:
-        col, table = j
-        s.append_whereclause(r_table.c[col] == table.c.thing_id)
+        for op in constraints:
+            s.append_whereclause(sa_op(op))
 
-    if limit:
-        s = s.limit(limit)
+        if sort:
+            s, cols = add_sort(
+                sort=sort,
+                t_table={'_': r_table, '_t1_': t1_table, '_t2_': t2_table},
+                select=s,
+            )
 
-    if offset:
-        s = s.offset(offset)
+            #do we need more joins?
+            for (col, table) in cols:
+                if table == need_join1[1]:
+                    joins_needed.add(need_join1)
+                elif table == need_join2[1]:
+                    joins_needed.add(need_join2)
 
-    try:
-        r = add_request_info(s).execute()
-    except Exception, e:
-        dbm.mark_dead(r_table.bind)
-        # this thread must die so that others may live
-        raise
+        for j in joins_needed:
+            col, table = j
+            s.append_whereclause(r_table.c[col] == table.c.thing_id)
+
+        if limit:
+            s = s.limit(limit)
+
+        if offset:
+            s = s.offset(offset)
+
+        return s
+
+    key = ('rels', rel_type_id, tuple(ret_props), sort_shape(sort), limit,
+           offset)
+    compiled, params = compile_select(
+        key, r_table.bind, constraints, is_data_op, build)
+    return r_table.bind, compiled, params
+
+def find_rels(ret_props, rel_type_id, sort, limit, offset, constraints,
+              master=False):
+    """Query relations, from a replica unless `master` is set."""
+    r = execute_compiled(*prepare_rels(
+        ret_props, rel_type_id, sort, limit, offset, constraints, master))
 
     def build_fn(row):
         # return Storage objects with just the requested props
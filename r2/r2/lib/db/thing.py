@@ -27,12 +27,18 @@ import hashlib
 import itertools
 import new
 import sys
+import time
 
 from _pylibmc import MemcachedError
 from pylons import app_globals as g
+from pylons import request, tmpl_context
 
 from r2.lib import amqp, hooks
+from r2.lib.bloom import BloomFilter
+from r2.lib.cache import load_coalesced
+from r2.lib.db.batch_loader import get_loader
 from r2.lib.db import tdb_sql as tdb, sorts, operators
+from r2.lib.db import incr_buffer
 from r2.lib.sgm import sgm
 from r2.lib.utils import class_property, Results, tup, to36
 
@@ -46,6 +52,16 @@ CreationError = tdb.CreationError
 thing_types = {}
 rel_types = {}
 
+# values of a relation's negative filter key other than a BloomFilter. DIRTY
+# means a relation was added while there was no filter, so a filter built
+# from a query made before then mustn't be stored. filters are built from the
+# master, so DIRTY only has to outlast one build, not replication lag.
+# SATURATED means there are too many relations for a filter to be worth
+# keeping.
+NEGATIVE_FILTER_DIRTY = "dirty"
+NEGATIVE_FILTER_SATURATED = "saturated"
+NEGATIVE_FILTER_DIRTY_TTL = 60
+
 
 class SafeSetAttr:
     def __init__(self, cls):
@@ -75,6 +91,9 @@ class DataThing(object):
     _int_props = ()
     _data_int_props = ()
     _int_prop_suffix = None
+    # int props whose _incr can be written behind, see incr_buffer
+    _buffered_incr_props = ()
+    _buffered_incr_suffix = None
     _defaults = {}
     _essentials = ()
     c = operators.Slots()
@@ -174,7 +193,7 @@ class DataThing(object):
         return things_by_id
 
     @classmethod
-    def write_things_to_cache(cls, things_by_id):
+    def write_things_to_cache(cls, things_by_id, time=None):
         """Write id->thing dict to cache.
 
         Used to populate the cache after a cache miss/db read. To ensure we
@@ -186,7 +205,8 @@ class DataThing(object):
         cache = cls._cache
         prefix = cls._cache_prefix()
         try:
-            cache.add_multi(things_by_id, prefix=prefix, time=cls._cache_ttl)
+            cache.add_multi(things_by_id, prefix=prefix,
+                            time=time or cls._cache_ttl)
         except MemcachedError as e:
             g.log.warning("write_things_to_cache error: %s", e)
 
@@ -236,7 +256,20 @@ class DataThing(object):
 
         cache = self.__class__._cache
         key = self._cache_key()
-        cache.set(key, self, time=self.__class__._cache_ttl)
+        ttl = self.__class__._cache_ttl
+
+        # a copy loaded from the db while increments were still buffered
+        # must expire when they've been written (see _mark_unsettled)
+        unsettled_until = getattr(self, "_incr_unsettled_until", None)
+        if unsettled_until:
+            ttl = min(ttl, max(int(unsettled_until - time.time()), 1))
+
+        cache.set(key, self, time=ttl)
+
+        # don't let later stale lookups have a copy from before this write
+        loader = get_loader()
+        if loader:
+            loader.forget(self.__class__, [self._id])
 
     def update_from_cache(self, lock):
         """Read the current value of thing from cache and update self.
@@ -264,6 +297,10 @@ class DataThing(object):
         # update data_props
         self._t = other_self._t
 
+        unsettled_until = getattr(other_self, "_incr_unsettled_until", None)
+        if unsettled_until or getattr(self, "_incr_unsettled_until", None):
+            self._incr_unsettled_until = unsettled_until
+
         # reapply changes made to self
         self_changes = self._dirties
         self._dirties = {}
@@ -361,11 +398,7 @@ class DataThing(object):
         return self._fullname_from_id36(self._id36)
 
     @classmethod
-    def _byID(cls, ids, data=True, return_dict=True, stale=False,
-              ignore_missing=False):
-        # data props are ALWAYS loaded, data keyword is meaningless
-        ids, single = tup(ids, ret_is_single=True)
-
+    def _check_ids(cls, ids):
         for x in ids:
             if not isinstance(x, (int, long)):
                 raise ValueError('non-integer thing_id in %r' % ids)
@@ -374,28 +407,113 @@ class DataThing(object):
             elif x < tdb.MIN_THING_ID:
                 raise NotFound('negative thing_id in %r' % ids)
 
+    @classmethod
+    def _loaded_from_db(cls, from_db_by_id):
+        if from_db_by_id:
+            unsettled = cls._mark_unsettled(from_db_by_id)
+            if unsettled:
+                settled = {_id: thing
+                           for _id, thing in from_db_by_id.iteritems()
+                           if _id not in unsettled}
+                if settled:
+                    cls.write_things_to_cache(settled)
+                cls.write_things_to_cache(
+                    unsettled, time=incr_buffer.pending_ttl())
+            else:
+                cls.write_things_to_cache(from_db_by_id)
+            cls.record_cache_write(event="cache", delta=len(from_db_by_id))
+        return from_db_by_id
+
+    @classmethod
+    def _incr_pending_prefix(cls):
+        return "incr_pending_" + cls._cache_prefix()
+
+    @classmethod
+    def _mark_unsettled(cls, things_by_id):
+        """Find things that may have buffered increments not yet in the db.
+
+        They're marked so that they're cached only until the increments have
+        been written, rather than keeping the lower db values in the cache.
+
+        """
+
+        if not (g.incr_buffer_window and
+                (cls._buffered_incr_props or cls._buffered_incr_suffix)):
+            return {}
+
+        pending = cls._cache.get_multi(
+            things_by_id.keys(), prefix=cls._incr_pending_prefix())
+        if not pending:
+            return {}
+
+        until = time.time() + incr_buffer.pending_ttl()
+        unsettled = {}
+        for _id in pending:
+            thing = things_by_id[_id]
+            thing._incr_unsettled_until = until
+            unsettled[_id] = thing
+        g.stats.simple_event(
+            "incr_buffer.unsettled_load", delta=len(unsettled))
+        return unsettled
+
+    @classmethod
+    def _load_missing(cls, missing_ids):
+        """Read things that weren't in the cache from the db and cache them."""
+        def load_from_db(missing_ids):
+            return cls._loaded_from_db(cls.get_things_from_db(missing_ids))
+
+        # concurrent lookups of the same missing things share one load
+        # if the cache chain is set up to coalesce them
+        return load_coalesced(
+            cls._cache, missing_ids, load_from_db, prefix=cls._cache_prefix())
+
+    @classmethod
+    def _byID(cls, ids, data=True, return_dict=True, stale=False,
+              ignore_missing=False):
+        # data props are ALWAYS loaded, data keyword is meaningless
+        ids, single = tup(ids, ret_is_single=True)
+        cls._check_ids(ids)
+
         if not single and not ids:
             if return_dict:
                 return {}
             else:
                 return []
 
-        things_by_id = cls.get_things_from_cache(ids, stale=stale)
+        # fetch anything registered with _prefetch along with these
+        loader = get_loader()
+        if loader:
+            batched = loader.claim(cls, ids, stale=stale)
+            prefetch_ids = loader.take(cls, exclude=ids)
+            fetch_ids = [_id for _id in ids if _id not in batched]
+            fetch_ids.extend(prefetch_ids)
+        else:
+            batched = {}
+            prefetch_ids = []
+            fetch_ids = ids
+
+        if fetch_ids:
+            things_by_id = cls.get_things_from_cache(fetch_ids, stale=stale)
+        else:
+            things_by_id = {}
         missing_ids = [_id
-            for _id in ids
+            for _id in fetch_ids
             if _id not in things_by_id
         ]
 
         if missing_ids:
-            from_db_by_id = cls.get_things_from_db(missing_ids)
+            from_db_by_id = cls._load_missing(missing_ids)
         else:
             from_db_by_id = {}
 
-        if from_db_by_id:
-            cls.write_things_to_cache(from_db_by_id)
-            cls.record_cache_write(event="cache", delta=len(from_db_by_id))
-
         things_by_id.update(from_db_by_id)
+        if prefetch_ids:
+            # stale reads don't go in the local cache, so the loader keeps
+            # the prefetched things for later stale lookups
+            prefetched = {_id: things_by_id.pop(_id)
+                          for _id in prefetch_ids if _id in things_by_id}
+            loader.store(cls, prefetched, stale=stale)
+        things_by_id.update(batched)
 
         # Check to see if we found everything we asked for
         missing = [_id for _id in ids if _id not in things_by_id]
@@ -412,6 +530,25 @@ class DataThing(object):
         else:
             return filter(None, (things_by_id.get(_id) for _id in ids))
 
+    @classmethod
+    def _prefetch(cls, ids):
+        """Register ids to be fetched by the next _byID of this type.
+
+        Only has an effect within a request (see r2.lib.db.batch_loader).
+
+        """
+        loader = get_loader()
+        if loader:
+            ids = tup(ids)
+            for x in ids:
+                if not isinstance(x, (int, long)):
+                    raise ValueError('non-integer thing_id in %r' % ids)
+            loader.prefetch(cls, ids)
+
+    @classmethod
+    def _load_prefetched(cls, ids):
+        return cls._byID(ids, return_dict=True, ignore_missing=True)
+
     @classmethod
     def _byID36(cls, id36s, return_dict = True, **kw):
 
@@ -458,11 +595,23 @@ class DataThing(object):
                 if single:
                     raise NotFound
 
-        # lookup ids for each type
-        identified = {}
+        # lookup ids for each type. Thing types that use the standard _byID
+        # can all be looked up together.
+        batchable = {real_type: thing_ids
+                     for real_type, thing_ids in table.iteritems()
+                     if _can_batch_byID(real_type, kw)}
+        if len(batchable) > 1:
+            identified = _byID_by_type(
+                batchable, stale=kw.get("stale", False),
+                ignore_missing=ignore_missing)
+        else:
+            identified = {}
+
         for real_type, thing_ids in table.iteritems():
-            i = real_type._byID(thing_ids, ignore_missing=ignore_missing, **kw)
-            identified[real_type] = i
+            if real_type not in identified:
+                i = real_type._byID(
+                    thing_ids, ignore_missing=ignore_missing, **kw)
+                identified[real_type] = i
 
         # interleave types in original order of the name
         res = []
@@ -490,6 +639,104 @@ class DataThing(object):
         raise NotImplementedError()
 
 
+def _can_batch_byID(cls, kw):
+    return (cls._byID.im_func is DataThing._byID.im_func and
+            set(kw) <= {"data", "stale"})
+
+
+def _with_request_context(fn):
+    """Wrap fn to run on another thread with this thread's pylons globals."""
+    objs = []
+    for proxy in (g, tmpl_context, request):
+        try:
+            objs.append((proxy, proxy._current_obj()))
+        except TypeError:
+            # nothing registered on this thread
+            pass
+
+    def with_request_context(*a, **kw):
+        for proxy, obj in objs:
+            proxy._push_object(obj)
+        try:
+            return fn(*a, **kw)
+        finally:
+            for proxy, obj in reversed(objs):
+                proxy._pop_object(obj)
+    return with_request_context
+
+
+def _byID_by_type(ids_by_type, stale=False, ignore_missing=False):
+    """Look up things of several types, returning {type: {id: thing}}.
+
+    This is equivalent to calling _byID on each type, but the things of all
+    the types that share a cache are read with one get_multi. If
+    parallel_thing_lookups is enabled, the things that weren't cached are
+    read from each type's database at the same time.
+
+    """
+
+    loader = None if stale else get_loader()
+    fetch_ids_by_type = {}
+    prefetch_ids_by_type = {}
+    for cls, ids in ids_by_type.iteritems():
+        cls._check_ids(ids)
+        prefetch_ids = loader.take(cls, exclude=ids) if loader else []
+        prefetch_ids_by_type[cls] = prefetch_ids
+        fetch_ids_by_type[cls] = list(ids) + prefetch_ids
+
+    things_by_type = {cls: {} for cls in fetch_ids_by_type}
+    types_by_cache = {}
+    for cls in fetch_ids_by_type:
+        types_by_cache.setdefault(cls._cache, []).append(cls)
+
+    for cache, types in types_by_cache.iteritems():
+        type_and_id_by_key = {}
+        for cls in types:
+            prefix = cls._cache_prefix()
+            for _id in fetch_ids_by_type[cls]:
+                type_and_id_by_key[prefix + str(_id)] = (cls, _id)
+
+        cached = cache.simple_get_multi(
+            type_and_id_by_key.keys(), stale=stale, allow_local=True)
+        for key, thing in cached.iteritems():
+            cls, _id = type_and_id_by_key[key]
+            things_by_type[cls][_id] = thing
+
+    missing_by_type = {}
+    for cls, fetch_ids in fetch_ids_by_type.iteritems():
+        missing_ids = [_id for _id in fetch_ids
+                       if _id not in things_by_type[cls]]
+        if missing_ids:
+            missing_by_type[cls] = missing_ids
+
+    fetcher = g.thing_lookup_fetcher
+    if fetcher and len(missing_by_type) > 1:
+        types = missing_by_type.keys()
+        results = fetcher.run([
+            (cls.__name__,
+             _with_request_context(cls.get_things_from_db),
+             (missing_by_type[cls],))
+            for cls in types
+        ])
+        for cls, from_db_by_id in zip(types, results):
+            # cache chains are thread-local so write to them from here
+            things_by_type[cls].update(cls._loaded_from_db(from_db_by_id))
+    else:
+        for cls, missing_ids in missing_by_type.iteritems():
+            things_by_type[cls].update(cls._load_missing(missing_ids))
+
+    for cls, ids in ids_by_type.iteritems():
+        things_by_id = things_by_type[cls]
+        for _id in prefetch_ids_by_type[cls]:
+            things_by_id.pop(_id, None)
+
+        missing = [_id for _id in ids if _id not in things_by_id]
+        if missing and not ignore_missing:
+            raise NotFound, '%s %s' % (cls.__name__, missing)
+
+    return things_by_type
+
+
 class ThingMeta(type):
     def __init__(cls, name, bases, dct):
         if name == 'Thing' or hasattr(cls, '_nodb') and cls._nodb: return
@@ -618,6 +865,70 @@ class Thing(DataThing):
                 **props
             )
 
+    @classmethod
+    def _bulk_create(cls, things):
+        """Create many new things of this type at once.
+
+        Equivalent to calling _commit on each of them, but the things and
+        their data are written with a few multi-row INSERTs in one
+        transaction and cached with one set_multi.
+
+        """
+
+        things = list(things)
+        if not things:
+            return things
+
+        for thing in things:
+            assert not thing._created
+            assert thing._type_id == cls._type_id
+
+        with TdbTransactionContext():
+            ids = tdb.make_things(cls._type_id, [
+                dict(
+                    ups=thing._ups,
+                    downs=thing._downs,
+                    date=thing._date,
+                    deleted=thing._deleted,
+                    spam=thing._spam,
+                )
+                for thing in things
+            ])
+
+            changes_by_thing = []
+            data_by_id = {}
+            for thing, _id in zip(things, ids):
+                thing._id = _id
+                thing._created = True
+
+                changes = thing._dirties.copy()
+                changes_by_thing.append((thing, changes))
+                data_props = {prop: new_value
+                    for prop, (old_value, new_value) in changes.iteritems()
+                    if not prop.startswith('_')}
+                if data_props:
+                    data_by_id[_id] = data_props
+
+            tdb.create_things_data(cls._type_id, data_by_id)
+
+            for thing in things:
+                thing._dirties.clear()
+
+        cls._cache.set_multi({thing._id: thing for thing in things},
+                             prefix=cls._cache_prefix(), time=cls._cache_ttl)
+        cls.record_cache_write(event="create", delta=len(things))
+
+        hook = hooks.get_hook("thing.commit")
+        for thing, changes in changes_by_thing:
+            hook.call(thing=thing, changes=changes)
+
+        return things
+
+    @classmethod
+    def _incr_is_buffered(cls, prop):
+        return (prop in cls._buffered_incr_props or
+            cls._buffered_incr_suffix and prop.endswith(cls._buffered_incr_suffix))
+
     def _incr(self, prop, amt=1):
         """Increment self.prop."""
         assert not self._dirty
@@ -636,6 +947,23 @@ class Thing(DataThing):
 
             self.__setattr__(prop, new_val, make_dirty=False)
 
+            from_default = (not is_base_prop and
+                            prop in self.__class__._defaults and
+                            self.__class__._defaults[prop] == old_val)
+            buf = incr_buffer.get_buffer()
+            if buf and not from_default and self._incr_is_buffered(prop):
+                newly_pending = buf.add(
+                    (self.__class__._type_id, self._id, db_prop, is_base_prop),
+                    amt,
+                )
+                if newly_pending:
+                    self.__class__._cache.set(
+                        self._incr_pending_prefix() + str(self._id), True,
+                        time=incr_buffer.pending_ttl())
+                self.write_thing_to_cache(lock)
+                self.record_cache_write(event="incr_buffered")
+                return
+
             with TdbTransactionContext():
                 if is_base_prop:
                     # can just incr a base prop because it must have been set
@@ -646,8 +974,7 @@ class Thing(DataThing):
                         prop=db_prop,
                         amount=amt,
                     )
-                elif (prop in self.__class__._defaults and
-                        self.__class__._defaults[prop] == old_val):
+                elif from_default:
                     # when updating a data prop from the default value assume
                     # the value was never actually set so it's not safe to incr
                     tdb.set_thing_data(
@@ -791,6 +1118,15 @@ def Relation(type1, type2):
         _rel_cache = g.relcache
         _rel_cache_ttl = int(timedelta(hours=1).total_seconds())
 
+        # keep a Bloom filter of the thing2s each thing1 is related to by
+        # each name (or only by _negative_filter_names) so that _fast_query
+        # can skip looking up pairs that definitely aren't related
+        _negative_filter = False
+        _negative_filter_names = None
+        _negative_filter_capacity = 1000
+        _negative_filter_ttl = int(timedelta(days=1).total_seconds())
+        _negative_filter_cache = g.relfiltercache
+
         @classmethod
         def get_things_from_db(cls, ids):
             """Read props from db and return id->rel dict."""
@@ -954,13 +1290,111 @@ def Relation(type1, type2):
                 self._name,
             )
 
+        @classmethod
+        def _use_negative_filter(cls, name):
+            return (cls._negative_filter and g.rel_negative_filters and
+                (cls._negative_filter_names is None or
+                    name in cls._negative_filter_names))
+
+        @classmethod
+        def _negative_filter_key(cls, thing1_id, name):
+            return "relfilter:{cls}_{t1}_{name}".format(
+                cls=cls.__name__,
+                t1=str(thing1_id),
+                name=name,
+            )
+
+        @classmethod
+        def _build_negative_filter(cls, thing1_id, name):
+            # a replica can be missing relations added longer ago than the
+            # filter's DIRTY marker lasts, which would leave them out of the
+            # filter until it expires. apps that can't use the master don't
+            # build filters.
+            if g.disallow_db_writes:
+                return None
+
+            capacity = cls._negative_filter_capacity
+            q = cls._simple_query(
+                ["_thing2_id"],
+                cls.c._thing1_id == thing1_id,
+                cls.c._name == name,
+                limit=capacity + 1,
+                master=True,
+            )
+            thing2_ids = [row._thing2_id for row in q]
+            if len(thing2_ids) > capacity:
+                return NEGATIVE_FILTER_SATURATED
+
+            negative_filter = BloomFilter(capacity)
+            for thing2_id in thing2_ids:
+                negative_filter.add(thing2_id)
+            return negative_filter
+
+        @classmethod
+        def _get_negative_filters(cls, thing1_ids, names):
+            """Return {(thing1_id, name): BloomFilter} for usable filters.
+
+            Missing filters are built from the master database, but only
+            stored (and used) if no relation was added in the meantime.
+
+            """
+
+            cache = cls._negative_filter_cache
+            keys = {cls._negative_filter_key(thing1_id, name): (thing1_id, name)
+                    for thing1_id in thing1_ids
+                    for name in names
+                    if cls._use_negative_filter(name)}
+            if not keys:
+                return {}
+
+            values = cache.get_multi(keys.keys())
+            filters = {}
+            for key, (thing1_id, name) in keys.iteritems():
+                value = values.get(key)
+                if value is None:
+                    value = cls._build_negative_filter(thing1_id, name)
+                    if value is None:
+                        continue
+                    # the chain's add isn't reliable, ask memcache itself
+                    if not cache.caches[-1].add(key, value,
+                                                time=cls._negative_filter_ttl):
+                        continue
+                    g.stats.simple_event("rel.negative_filter_build")
+
+                if isinstance(value, BloomFilter):
+                    filters[(thing1_id, name)] = value
+            return filters
+
+        def _update_negative_filter(self):
+            cls = self.__class__
+            cache = cls._negative_filter_cache
+            key = cls._negative_filter_key(self._thing1_id, self._name)
+
+            with g.make_lock("rel_negative_filter", "lock_" + key):
+                value = cache.get(key, allow_local=False)
+                if isinstance(value, BloomFilter):
+                    value.add(self._thing2_id)
+                    if value.full:
+                        value = NEGATIVE_FILTER_SATURATED
+                    cache.set(key, value, time=cls._negative_filter_ttl)
+                elif value != NEGATIVE_FILTER_SATURATED:
+                    cache.set(key, NEGATIVE_FILTER_DIRTY,
+                              time=NEGATIVE_FILTER_DIRTY_TTL)
+
         def _commit(self):
+            # deleting a relation leaves it in the negative filter, which
+            # only makes for a false positive
+            new_pair = not self._created or "_name" in self._dirties
+
             DataThing._commit(self)
 
             if self.__class__._enable_fast_query:
                 ttl = self.__class__._rel_cache_ttl
                 self._rel_cache.set(self._rel_cache_key(), self._id, time=ttl)
 
+            if new_pair and self._use_negative_filter(self._name):
+                self._update_negative_filter()
+
         def _delete(self):
             tdb.del_rel(self._type_id, self._id)
 
@@ -1041,14 +1475,34 @@ def Relation(type1, type2):
                 )
                 cache_key_lookup[rel_cache_key] = t
 
+            # pairs that definitely aren't related needn't be looked up
+            negatives = {}
+            negative_filters = cls._get_negative_filters(
+                thing1_dict.keys(), names)
+            if negative_filters:
+                for cache_key, t in cache_key_lookup.iteritems():
+                    thing1, thing2, name = t
+                    negative_filter = negative_filters.get((thing1._id, name))
+                    if (negative_filter is not None and
+                            thing2._id not in negative_filter):
+                        negatives[cache_key] = None
+                g.stats.simple_event(
+                    "rel.negative_filter_skip", delta=len(negatives))
+
             # get the relation ids from the cache or query the db
-            res = sgm(
-                cache=cls._rel_cache,
-                keys=cache_key_lookup.keys(),
-                miss_fn=lookup_rel_ids,
-                time=cls._rel_cache_ttl,
-                ignore_set_errors=True,
-            )
+            keys = [cache_key for cache_key in cache_key_lookup
+                    if cache_key not in negatives]
+            if keys:
+                res = sgm(
+                    cache=cls._rel_cache,
+                    keys=keys,
+                    miss_fn=lookup_rel_ids,
+                    time=cls._rel_cache_ttl,
+                    ignore_set_errors=True,
+                )
+            else:
+                res = {}
+            res.update(negatives)
 
             # get the relation objects
             rel_ids = {rel_id for rel_id in res.itervalues()
@@ -1266,6 +1720,64 @@ class Things(Query):
 
         return Results(cursor, row_fn, do_batch=True)
 
+    def _stream(self, batch_size=1000, use_cache=False,
+                cursor_rows=500000, cursor_seconds=600):
+        """Yield lists of all the query's things, batch_size at a time.
+
+        Unlike paging through the query with _after, the query is only run
+        once per cursor_rows rows or cursor_seconds seconds (see
+        tdb_sql.stream_thing_ids). Cursors are re-opened after the last
+        thing rather than held open for a whole scan, which would hold back
+        vacuum (or get cancelled on a hot standby). The things are read
+        straight from the db unless use_cache is set, so one-off scans don't
+        fill the cache with things nobody else wants.
+
+        """
+
+        orig_rules = deepcopy(self._rules)
+        last = None
+
+        while True:
+            if last is not None:
+                self._rules = deepcopy(orig_rules)
+                self._after(last)
+
+            batches = tdb.stream_thing_ids(
+                type_id=self._kind._type_id,
+                sort=self._sort,
+                constraints=self._rules,
+                batch_size=batch_size,
+                use_data=self._use_data,
+            )
+            opened = time.time()
+            rows = 0
+            done = True
+
+            try:
+                for ids in batches:
+                    if use_cache:
+                        things = self._kind._byID(ids, return_dict=False,
+                                                  stale=self._stale,
+                                                  ignore_missing=True)
+                    else:
+                        things_by_id = self._kind.get_things_from_db(ids)
+                        things = [things_by_id[_id] for _id in ids
+                                  if _id in things_by_id]
+                    if things:
+                        last = things[-1]
+                        yield things
+
+                    rows += len(ids)
+                    if last is not None and (rows >= cursor_rows or
+                            time.time() - opened >= cursor_seconds):
+                        done = False
+                        break
+            finally:
+                batches.close()
+
+            if done:
+                break
+
 def load_things(rels, stale=False):
     rels = tup(rels)
     kind = rels[0].__class__
@@ -1288,6 +1800,7 @@ class Relations(Query):
     def __init__(self, kind, *rules, **kw):
         self._eager_load = kw.get('eager_load')
         self._thing_stale = kw.get('thing_stale')
+        self._master = kw.get('master', False)
         Query.__init__(self, kind, *rules, **kw)
 
     def _filter(self, *rules):
@@ -1314,6 +1827,7 @@ class Relations(Query):
             limit=self._limit,
             offset=self._offset,
             constraints=self._rules,
+            master=self._master,
         )
         return Results(c, self._make_rel, do_batch=True)
 
@@ -1331,6 +1845,7 @@ class RelationsPropsOnly(Relations):
             limit=self._limit,
             offset=self._offset,
             constraints=self._rules,
+            master=self._master,
         )
         return c
 
@@ -0,0 +1,169 @@
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of
+# the Original Code is reddit Inc.
+#
+# All portions of the code written by reddit are Copyright (c) 2006-2016 reddit
+# Inc. All Rights Reserved.
+"""Read-your-writes for users who have just written something.
+
+Reads normally go to replicas and stale caches, which may be a little behind
+the master. When a request writes to a thing or relation type the time of
+the write is kept in a signed cookie, and for db_read_your_writes_window
+seconds afterwards that user's reads of the type only use replicas that have
+caught up with the write (or the master) and skip the stale caches. Everyone
+else keeps reading from replicas and stale caches.
+
+"""
+
+from datetime import datetime, timedelta
+import hashlib
+import hmac
+import math
+import time
+
+from pylons import app_globals as g
+from pylons import request
+from pylons import tmpl_context as c
+
+from r2.lib.utils import constant_time_compare
+
+
+COOKIE_NAME = "reddit_rw"
+# only the most recently written types are kept, a user can't make the
+# cookie (and the work of parsing it) arbitrarily large
+MAX_KINDS = 10
+# how far in the future a token may be, to allow for clock differences
+# between app servers
+MAX_CLOCK_SKEW = 1
+
+
+class WriteTokens(object):
+    def __init__(self, writes=None):
+        # kind ("t" or "r" and the type id, as in tdb_sql) -> write time
+        self.writes = dict(writes or {})
+        self.dirty = False
+
+    @staticmethod
+    def _mac(value, secret):
+        return hmac.new(secret, value, hashlib.sha1).hexdigest()
+
+    @classmethod
+    def from_cookie(cls, cookie, now, window, secret):
+        # the tokens send reads to the master, so they can't be taken from
+        # clients that haven't actually written anything
+        value, sep, mac = cookie.rpartition("|")
+        if not constant_time_compare(mac, cls._mac(value, secret)):
+            return cls()
+
+        writes = {}
+        for token in value.split(","):
+            kind, sep, timestamp = token.partition(":")
+            try:
+                timestamp = float(timestamp)
+            except ValueError:
+                continue
+
+            # tokens from the future are bogus
+            if kind and now - window < timestamp <= now + MAX_CLOCK_SKEW:
+                writes[kind] = timestamp
+
+        if len(writes) > MAX_KINDS:
+            writes = dict(sorted(writes.iteritems(), key=lambda kv: kv[1])
+                          [-MAX_KINDS:])
+        return cls(writes)
+
+    def to_cookie(self, secret):
+        recent = sorted(self.writes.iteritems(), key=lambda kv: kv[1])
+        # round up so the write is never thought older than it was
+        value = ",".join("%s:%.3f" % (kind, math.ceil(timestamp * 1000) / 1000)
+                         for kind, timestamp in recent[-MAX_KINDS:])
+        return "%s|%s" % (value, self._mac(value, secret))
+
+    def record(self, kind, now):
+        self.writes[kind] = now
+        self.dirty = True
+
+    def last_write(self, kind, now, window):
+        timestamp = self.writes.get(kind)
+        if timestamp is not None and now - timestamp < window:
+            return timestamp
+        return None
+
+    def wrote_recently(self, now, window):
+        return any(now - timestamp < window
+                   for timestamp in self.writes.itervalues())
+
+
+def get_tokens():
+    """Return the current request's WriteTokens, if it has any."""
+    try:
+        return getattr(c, "write_tokens", None) or None
+    except TypeError:
+        # not in a request
+        return None
+
+
+def record_write(kind):
+    tokens = get_tokens()
+    if tokens:
+        tokens.record(kind, time.time())
+
+
+def last_write(kind):
+    """Return when the current user last wrote to kind, if it was recent."""
+    tokens = get_tokens()
+    if tokens:
+        return tokens.last_write(kind, time.time(),
+                                 g.db_read_your_writes_window)
+    return None
+
+
+def wrote_recently():
+    """Return whether the current user has written anything recently."""
+    tokens = get_tokens()
+    return bool(tokens and
+                tokens.wrote_recently(time.time(),
+                                      g.db_read_your_writes_window))
+
+
+def start_request():
+    window = g.db_read_your_writes_window
+    if not window:
+        return
+
+    value = request.cookies.get(COOKIE_NAME)
+    if value:
+        c.write_tokens = WriteTokens.from_cookie(
+            value, time.time(), window, g.secrets["write_tokens"])
+    else:
+        c.write_tokens = WriteTokens()
+
+
+def finish_request():
+    from r2.lib.cookies import Cookie
+
+    tokens = get_tokens()
+    if not tokens:
+        return
+
+    if tokens.dirty:
+        expires = datetime.utcnow() + timedelta(
+            seconds=g.db_read_your_writes_window)
+        c.cookies[COOKIE_NAME] = Cookie(
+            value=tokens.to_cookie(g.secrets["write_tokens"]),
+            expires=expires, httponly=True)
+    c.write_tokens = None
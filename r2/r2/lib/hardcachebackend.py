@@ -23,7 +23,10 @@
 from pylons import app_globals as g
 from datetime import timedelta as timedelta
 from datetime import datetime
+import calendar
+import hashlib
 import sqlalchemy as sa
+import struct
 from r2.lib.db.tdb_lite import tdb_lite
 import pytz
 import random
@@ -31,6 +34,7 @@ import random
 COUNT_CATEGORY = 'hc_count'
 ELAPSED_CATEGORY = 'hc_elapsed'
 TZ = pytz.timezone("MST")
+PARTITION_FORMAT = "%Y%m%d%H"
 
 def expiration_from_time(time):
     if time <= 0:
@@ -38,13 +42,29 @@ def expiration_from_time(time):
     return datetime.now(TZ) + timedelta(0, time)
 
 class HardCacheBackend(object):
+    """Postgres storage for the hardcache.
+
+    Categories flagged with !partitioned in hardcache_categories keep items
+    that expire within the next hardcache_partition_count buckets of
+    hardcache_partition_hours in tables of their own, one per bucket of
+    expiration times (e.g. reddit_hardcache_2016010100). Expiring them is a
+    DROP TABLE rather than a DELETE, at the cost of writes having to look for
+    older copies of the key in each of the tables. Items expiring further out
+    stay in the main table.
+
+    """
+
     def __init__(self, gc):
         self.tdb = tdb_lite(gc)
         self.profile_categories = {}
+        self.partitioned_categories = set()
+        self.partition_hours = gc.config.get("hardcache_partition_hours", 0)
+        self.partition_count = gc.config.get("hardcache_partition_count", 8)
+        self._partitions = {}
         TZ = gc.display_tz
 
-        def _table(metadata):
-            return sa.Table(gc.db_app_name + '_hardcache', metadata,
+        def _table(metadata, name=None):
+            return sa.Table(name or gc.db_app_name + '_hardcache', metadata,
                             sa.Column('category', sa.String, nullable = False,
                                       primary_key = True),
                             sa.Column('ids', sa.String, nullable = False,
@@ -55,6 +75,8 @@ class HardCacheBackend(object):
                                       sa.DateTime(timezone = True),
                                       nullable = False)
                             )
+        self._make_table = _table
+
         enginenames_by_category = {}
         all_enginenames = set()
         for item in gc.hardcache_categories:
@@ -66,6 +88,8 @@ class HardCacheBackend(object):
             for c in chunks:
                 if c == '!profile':
                     self.profile_categories[category] = True
+                elif c == '!partitioned':
+                    self.partitioned_categories.add(category)
                 elif c.startswith("!"):
                     raise ValueError("WTF is [%s] in hardcache_overrides?" % c)
                 else:
@@ -88,6 +112,9 @@ class HardCacheBackend(object):
             self.mapping[category] = [ engines_by_enginename[e]
                                        for e in enginenames]
 
+        if self.partition_hours and gc.db_create_tables:
+            self.create_partitions()
+
     def engine_by_category(self, category, type="master"):
         if category not in self.mapping:
             category = '*'
@@ -99,6 +126,103 @@ class HardCacheBackend(object):
         else:
             raise ValueError("invalid type %s" % type)
 
+    def is_partitioned(self, category):
+        if not self.partition_hours:
+            return False
+        if category not in self.mapping:
+            category = '*'
+        return category in self.partitioned_categories
+
+    def bucket(self, when):
+        """Return the start of the partition bucket that `when` is in."""
+        hours = calendar.timegm(when.utctimetuple()) // 3600
+        hours -= hours % self.partition_hours
+        return datetime.fromtimestamp(hours * 3600, pytz.utc)
+
+    def live_buckets(self, now=None):
+        """Return the buckets of items that haven't expired yet."""
+        first = self.bucket(now or datetime.now(TZ))
+        width = timedelta(hours=self.partition_hours)
+        return [first + width * i for i in xrange(self.partition_count + 1)]
+
+    def partition(self, table, bucket):
+        key = (table, bucket)
+        if key not in self._partitions:
+            self._forget_expired_partitions()
+            name = "%s_%s" % (table.name, bucket.strftime(PARTITION_FORMAT))
+            self._partitions[key] = self._make_table(table.metadata, name)
+        return self._partitions[key]
+
+    def _forget_expired_partitions(self):
+        first_bucket = self.live_buckets()[0]
+        for table, bucket in self._partitions.keys():
+            if bucket < first_bucket:
+                partition = self._partitions.pop((table, bucket))
+                table.metadata.remove(partition)
+
+    def tables(self, category, type="master"):
+        """Return the tables that can hold items of category."""
+        table = self.engine_by_category(category, type)
+        if not self.is_partitioned(category):
+            return [table]
+        return [table] + [self.partition(table, bucket)
+                          for bucket in self.live_buckets()]
+
+    def table_for_expiration(self, category, expiration):
+        """Return the table new items of category expiring then go in."""
+        table = self.engine_by_category(category, "master")
+        if self.is_partitioned(category):
+            bucket = self.bucket(expiration)
+            if bucket in self.live_buckets():
+                return self.partition(table, bucket)
+        return table
+
+    def partitioned_masters(self):
+        return {self.mapping[category][0]
+                for category in self.partitioned_categories}
+
+    def create_partitions(self, now=None):
+        """Create the partitions for the live buckets and the next one."""
+        now = now or datetime.now(TZ)
+        width = timedelta(hours=self.partition_hours)
+        buckets = self.live_buckets(now)
+        buckets.append(buckets[-1] + width)
+        for table in self.partitioned_masters():
+            for bucket in buckets:
+                self.partition(table, bucket).create(checkfirst=True)
+
+    def drop_expired_partitions(self, now=None):
+        """Drop the partitions of buckets that have completely expired.
+
+        Returns the names of the dropped tables.
+
+        """
+
+        now = now or datetime.now(TZ)
+        width = timedelta(hours=self.partition_hours)
+        dropped = []
+        for table in self.partitioned_masters():
+            prefix = table.name + "_"
+            for name in table.bind.table_names():
+                if not name.startswith(prefix):
+                    continue
+
+                try:
+                    bucket = datetime.strptime(
+                        name[len(prefix):], PARTITION_FORMAT)
+                except ValueError:
+                    continue
+                bucket = bucket.replace(tzinfo=pytz.utc)
+
+                if bucket + width <= now:
+                    partition = self._partitions.pop((table, bucket), None)
+                    if partition is None:
+                        partition = self._make_table(table.metadata, name)
+                    partition.drop(checkfirst=True)
+                    table.metadata.remove(partition)
+                    dropped.append(name)
+        return dropped
+
     def profile_start(self, operation, category):
         if category == COUNT_CATEGORY:
             return None
@@ -148,7 +272,7 @@ class HardCacheBackend(object):
 
         prof = self.profile_start('set', category)
 
-        engine = self.engine_by_category(category, "master")
+        engine = self.table_for_expiration(category, expiration)
 
         engine.insert().execute(
             category=category,
@@ -169,7 +293,13 @@ class HardCacheBackend(object):
 
         prof = self.profile_start('add', category)
 
-        engine = self.engine_by_category(category, "master")
+        if self.is_partitioned(category):
+            result = self._add_partitioned(category, ids, value, kind,
+                                           expiration)
+            self.profile_stop(prof)
+            return result
+
+        engine = self.table_for_expiration(category, expiration)
 
         try:
             rp = engine.insert().execute(
@@ -186,6 +316,39 @@ class HardCacheBackend(object):
             self.profile_stop(prof)
             return self.get(category, ids, force_write_table=True)
 
+    def _add_partitioned(self, category, ids, value, kind, expiration):
+        """add() for partitioned categories.
+
+        The primary key only rules out duplicates within one table, so adds
+        of a key hold an advisory lock on it while they check each table
+        and insert.
+
+        """
+
+        target = self.table_for_expiration(category, expiration)
+        conn = target.bind.connect()
+        try:
+            with conn.begin():
+                if conn.dialect.name == "postgresql":
+                    conn.execute(sa.select([sa.func.pg_advisory_xact_lock(
+                        _lock_key(category, ids))]))
+                tables = self.tables(category, "master")
+                rows = conn.execute(
+                    self._select_value(tables, category, ids)).fetchall()
+                row = self._latest(rows)
+                if row is not None:
+                    return self.tdb.db2py(row.value, row.kind)
+
+                conn.execute(target.insert(),
+                             category=category,
+                             ids=ids,
+                             value=value,
+                             kind=kind,
+                             expiration=expiration)
+                return value
+        finally:
+            conn.close()
+
     def incr(self, category, ids, time=0, delta=1):
         self.delete_if_expired(category, ids)
 
@@ -193,19 +356,24 @@ class HardCacheBackend(object):
 
         prof = self.profile_start('incr', category)
 
-        engine = self.engine_by_category(category, "master")
-
-        rp = engine.update(sa.and_(engine.c.category==category,
-                                   engine.c.ids==ids,
-                                   engine.c.kind=='num'),
-                           values = {
-                                   engine.c.value:
-                                           sa.cast(
-                                           sa.cast(engine.c.value, sa.Integer)
-                                           + delta, sa.String),
-                                   engine.c.expiration: expiration
-                                   }
-                           ).execute()
+        for engine in self.tables(category, "master"):
+            rp = engine.update(sa.and_(engine.c.category==category,
+                                       engine.c.ids==ids,
+                                       engine.c.kind=='num'),
+                               values = {
+                                       engine.c.value:
+                                               sa.cast(
+                                               sa.cast(engine.c.value, sa.Integer)
+                                               + delta, sa.String),
+                                       engine.c.expiration: expiration
+                                       }
+                               ).execute()
+            if rp.rowcount:
+                target = self.table_for_expiration(category, expiration)
+                if target is not engine:
+                    # its new expiration belongs in another partition
+                    self.move(engine, target, category, ids)
+                break
 
         self.profile_stop(prof)
 
@@ -228,67 +396,122 @@ class HardCacheBackend(object):
         else:
             type = "readslave"
 
-        engine = self.engine_by_category(category, type)
+        tables = self.tables(category, type)
 
         prof = self.profile_start('get', category)
 
-        s = sa.select([engine.c.value,
-                       engine.c.kind,
-                       engine.c.expiration],
-                      sa.and_(engine.c.category==category,
-                              engine.c.ids==ids),
-                      limit = 1)
-        rows = s.execute().fetchall()
+        rows = self._select_value(tables, category, ids).execute().fetchall()
 
         self.profile_stop(prof)
 
-        if len(rows) < 1:
-            return None
-        elif rows[0].expiration < datetime.now(TZ):
+        row = self._latest(rows)
+        if row is None:
             return None
         else:
-            return self.tdb.db2py(rows[0].value, rows[0].kind)
+            return self.tdb.db2py(row.value, row.kind)
+
+    def _select_value(self, tables, category, ids):
+        return _union([sa.select([engine.c.value,
+                                  engine.c.kind,
+                                  engine.c.expiration],
+                                 sa.and_(engine.c.category==category,
+                                         engine.c.ids==ids))
+                       for engine in tables],
+                      limit = len(tables))
+
+    def _latest(self, rows):
+        """Return the unexpired row that expires last, if any."""
+        now = datetime.now(TZ)
+        rows = [row for row in rows if row.expiration >= now]
+        if not rows:
+            return None
+        return max(rows, key=lambda row: row.expiration)
 
     def get_multi(self, category, idses):
-        prof = self.profile_start('get_multi', category)
+        return self.get_multi_by_category({category: idses})
 
-        engine = self.engine_by_category(category, "readslave")
+    def get_multi_by_category(self, idses_by_category):
+        """Get items of several categories, one query per database.
 
-        s = sa.select([engine.c.ids,
-                       engine.c.value,
-                       engine.c.kind,
-                       engine.c.expiration],
-                      sa.and_(engine.c.category==category,
-                              sa.or_(*[engine.c.ids==ids
-                                       for ids in idses])))
-        rows = s.execute().fetchall()
+        Returns a dict of {"category-ids": value}.
 
-        self.profile_stop(prof)
+        """
 
+        categories_by_engines = {}
+        for category in idses_by_category:
+            effective_category = category
+            if effective_category not in self.mapping:
+                effective_category = '*'
+            engines = tuple(self.mapping[effective_category])
+            categories_by_engines.setdefault(engines, []).append(category)
+
+        rows = []
+        for engines, categories in categories_by_engines.iteritems():
+            profs = [self.profile_start('get_multi', category)
+                     for category in categories]
+
+            tables = [random.choice(engines[1:])]
+            if any(self.is_partitioned(category) for category in categories):
+                tables.extend(self.partition(tables[0], bucket)
+                              for bucket in self.live_buckets())
+
+            s = _union([sa.select([engine.c.category,
+                                   engine.c.ids,
+                                   engine.c.value,
+                                   engine.c.kind,
+                                   engine.c.expiration],
+                                  sa.or_(*[sa.and_(
+                                        engine.c.category==category,
+                                        engine.c.ids.in_(
+                                            idses_by_category[category]))
+                                      for category in categories]))
+                        for engine in tables])
+            rows.extend(s.execute().fetchall())
+
+            for prof in profs:
+                self.profile_stop(prof)
+
+        now = datetime.now(TZ)
+        expirations = {}
         results = {}
 
         for row in rows:
-          if row.expiration >= datetime.now(TZ):
-              k = "%s-%s" % (category, row.ids)
+          k = "%s-%s" % (row.category, row.ids)
+          if row.expiration >= max(now, expirations.get(k, now)):
+              expirations[k] = row.expiration
               results[k] = self.tdb.db2py(row.value, row.kind)
 
         return results
 
     def delete(self, category, ids):
         prof = self.profile_start('delete', category)
-        engine = self.engine_by_category(category, "master")
-        engine.delete(
-            sa.and_(engine.c.category==category,
-                    engine.c.ids==ids)).execute()
+        for engine in self.tables(category, "master"):
+            engine.delete(
+                sa.and_(engine.c.category==category,
+                        engine.c.ids==ids)).execute()
         self.profile_stop(prof)
 
+    def move(self, source, target, category, ids):
+        """Move an item from one table to another (on the same database)."""
+        conn = source.bind.connect()
+        try:
+            with conn.begin():
+                key_clause = sa.and_(source.c.category==category,
+                                     source.c.ids==ids)
+                row = conn.execute(sa.select([source], key_clause)).first()
+                if row is not None:
+                    conn.execute(target.insert(), **dict(row.items()))
+                    conn.execute(source.delete(key_clause))
+        finally:
+            conn.close()
+
     def ids_by_category(self, category, limit=1000):
         prof = self.profile_start('ids_by_category', category)
-        engine = self.engine_by_category(category, "readslave")
-        s = sa.select([engine.c.ids],
-                      sa.and_(engine.c.category==category,
-                              engine.c.expiration > datetime.now(TZ)),
-                      limit = limit)
+        s = _union([sa.select([engine.c.ids],
+                              sa.and_(engine.c.category==category,
+                                      engine.c.expiration > datetime.now(TZ)))
+                    for engine in self.tables(category, "readslave")],
+                   limit = limit)
         rows = s.execute().fetchall()
         self.profile_stop(prof)
         return [ r.ids for r in rows ]
@@ -314,14 +537,32 @@ class HardCacheBackend(object):
 
     def delete_if_expired(self, category, ids, expiration="now"):
         prof = self.profile_start('delete_if_expired', category)
-        engine = self.engine_by_category(category, "master")
-        expiration_clause = self.clause_from_expiration(engine, expiration)
-        engine.delete(sa.and_(engine.c.category==category,
-                              engine.c.ids==ids,
-                              expiration_clause)).execute()
+        for engine in self.tables(category, "master"):
+            expiration_clause = self.clause_from_expiration(engine, expiration)
+            engine.delete(sa.and_(engine.c.category==category,
+                                  engine.c.ids==ids,
+                                  expiration_clause)).execute()
         self.profile_stop(prof)
 
 
+def _lock_key(category, ids):
+    """Return the advisory lock id (a signed 64 bit int) for an item."""
+    key = "%s-%s" % (category, ids)
+    if isinstance(key, unicode):
+        key = key.encode("utf-8")
+    return struct.unpack(">q", hashlib.md5(key).digest()[:8])[0]
+
+
+def _union(selects, limit=None):
+    if len(selects) == 1:
+        s = selects[0]
+    else:
+        s = sa.union_all(*selects)
+    if limit is not None:
+        s = s.limit(limit)
+    return s
+
+
 def delete_expired(expiration="now", limit=5000):
     # the following depends on the structure of g.hardcache not changing
     backend = g.hardcache.caches[1].backend
@@ -343,3 +584,8 @@ def delete_expired(expiration="now", limit=5000):
 
         # Delete from the backend.
         engine.delete(expiration_clause).execute()
+
+    if backend.partition_hours:
+        # items in partitioned categories expire a whole bucket at a time
+        backend.drop_expired_partitions()
+        backend.create_partitions()
@@ -25,6 +25,7 @@ import os
 import random
 import socket
 import sqlalchemy
+import threading
 import time
 import traceback
 
@@ -69,21 +70,86 @@ def get_engine(name, db_host='', db_user='', db_pass='', db_port='5432',
     return engine
 
 
-class db_manager:
+def engine_name(engine):
+    """Return "host.dbname" for an engine made by get_engine."""
+    try:
+        dsn = dict(part.split('=', 1)
+                   for part in engine.url.query['dsn'].split())
+        return '.'.join((dsn['host'].replace('.', '-'), dsn['dbname']))
+    except (AttributeError, KeyError, ValueError):
+        return str(engine)
+
+
+# replication lag in seconds, as the age of the last transaction the replica
+# replayed. a replica that has replayed everything it received can't tell if
+# it's lost its connection to the master, so this is used even then: an idle
+# master makes its replicas look behind rather than a stalled replica look
+# current.
+REPLICATION_LAG_QUERY = """
+SELECT CASE
+    WHEN NOT pg_is_in_recovery() THEN 0
+    ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+END
+"""
+
+
+class ReplicaHealth(object):
+    """The measured replication lag and query latency of an engine."""
+
     def __init__(self):
+        self.lag = 0.
+        self.lag_checked = None
+        self.latency = None
+        self.checking = threading.Lock()
+
+    def record_latency(self, seconds, alpha):
+        if self.latency is None:
+            self.latency = seconds
+        else:
+            self.latency += alpha * (seconds - self.latency)
+
+
+class db_manager:
+    def __init__(self, lag_check_interval=0, max_lag=30.,
+                 lag_check_timeout=0.25, latency_alpha=0.1,
+                 min_latency=0.001, stats=None, clock=time.time):
+        """Routing of reads to replicas.
+
+        Each replica's replication lag is queried at most once every
+        lag_check_interval seconds (0 disables lag and latency tracking,
+        picking among live replicas at random), and a replica whose lag
+        query takes more than lag_check_timeout seconds is treated as
+        lagging. Replicas more than max_lag seconds behind are only used if
+        nothing else is, the rest are weighted by the inverse of their
+        average query latency.
+
+        """
+
         self.type_db = None
         self.relation_type_db = None
         self._things = {}
         self._relations = {}
         self._engines = {}
         self.avoid_master_reads = {}
+        self.data_documents = {}
         self.dead = {}
 
-    def add_thing(self, name, thing_dbs, avoid_master=False, **kw):
+        self.lag_check_interval = lag_check_interval
+        self.max_lag = max_lag
+        self.lag_check_timeout = lag_check_timeout
+        self.latency_alpha = latency_alpha
+        self.min_latency = min_latency
+        self.stats = stats
+        self.clock = clock
+        self.health = {}
+
+    def add_thing(self, name, thing_dbs, avoid_master=False,
+                  data_documents=None, **kw):
         """thing_dbs is a list of database engines. the first in the
         list is assumed to be the master, the rest are slaves."""
         self._things[name] = thing_dbs
         self.avoid_master_reads[name] = avoid_master
+        self.data_documents[name] = data_documents
 
     def add_relation(self, name, type1, type2, relation_dbs,
                      avoid_master=False, **kw):
@@ -93,6 +159,8 @@ class db_manager:
     def setup_db(self, db_name, g_override=None, **params):
         engine = get_engine(g_override=g_override, **params)
         self._engines[db_name] = engine
+        if self.lag_check_interval:
+            self.track_latency(engine)
 
         if db_name not in ("email", "authorize", "hc", "traffic"):
             # test_engine creates a connection to the database, for some less
@@ -137,7 +205,163 @@ class db_manager:
     def get_engines(self, names):
         return [self._engines[name] for name in names if name in self._engines]
 
-    def get_read_table(self, tables):
-        if len(tables) == 1:
-            return tables[0]
-        return  random.choice(list(tables))
+    def track_latency(self, engine):
+        def before_cursor_execute(conn, cursor, statement, parameters,
+                                  context, executemany):
+            context._replica_query_start = self.clock()
+
+        def after_cursor_execute(conn, cursor, statement, parameters,
+                                 context, executemany):
+            start = getattr(context, "_replica_query_start", None)
+            if start is not None:
+                self.record_latency(engine, self.clock() - start)
+
+        sqlalchemy.event.listen(
+            engine, 'before_cursor_execute', before_cursor_execute)
+        sqlalchemy.event.listen(
+            engine, 'after_cursor_execute', after_cursor_execute)
+
+    def get_health(self, engine):
+        health = self.health.get(engine)
+        if health is None:
+            health = self.health.setdefault(engine, ReplicaHealth())
+        return health
+
+    def record_latency(self, engine, seconds):
+        self.get_health(engine).record_latency(seconds, self.latency_alpha)
+
+    def check_lag(self, engine):
+        """Return the engine's replication lag, querying it if it's stale.
+
+        Only one thread queries an engine at a time, the others use the lag
+        from the last check. The query runs on the request's thread, so it's
+        cut off after lag_check_timeout seconds rather than left to stall
+        the request behind a replica that's stuck (in a vacuum or backup,
+        say).
+
+        """
+
+        health = self.get_health(engine)
+        now = self.clock()
+        if (health.lag_checked is not None and
+                now - health.lag_checked < self.lag_check_interval):
+            return health.lag
+
+        if not health.checking.acquire(False):
+            return health.lag
+
+        try:
+            try:
+                lag = self._query_lag(engine)
+            except Exception:
+                logger.error("db_manager: lag check failed: %r", engine)
+                health.lag = float("inf")
+            else:
+                health.lag = max(float(lag or 0), 0.)
+                name = engine_name(engine)
+                self._timing("pg_replica.%s.lag" % name, health.lag)
+                if health.latency is not None:
+                    self._timing("pg_replica.%s.latency" % name,
+                                 health.latency)
+            health.lag_checked = now
+        finally:
+            health.checking.release()
+
+        return health.lag
+
+    def _query_lag(self, engine):
+        # a connection of its own, so SET LOCAL can't leak into the thread's
+        # transaction (engines use the threadlocal strategy)
+        conn = engine.connect()
+        try:
+            with conn.begin():
+                if self.lag_check_timeout:
+                    conn.execute("SET LOCAL statement_timeout = %d" %
+                                 max(int(self.lag_check_timeout * 1000), 1))
+                return conn.execute(REPLICATION_LAG_QUERY).scalar()
+        finally:
+            conn.close()
+
+    def replayed_since(self, engine, timestamp):
+        """Return whether the engine is known to have replayed timestamp.
+
+        The lag is as of the last check, which may be up to
+        lag_check_interval seconds ago.
+
+        """
+
+        health = self.get_health(engine)
+        return (health.lag_checked is not None and
+                health.lag_checked - health.lag >= timestamp)
+
+    def score(self, engine):
+        """Return the weight of an engine when picking a replica to read."""
+        latency = self.get_health(engine).latency or 0
+        return 1. / max(latency, self.min_latency)
+
+    def get_read_table(self, tables, master=None, last_write=None):
+        """Pick which of tables to read from.
+
+        tables is a list of table tuples (one per engine, the first element
+        of each bound to its engine). If the current user wrote to the
+        table at last_write (see write_tokens), only replicas that have caught up to
+        the write are candidates, with master (or the first of tables) used
+        if none have.
+
+        """
+
+        if master is None:
+            master = tables[0]
+
+        if not self.lag_check_interval:
+            if last_write is not None:
+                # without lag checks there's no telling if a replica has
+                # the user's write
+                self._count("fresh_master")
+                return master
+            elif len(tables) == 1:
+                return tables[0]
+            return random.choice(list(tables))
+
+        fresh_only = last_write is not None
+        lags = []
+        candidates = []
+        for table in tables:
+            engine = table[0].bind
+            lag = self.check_lag(engine)
+            lags.append((lag, table))
+            if lag > self.max_lag:
+                continue
+            if fresh_only and not self.replayed_since(engine, last_write):
+                continue
+            candidates.append(table)
+
+        if not candidates:
+            if fresh_only:
+                self._count("fresh_master")
+                return master
+            # everything is behind, the least bad is better than nothing
+            self._count("all_lagging")
+            lag, table = min(lags, key=lambda lag_table: lag_table[0])
+            return table
+
+        if len(candidates) == 1:
+            table = candidates[0]
+        else:
+            weights = [self.score(table[0].bind) for table in candidates]
+            pick = random.random() * sum(weights)
+            for table, weight in zip(candidates, weights):
+                pick -= weight
+                if pick < 0:
+                    break
+
+        self._count(engine_name(table[0].bind))
+        return table
+
+    def _count(self, name):
+        if self.stats:
+            self.stats.event_count("pg_replica.read", name)
+
+    def _timing(self, name, seconds):
+        if self.stats:
+            self.stats.simple_timing(name, seconds * 1000)
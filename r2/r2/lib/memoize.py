@@ -21,6 +21,9 @@
 ###############################################################################
 
 from hashlib import md5
+import math
+import random
+from time import time as unix_time
 
 from r2.lib.filters import _force_utf8
 from r2.lib.cache import NoneResult, make_key_id
@@ -28,36 +31,93 @@ from r2.lib.lock import make_lock_factory
 from pylons import app_globals as g
 
 
-def memoize(iden, time = 0, stale=False, timeout=30):
+def should_refresh_early(delta, expiry, beta=1.0, now=None):
+    """Decide whether to recompute a value before it expires.
+
+    This is the "XFetch" algorithm: the chance of an early refresh grows as
+    the value gets closer to expiring, and values that took longer to
+    compute (`delta` seconds) are refreshed earlier. With many concurrent
+    readers, about one of them recomputes the value shortly before it
+    expires while the rest keep using the cached copy. Larger `beta` values
+    favor earlier refreshes.
+
+    """
+
+    now = now or unix_time()
+    # 1 - random() is in (0, 1] so the log is always defined
+    return now - delta * beta * math.log(1 - random.random()) >= expiry
+
+
+def memoize(iden, time = 0, stale=False, timeout=30, early_refresh=False,
+            beta=1.0):
+    """Cache the results of the decorated function for `time` seconds.
+
+    By default a cache miss is recomputed under a lock so that only one
+    caller does the work while the others wait up to `timeout` seconds for
+    it. With `early_refresh`, the time it took to compute the value and its
+    expiration are stored next to it and callers probabilistically refresh
+    it before it expires (see should_refresh_early) without taking the
+    lock, so hot values are never missing. The lock is then only used when
+    the value isn't cached at all.
+
+    """
+
+    if early_refresh and not time:
+        raise ValueError("early_refresh needs an expiration time")
+
     def memoize_fn(fn):
         from r2.lib.memoize import NoneResult
+
+        def calculate(key, *a, **kw):
+            start = unix_time()
+            res = fn(*a, **kw)
+            if res is None:
+                res = NoneResult
+
+            if early_refresh:
+                end = unix_time()
+                stored = (res, end - start, end + time)
+            else:
+                stored = res
+            g.memoizecache.set(key, stored, time=time)
+            return res
+
+        def unpack(stored):
+            if stored is not None and early_refresh:
+                return stored[0]
+            return stored
+
         def new_fn(*a, **kw):
 
             #if the keyword param _update == True, the cache will be
             #overwritten no matter what
             update = kw.pop('_update', False)
 
-            key = "memo:%s:%s" % (iden, make_key_id(*a, **kw))
+            key_format = "memo:xf:%s:%s" if early_refresh else "memo:%s:%s"
+            key = key_format % (iden, make_key_id(*a, **kw))
 
-            res = None if update else g.memoizecache.get(key, stale=stale)
+            stored = None if update else g.memoizecache.get(key, stale=stale)
+            res = unpack(stored)
 
-            if res is None:
+            if res is not None and early_refresh:
+                _, delta, expiry = stored
+                if should_refresh_early(delta, expiry, beta):
+                    g.stats.simple_event("memoize.early_refresh")
+                    res = calculate(key, *a, **kw)
+            elif res is None:
                 # not cached, we should calculate it.
                 with g.make_lock("memoize", 'memoize_lock(%s)' % key,
                                  time=timeout, timeout=timeout):
 
                     # see if it was completed while we were waiting
                     # for the lock
-                    stored = None if update else g.memoizecache.get(key)
+                    stored = None if update else unpack(g.memoizecache.get(key))
                     if stored is not None:
                         # it was calculated while we were waiting
                         res = stored
                     else:
                         # okay now go and actually calculate it
-                        res = fn(*a, **kw)
-                        if res is None:
-                            res = NoneResult
-                        g.memoizecache.set(key, res, time=time)
+                        res = calculate(key, *a, **kw)
 
             if res == NoneResult:
                 res = None
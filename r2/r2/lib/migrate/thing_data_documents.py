@@ -0,0 +1,133 @@
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of
+# the Original Code is reddit Inc.
+#
+# All portions of the code written by reddit are Copyright (c) 2006-2016 reddit
+# Inc. All Rights Reserved.
+
+"""Backfill the document tables of thing types using !data_documents.
+
+The types must already have "!data_documents=write" set everywhere so that
+things modified during the backfill keep their documents up to date. Once
+the backfill (and optionally verify_documents) has finished the type can be
+switched to "!data_documents=read".
+
+    paster run run.ini r2/lib/migrate/thing_data_documents.py \\
+        -c "backfill_documents(Link)"
+
+"""
+
+import time
+
+import sqlalchemy as sa
+from pylons import app_globals as g
+
+from r2.lib.db import tdb_sql
+from r2.lib.utils import to36
+
+
+def _master_tables(cls):
+    info = tdb_sql.types_id[cls._type_id]
+    if not info.data_documents:
+        raise ValueError("%s doesn't have data_documents enabled" %
+                         cls.__name__)
+    return tdb_sql.get_write_table(info.tables)
+
+
+def _iter_id_chunks(thing_table, start_id, chunk_size):
+    last_id = start_id
+    while True:
+        q = sa.select([thing_table.c.thing_id],
+                      thing_table.c.thing_id > last_id,
+                      order_by=thing_table.c.thing_id,
+                      limit=chunk_size)
+        thing_ids = [row.thing_id for row in q.execute()]
+        if not thing_ids:
+            return
+        yield thing_ids
+        last_id = thing_ids[-1]
+
+
+def _ids_with_documents(document_table, thing_ids):
+    q = sa.select([document_table.c.thing_id],
+                  document_table.c.thing_id.in_(thing_ids))
+    return {row.thing_id for row in q.execute()}
+
+
+def backfill_documents(cls, start_id=0, chunk_size=500, sleep_time=0):
+    """Write a document for each thing of type cls that doesn't have one.
+
+    Each document is only inserted, never updated, and the insert is made
+    holding the thing's commit lock. A thing modified after its data was
+    read will already have a document written by the modification, so the
+    stale insert fails and is skipped.
+
+    """
+
+    thing_table, data_table, document_table = _master_tables(cls)
+    written = skipped = 0
+
+    for thing_ids in _iter_id_chunks(thing_table, start_id, chunk_size):
+        existing = _ids_with_documents(document_table, thing_ids)
+        skipped += len(existing)
+        todo = [_id for _id in thing_ids if _id not in existing]
+        data_by_id = tdb_sql.get_data(data_table, todo) if todo else {}
+
+        for _id in todo:
+            fullname = cls._fullname_from_id36(to36(_id))
+            with g.make_lock("thing_commit", "commit_" + fullname):
+                try:
+                    document_table.insert().execute(
+                        thing_id=_id,
+                        data=tdb_sql.dump_document(data_by_id.get(_id, {})),
+                    )
+                except sa.exc.IntegrityError:
+                    skipped += 1
+                else:
+                    written += 1
+
+        print "%s: up to %d, %d written, %d already written" % (
+            cls.__name__, thing_ids[-1], written, skipped)
+
+        if sleep_time:
+            time.sleep(sleep_time)
+
+
+def verify_documents(cls, start_id=0, chunk_size=500):
+    """Compare documents with the data table and print any that differ."""
+
+    thing_table, data_table, document_table = _master_tables(cls)
+    mismatched = []
+
+    for thing_ids in _iter_id_chunks(thing_table, start_id, chunk_size):
+        data_by_id = tdb_sql.get_data(data_table, thing_ids)
+        q = sa.select([document_table],
+                      document_table.c.thing_id.in_(thing_ids))
+        documents_by_id = {row.thing_id: tdb_sql.load_document(row.data)
+                           for row in q.execute()}
+
+        for _id in thing_ids:
+            if _id not in documents_by_id:
+                print "%s %d: no document" % (cls.__name__, _id)
+                mismatched.append(_id)
+            elif documents_by_id[_id] != data_by_id.get(_id, {}):
+                print "%s %d: document doesn't match data" % (
+                    cls.__name__, _id)
+                mismatched.append(_id)
+
+    print "%s: %d mismatched" % (cls.__name__, len(mismatched))
+    return mismatched
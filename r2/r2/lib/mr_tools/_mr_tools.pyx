@@ -139,6 +139,14 @@ cpdef mr_map(process, fd = stdin):
         for res in process(vals):
             emit(res)
 
+cpdef mr_map_chunks(process, int chunk_size = 1000, fd = stdin):
+    """like mr_map, but passes `process` lists of up to chunk_size
+       split lines so that it can work on them in batches"""
+    for lines in in_chunks(fd, chunk_size):
+        chunk = [line.strip('\n').split('\t') for line in lines]
+        for res in process(chunk):
+            emit(res)
+
 cpdef mr_reduce(process, fd = stdin):
     for key, vals in keyiter(fd):
         for res in process(key, vals):
@@ -26,9 +26,10 @@
 # list. I'll call it a feature.
 
 import sys
+from itertools import izip
 
 from r2.models import Link, Comment
-from r2.lib.db.sorts import epoch_seconds, score, controversy
+from r2.lib.db.sorts import epoch_seconds, batch_score, batch_controversy
 from r2.lib.db import queries
 from r2.lib import mr_tools
 from r2.lib.utils import timeago, UrlParser
@@ -70,47 +71,60 @@ def _get_cutoffs(intervals):
 def time_listings(intervals, thing_type):
     cutoff_by_interval = _get_cutoffs(intervals)
 
-    @mr_tools.dataspec_m_thing(*data_fields_by_name[thing_type].items())
-    def process(thing):
-        if thing.deleted:
-            return
+    parse_thing = mr_tools.dataspec_m_thing(
+        *data_fields_by_name[thing_type].items())(lambda thing: thing)
 
-        thing_cls = thingcls_by_name[thing.thing_type]
-        fname = make_fullname(thing_cls, thing.thing_id)
-        thing_score = score(thing.ups, thing.downs)
-        thing_controversy = controversy(thing.ups, thing.downs)
+    def process(chunk):
+        things = [thing for thing in map(parse_thing, chunk)
+                  if not thing.deleted]
+        ups = [thing.ups for thing in things]
+        downs = [thing.downs for thing in things]
+        scores = batch_score(ups, downs)
+        controversies = batch_controversy(ups, downs)
 
-        for interval, cutoff in cutoff_by_interval.iteritems():
-            if thing.timestamp < cutoff:
-                continue
+        for thing, thing_score, thing_controversy in izip(
+                things, scores, controversies):
+            for result in _thing_listings(
+                    thing, thing_score, thing_controversy, cutoff_by_interval):
+                yield result
+
+    mr_tools.mr_map_chunks(process)
 
-            yield ("user/%s/top/%s/%d" % (thing.thing_type, interval, thing.author_id),
-                   thing_score, thing.timestamp, fname)
-            yield ("user/%s/controversial/%s/%d" % (thing.thing_type, interval, thing.author_id),
-                   thing_controversy, thing.timestamp, fname)
 
-            if thing.spam:
-                continue
+def _thing_listings(thing, thing_score, thing_controversy,
+                    cutoff_by_interval):
+    thing_cls = thingcls_by_name[thing.thing_type]
+    fname = make_fullname(thing_cls, thing.thing_id)
 
-            if thing.thing_type == "link":
-                yield ("sr/link/top/%s/%d" % (interval, thing.sr_id),
-                       thing_score, thing.timestamp, fname)
-                yield ("sr/link/controversial/%s/%d" % (interval, thing.sr_id),
-                       thing_controversy, thing.timestamp, fname)
+    for interval, cutoff in cutoff_by_interval.iteritems():
+        if thing.timestamp < cutoff:
+            continue
 
-                if thing.url:
-                    try:
-                        parsed = UrlParser(thing.url)
-                    except ValueError:
-                        continue
+        yield ("user/%s/top/%s/%d" % (thing.thing_type, interval, thing.author_id),
+               thing_score, thing.timestamp, fname)
+        yield ("user/%s/controversial/%s/%d" % (thing.thing_type, interval, thing.author_id),
+               thing_controversy, thing.timestamp, fname)
 
-                    for domain in parsed.domain_permutations():
-                        yield ("domain/link/top/%s/%s" % (interval, domain),
-                               thing_score, thing.timestamp, fname)
-                        yield ("domain/link/controversial/%s/%s" % (interval, domain),
-                               thing_controversy, thing.timestamp, fname)
+        if thing.spam:
+            continue
+
+        if thing.thing_type == "link":
+            yield ("sr/link/top/%s/%d" % (interval, thing.sr_id),
+                   thing_score, thing.timestamp, fname)
+            yield ("sr/link/controversial/%s/%d" % (interval, thing.sr_id),
+                   thing_controversy, thing.timestamp, fname)
 
-    mr_tools.mr_map(process)
+            if thing.url:
+                try:
+                    parsed = UrlParser(thing.url)
+                except ValueError:
+                    continue
+
+                for domain in parsed.domain_permutations():
+                    yield ("domain/link/top/%s/%s" % (interval, domain),
+                           thing_score, thing.timestamp, fname)
+                    yield ("domain/link/controversial/%s/%s" % (interval, domain),
+                           thing_controversy, thing.timestamp, fname)
 
 
 def store_keys(key, maxes):
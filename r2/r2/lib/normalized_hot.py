@@ -20,14 +20,20 @@
 # Inc. All Rights Reserved.
 ###############################################################################
 
+import hashlib
 import heapq
 import itertools
+import time
 from datetime import datetime, timedelta
 
 from pylons import app_globals as g
 
 from r2.config import feature
-from r2.lib.db.queries import _get_links, CachedResults
+from r2.lib.db.queries import (
+    _get_links,
+    CachedResults,
+    hot_links_version_key,
+)
 from r2.lib.db.sorts import epoch_seconds
 
 
@@ -35,13 +41,14 @@ MAX_PER_SUBREDDIT = 150
 MAX_LINKS = 1000
 
 
-def get_hot_tuples(sr_ids, ageweight=None):
+def get_hot_tuples(sr_ids, ageweight=None, now_seconds=None):
     queries_by_sr_id = {sr_id: _get_links(sr_id, sort='hot', time='all')
                         for sr_id in sr_ids}
     CachedResults.fetch_multi(queries_by_sr_id.values(), stale=True)
     tuples_by_srid = {sr_id: [] for sr_id in sr_ids}
 
-    now_seconds = epoch_seconds(datetime.now(g.tz))
+    if now_seconds is None:
+        now_seconds = epoch_seconds(datetime.now(g.tz))
 
     for sr_id, q in queries_by_sr_id.iteritems():
         if not q.data:
@@ -54,7 +61,7 @@ def get_hot_tuples(sr_ids, ageweight=None):
             # heapq.merge sorts from smallest to largest so we need to flip
             # ehot and hot to get the hottest links first
             tuples_by_srid[sr_id].append(
-                (-effective_hot, -hot, link_name, timestamp)
+                (-effective_hot, -hot, link_name, timestamp, sr_id)
             )
 
     return tuples_by_srid
@@ -79,6 +86,85 @@ def get_hot_factor(qdata, now, ageweight):
     return max(hot + ((now - timestamp) * ageweight) / 45000.0, 1.0)
 
 
+def merge_hot_tuples(tuple_lists, oldest):
+    merged = heapq.merge(*tuple_lists)
+    generator = (t for t in merged if t[3] > oldest)
+    return list(itertools.islice(generator, MAX_LINKS))
+
+
+def _cache_key(sr_ids, obey_age_limit, ageweight):
+    key = "%s:%s:%s" % (",".join(str(sr_id) for sr_id in sorted(sr_ids)),
+                        obey_age_limit, ageweight)
+    return "normalized_hot_" + hashlib.sha1(key).hexdigest()
+
+
+def get_merged_hot_tuples(sr_ids, oldest, obey_age_limit, ageweight):
+    """Return the merged hot tuples, materialized for sets of subreddits.
+
+    The merged listing for a set of subreddits is cached and shared by
+    everyone looking at that set.  It notes the version of each subreddit's
+    hot listing it was built from, and when some have changed since, only
+    those subreddits' tuples are replaced.  Links from unchanged subreddits
+    that were below the cut are not brought back by that, so the whole thing
+    is rebuilt at least every normalized_hot_cache_time seconds.
+
+    Votes change the versions all the time, so the replacing is done at most
+    every normalized_hot_refresh_interval seconds.  The replaced tuples are
+    scored (see get_hot_factor) as of when the listing was built so that
+    they can be compared with the rest.
+
+    """
+
+    cache_time = g.normalized_hot_cache_time
+    if not cache_time or len(sr_ids) < 2:
+        tuples_by_srid = get_hot_tuples(sr_ids, ageweight=ageweight)
+        return merge_hot_tuples(tuples_by_srid.values(), oldest)
+
+    key = _cache_key(sr_ids, obey_age_limit, ageweight)
+    version_keys = {hot_links_version_key(sr_id): sr_id for sr_id in sr_ids}
+    cached = g.gencache.get_multi(version_keys.keys() + [key])
+    versions = {sr_id: cached.get(version_key)
+                for version_key, sr_id in version_keys.iteritems()}
+    materialized = cached.get(key)
+
+    now = time.time()
+    if materialized:
+        changed = {sr_id for sr_id in sr_ids
+                   if versions[sr_id] != materialized["versions"].get(sr_id)}
+        if not changed:
+            g.stats.simple_event("normalized_hot.cache.hit")
+            return [t for t in materialized["tuples"] if t[3] > oldest]
+
+        refresh_interval = g.normalized_hot_refresh_interval
+        if now - materialized["refreshed"] < refresh_interval:
+            g.stats.simple_event("normalized_hot.cache.deferred")
+            return [t for t in materialized["tuples"] if t[3] > oldest]
+
+        g.stats.simple_event("normalized_hot.cache.partial")
+        now_seconds = materialized["now_seconds"]
+        unchanged = [t for t in materialized["tuples"] if t[4] not in changed]
+        tuples_by_srid = get_hot_tuples(
+            changed, ageweight=ageweight, now_seconds=now_seconds)
+        tuples = merge_hot_tuples([unchanged] + tuples_by_srid.values(),
+                                  oldest)
+        time_left = max(int(materialized["expires"] - now), 1)
+        expires = materialized["expires"]
+    else:
+        g.stats.simple_event("normalized_hot.cache.miss")
+        now_seconds = epoch_seconds(datetime.now(g.tz))
+        tuples_by_srid = get_hot_tuples(
+            sr_ids, ageweight=ageweight, now_seconds=now_seconds)
+        tuples = merge_hot_tuples(tuples_by_srid.values(), oldest)
+        time_left = cache_time
+        expires = now + cache_time
+
+    materialized = {"versions": versions, "tuples": tuples,
+                    "expires": expires, "refreshed": now,
+                    "now_seconds": now_seconds}
+    g.gencache.set(key, materialized, time=time_left)
+    return tuples
+
+
 def normalized_hot(sr_ids, obey_age_limit=True, ageweight=None):
     timer = g.stats.get_timer("normalized_hot")
     timer.start()
@@ -89,17 +175,13 @@ def normalized_hot(sr_ids, obey_age_limit=True, ageweight=None):
     if not feature.is_enabled("scaled_normalized_hot"):
         ageweight = None
 
-    tuples_by_srid = get_hot_tuples(sr_ids, ageweight=ageweight)
-
     if obey_age_limit:
         cutoff = datetime.now(g.tz) - timedelta(days=g.HOT_PAGE_AGE)
         oldest = epoch_seconds(cutoff)
     else:
         oldest = 0.
 
-    merged = heapq.merge(*tuples_by_srid.values())
-    generator = (link_name for ehot, hot, link_name, timestamp in merged
-                           if timestamp > oldest)
-    ret = list(itertools.islice(generator, MAX_LINKS))
+    tuples = get_merged_hot_tuples(sr_ids, oldest, obey_age_limit, ageweight)
+    ret = [t[2] for t in tuples]
     timer.stop()
     return ret
@@ -715,7 +715,11 @@ def _rebuild_link_index(start_at=None, sleeptime=1, cls=Link,
         assert isinstance(after, cls)
         q._after(after)
 
-    q = r2utils.fetch_things2(q, chunk_size=chunk_size)
+    def checkpoint(thing):
+        print "last updated %s" % thing._fullname
+
+    q = r2utils.stream_things(q, batch_size=chunk_size,
+                              checkpoint_fn=checkpoint)
     q = r2utils.progress(q, verbosity=1000, estimate=estimate, persec=True,
                          key=_progress_key)
     for chunk in r2utils.in_chunks(q, size=chunk_size):
@@ -732,8 +736,6 @@ def _rebuild_link_index(start_at=None, sleeptime=1, cls=Link,
                 break
         else:
             raise err
-        last_update = chunk[-1]
-        print "last updated %s" % last_update._fullname
         time.sleep(sleeptime)
 
 
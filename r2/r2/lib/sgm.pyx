@@ -20,7 +20,7 @@
 # Inc. All Rights Reserved.
 ###############################################################################
 
-from r2.lib.cache import MemcachedError
+from r2.lib.cache import MemcachedError, load_coalesced
 
 
 # smart get multi:
@@ -32,8 +32,6 @@ def sgm(cache, keys, miss_fn, str prefix='', int time=0, stale=False,
     cdef dict ret
     cdef dict s_keys
     cdef dict cached
-    cdef dict calculated
-    cdef dict calculated_to_cache
     cdef set  still_need
 
     ret = {}
@@ -71,18 +69,24 @@ def sgm(cache, keys, miss_fn, str prefix='', int time=0, stale=False,
     if miss_fn and still_need:
         # if we didn't get all of the keys from the cache, go to the
         # miss_fn with the keys they asked for minus the ones that we
-        # found
-        calculated = miss_fn(still_need)
-        ret.update(calculated)
+        # found. if the cache coalesces loads, concurrent callers missing
+        # on the same keys will wait for this to finish instead.
+        def load(keys):
+            calculated = miss_fn(set(keys))
+
+            calculated_to_cache = {}
+            for k, v in calculated.iteritems():
+                calculated_to_cache[str(k)] = v
 
-        calculated_to_cache = {}
-        for k, v in calculated.iteritems():
-            calculated_to_cache[str(k)] = v
+            try:
+                cache.set_multi(calculated_to_cache, prefix=prefix, time=time)
+            except MemcachedError:
+                if not ignore_set_errors:
+                    raise
 
-        try:
-            cache.set_multi(calculated_to_cache, prefix=prefix, time=time)
-        except MemcachedError:
-            if not ignore_set_errors:
-                raise
+            return calculated
+
+        calculated = load_coalesced(cache, still_need, load, prefix=prefix)
+        ret.update(calculated)
 
     return ret
@@ -447,6 +447,14 @@ class CacheStats:
         self.hit_stat_template = '%s.%%s.hit' % self.cache_name
         self.miss_stat_template = '%s.%%s.miss' % self.cache_name
         self.total_stat_template = '%s.%%s.total' % self.cache_name
+        self.eviction_stat_name = '%s.local.evict' % self.cache_name
+        self.eviction_stat_template = '%s.local.evict.%%s' % self.cache_name
+        self.backend_load_stat_name = '%s.singleflight.backend' % self.cache_name
+        self.coalesced_stat_name = '%s.singleflight.coalesced' % self.cache_name
+        self.cas_mutate_stat_name = '%s.cas.mutate' % self.cache_name
+        self.cas_retry_stat_name = '%s.cas.retry' % self.cache_name
+        self.cas_exhausted_stat_name = '%s.cas.exhausted' % self.cache_name
+        self.backend_timer_name = 'cache.%s.backend' % self.cache_name
 
     def cache_hit(self, delta=1, subname=None):
         if delta:
@@ -474,6 +482,38 @@ class CacheStats:
                 })
             self.parent.cache_count_multi(data)
 
+    def cache_eviction(self, delta=1, reason=None):
+        if delta:
+            data = {self.eviction_stat_name: delta}
+            if reason:
+                data[self.eviction_stat_template % reason] = delta
+            self.parent.cache_count_multi(data)
+
+    def single_flight(self, loaded=0, coalesced=0):
+        """Count keys loaded from the backend vs. served by another load."""
+        data = {}
+        if loaded:
+            data[self.backend_load_stat_name] = loaded
+        if coalesced:
+            data[self.coalesced_stat_name] = coalesced
+        if data:
+            self.parent.cache_count_multi(data)
+
+    def backend_timing(self, backend, start, end):
+        """Record how long one of the chain's backends took to respond."""
+        publish = random.random() < self.parent.CACHE_SAMPLE_RATE
+        timer = self.parent.get_timer(self.backend_timer_name, publish)
+        timer.send(backend, start, end)
+
+    def cas_mutation(self, retries=0, exhausted=False):
+        """Count an optimistic mutation and how often it had to retry."""
+        data = {self.cas_mutate_stat_name: 1}
+        if retries:
+            data[self.cas_retry_stat_name] = retries
+        if exhausted:
+            data[self.cas_exhausted_stat_name] = 1
+        self.parent.cache_count_multi(data)
+
 
 class StaleCacheStats(CacheStats):
     def __init__(self, parent, cache_name):
@@ -1050,6 +1050,31 @@ def fetch_things2(query, chunk_size = 100, batch_fn = None, chunks = False):
             items = list(query)
 
 
+def stream_things(query, batch_size=1000, chunks=False, checkpoint_fn=None,
+                  use_cache=False):
+    """Iterate over all of query's things with a few server-side cursors.
+
+    A faster fetch_things2 for scans of whole tables (see Things._stream).
+    Things are read from the db rather than the cache unless use_cache is
+    set. checkpoint_fn is called with the last thing of each batch once
+    the batch has been processed, so a scan can be resumed by applying
+    _after(thing) to the query.
+
+    """
+
+    assert query._sort, "you must specify the sort order in your query!"
+
+    for things in query._stream(batch_size, use_cache=use_cache):
+        if chunks:
+            yield things
+        else:
+            for thing in things:
+                yield thing
+
+        if checkpoint_fn:
+            checkpoint_fn(things[-1])
+
+
 def exponential_retrier(func_to_retry,
                         exception_filter=lambda *args, **kw: True,
                         retry_min_wait_ms=500,
@@ -194,6 +194,11 @@ def add_to_author_query_q(link):
 
 
 def consume_author_query_queue(qname="author_query_q", limit=1000):
+    from r2.lib.db.queries import CoalescingQueryMutator
+
+    mutator = CoalescingQueryMutator(
+        qname, timer="link_vote_processor.author_queries")
+
     @g.stats.amqp_processor(qname)
     def process_message(msgs, chan):
         """Update get_submitted(), the Links by author precomputed query.
@@ -206,7 +211,7 @@ def consume_author_query_queue(qname="author_query_q", limit=1000):
 
         """
 
-        from r2.lib.db.queries import add_queries, get_submitted
+        from r2.lib.db.queries import get_submitted
 
         link_names = {msg.body for msg in msgs}
         links = Link._by_fullname(link_names, return_dict=False)
@@ -219,15 +224,16 @@ def consume_author_query_queue(qname="author_query_q", limit=1000):
         authors_by_id = Account._byID(links_by_author_id.keys())
 
         for author_id, links in links_by_author_id.iteritems():
-            with g.stats.get_timer("link_vote_processor.author_queries"):
-                author = authors_by_id[author_id]
-                add_queries(
-                    queries=[
-                        get_submitted(author, sort, 'all') for sort in SORTS],
-                    insert_items=links,
-                )
+            author = authors_by_id[author_id]
+            mutator.add_queries(
+                queries=[get_submitted(author, sort, 'all') for sort in SORTS],
+                insert_items=links,
+            )
 
-    amqp.handle_items(qname, process_message, limit=limit)
+        mutator.flush_if_due(chan)
+
+    amqp.handle_items(qname, process_message, limit=limit, ack=False,
+                      idle_fn=mutator.flush)
 
 
 def add_to_subreddit_query_q(link):
@@ -240,6 +246,11 @@ def add_to_subreddit_query_q(link):
 
 
 def consume_subreddit_query_queue(qname="subreddit_query_q", limit=1000):
+    from r2.lib.db.queries import CoalescingQueryMutator
+
+    mutator = CoalescingQueryMutator(
+        qname, timer="link_vote_processor.subreddit_queries")
+
     @g.stats.amqp_processor(qname)
     def process_message(msgs, chan):
         """Update get_links(), the Links by Subreddit precomputed query.
@@ -252,7 +263,7 @@ def consume_subreddit_query_queue(qname="subreddit_query_q", limit=1000):
 
         """
 
-        from r2.lib.db.queries import add_queries, get_links
+        from r2.lib.db.queries import get_links
 
         link_names = {msg.body for msg in msgs}
         links = Link._by_fullname(link_names, return_dict=False)
@@ -265,14 +276,16 @@ def consume_subreddit_query_queue(qname="subreddit_query_q", limit=1000):
         srs_by_id = Subreddit._byID(links_by_sr_id.keys(), stale=True)
 
         for sr_id, links in links_by_sr_id.iteritems():
-            with g.stats.get_timer("link_vote_processor.subreddit_queries"):
-                sr = srs_by_id[sr_id]
-                add_queries(
-                    queries=[get_links(sr, sort, "all") for sort in SORTS],
-                    insert_items=links,
-                )
+            sr = srs_by_id[sr_id]
+            mutator.add_queries(
+                queries=[get_links(sr, sort, "all") for sort in SORTS],
+                insert_items=links,
+            )
+
+        mutator.flush_if_due(chan)
 
-    amqp.handle_items(qname, process_message, limit=limit)
+    amqp.handle_items(qname, process_message, limit=limit, ack=False,
+                      idle_fn=mutator.flush)
 
 
 def add_to_domain_query_q(link):
@@ -290,6 +303,11 @@ def add_to_domain_query_q(link):
 
 
 def consume_domain_query_queue(qname="domain_query_q", limit=1000):
+    from r2.lib.db.queries import CoalescingQueryMutator
+
+    mutator = CoalescingQueryMutator(
+        qname, timer="link_vote_processor.domain_queries")
+
     @g.stats.amqp_processor(qname)
     def process_message(msgs, chan):
         """Update get_domain_links(), the Links by domain precomputed query.
@@ -302,7 +320,7 @@ def consume_domain_query_queue(qname="domain_query_q", limit=1000):
 
         """
 
-        from r2.lib.db.queries import add_queries, get_domain_links
+        from r2.lib.db.queries import get_domain_links
 
         link_names = {msg.body for msg in msgs}
         links = Link._by_fullname(link_names, return_dict=False)
@@ -317,14 +335,15 @@ def consume_domain_query_queue(qname="domain_query_q", limit=1000):
                 links_by_domain[domain].append(link)
 
         for d, links in links_by_domain.iteritems():
-            with g.stats.get_timer("link_vote_processor.domain_queries"):
-                add_queries(
-                    queries=[
-                        get_domain_links(d, sort, "all") for sort in SORTS],
-                    insert_items=links,
-                )
+            mutator.add_queries(
+                queries=[get_domain_links(d, sort, "all") for sort in SORTS],
+                insert_items=links,
+            )
+
+        mutator.flush_if_due(chan)
 
-    amqp.handle_items(qname, process_message, limit=limit)
+    amqp.handle_items(qname, process_message, limit=limit, ack=False,
+                      idle_fn=mutator.flush)
 
 
 def consume_comment_vote_queue(qname="vote_comment_q"):
@@ -73,6 +73,7 @@ class Account(Thing):
                                                'admin_takedown_strikes',
                                               )
     _int_prop_suffix = '_karma'
+    _buffered_incr_suffix = '_karma'
     _essentials = ('name', )
     _defaults = dict(pref_numsites = 25,
                      pref_newwindow = False,
@@ -932,6 +933,7 @@ def register(name, password, registration_ip):
 
 class Friend(Relation(Account, Account)):
     _cache = g.thingcache
+    _negative_filter = True
 
     @classmethod
     def _cache_prefix(cls):
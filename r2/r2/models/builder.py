@@ -20,10 +20,11 @@
 # Inc. All Rights Reserved.
 ###############################################################################
 
-from collections import defaultdict, namedtuple
+from collections import defaultdict, namedtuple, Iterator
 from copy import deepcopy
 import datetime
 import heapq
+import itertools
 from random import shuffle
 import time
 
@@ -60,6 +61,7 @@ from r2.models import (
     Account,
     Comment,
     CommentSavesByAccount,
+    CommentScoresByLink,
     Link,
     LinkSavesByAccount,
     Message,
@@ -540,10 +542,16 @@ class IDBuilder(QueryBuilder):
                                   stale=self.stale)
 
     def init_query(self):
-        names = list(tup(self.query))
-
         after = self.after._fullname if self.after else None
 
+        # merged queries can find the names after `after` without building
+        # the whole listing, so only take as many of those as we need
+        if hasattr(self.query, "iter_after"):
+            self.names = self.query.iter_after(after, self.reverse)
+            return
+
+        names = list(tup(self.query))
+
         self.names = self._get_after(names,
                                      after,
                                      self.reverse)
@@ -577,10 +585,15 @@ class IDBuilder(QueryBuilder):
                     last_item = None
                 slice_size = max(int(num_need * EXTRA_FACTOR), self.num // 2, 1)
         else:
-            slice_size = len(names)
+            slice_size = None
             done = True
 
-        self.names, new_names = names[slice_size:], names[:slice_size]
+        if isinstance(names, Iterator):
+            new_names = list(itertools.islice(names, slice_size))
+        else:
+            if slice_size is None:
+                slice_size = len(names)
+            self.names, new_names = names[slice_size:], names[:slice_size]
         new_items = self.thing_lookup(new_names)
         return done, new_items
 
@@ -1206,12 +1219,21 @@ def write_comment_orders(link):
     # process will be timed by the caller
     timer = SimpleSillyStub()
 
-    precomputed_sorts = set()
-    for sort_name in get_active_sort_orders_for_link(link):
-        sort = SORT_OPERATOR_BY_NAME.get(sort_name)
-        if not sort:
-            continue
+    sorts_by_name = {
+        sort_name: SORT_OPERATOR_BY_NAME[sort_name]
+        for sort_name in get_active_sort_orders_for_link(link)
+        if sort_name in SORT_OPERATOR_BY_NAME
+    }
 
+    # read the scores for all the sorts at once, the orderers then find
+    # them in the request-local cache
+    score_cols = {sort.col for sort in sorts_by_name.itervalues()
+                  if sort.col != "_date"}
+    if score_cols:
+        CommentScoresByLink.get_scores_multi(link, score_cols)
+
+    precomputed_sorts = set()
+    for sort_name, sort in sorts_by_name.iteritems():
         if sort_name == "qa":
             QACommentOrderer.write_cache(link, sort, timer)
         else:
@@ -1536,6 +1558,9 @@ class CommentBuilder(Builder):
         return final
 
     def make_wrapped_items(self, comment_tuples):
+        # Comment.add_props looks up the link's author, get it along with
+        # the comment authors looked up by wrap_items
+        Account._prefetch(self.link.author_id)
         wrapped = Builder.wrap_items(self, self.comments)
         wrapped_by_id = {comment._id: comment for comment in wrapped}
 
@@ -106,6 +106,7 @@ class Link(Thing, Printable):
     _cache = g.thingcache
     _data_int_props = Thing._data_int_props + (
         'num_comments', 'reported', 'gildings')
+    _buffered_incr_props = ('_ups', '_downs', 'num_comments')
     _defaults = dict(is_self=False,
                      suggested_sort=None,
                      over_18=False,
@@ -611,23 +612,26 @@ class Link(Thing, Printable):
 
         if user_is_loggedin:
             gilded = [thing for thing in wrapped if thing.gildings > 0]
-            try:
-                user_gildings = GildedLinksByAccount.fast_query(user, gilded)
-            except tdb_cassandra.TRANSIENT_EXCEPTIONS as e:
-                g.log.warning("Cassandra gilding lookup failed: %r", e)
-                user_gildings = {}
-
-            try:
-                saved = LinkSavesByAccount.fast_query(user, wrapped)
-                hidden = LinkHidesByAccount.fast_query(user, wrapped)
-
-                if user.gold and user.pref_store_visits:
-                    visited = LinkVisitsByAccount.fast_query(user, wrapped)
-
-            except tdb_cassandra.TRANSIENT_EXCEPTIONS as e:
-                # saved or hidden or may have been done properly, so go ahead
-                # with what we do have
-                g.log.warning("Cassandra save/hide/visited lookup failed: %r", e)
+            queries = [
+                (GildedLinksByAccount, user, gilded),
+                (LinkSavesByAccount, user, wrapped),
+                (LinkHidesByAccount, user, wrapped),
+            ]
+            if user.gold and user.pref_store_visits:
+                queries.append((LinkVisitsByAccount, user, wrapped))
+
+            results = tdb_cassandra.DenormalizedRelation.fast_query_multi(
+                queries, return_exceptions=True)
+            for i, ((rel_cls, _, _), result) in enumerate(
+                    zip(queries, results)):
+                if isinstance(result, Exception):
+                    # go ahead without them rather than failing the listing
+                    g.log.warning("Cassandra %s lookup failed: %r",
+                                  rel_cls.__name__, result)
+                    results[i] = {}
+            user_gildings, saved, hidden = results[:3]
+            if len(results) > 3:
+                visited = results[3]
 
         # determine which subreddits the user could assign link flair in
         if user_is_loggedin:
@@ -1325,6 +1329,7 @@ class LegacySearchResultLink(Link):
 class Comment(Thing, Printable):
     _cache = g.thingcache
     _data_int_props = Thing._data_int_props + ('reported', 'gildings')
+    _buffered_incr_props = ('_ups', '_downs')
     _defaults = dict(
         reported=0,
         parent_id=None,
@@ -1920,6 +1925,19 @@ class CommentScoresByLink(tdb_cassandra.View):
         except tdb_cassandra.NotFound:
             return {}
 
+    @classmethod
+    def get_scores_multi(cls, link, sorts):
+        """Return {sort: scores} for several sorts, read in one batch.
+
+        The rows are left in the request-local cache, so get_scores doesn't
+        read them again.
+
+        """
+        rowkeys = {sort: cls._rowkey(link, sort) for sort in sorts}
+        found, = tdb_cassandra.byID_multi([(cls, rowkeys.values())])
+        return {sort: found[rowkey]._values() if rowkey in found else {}
+                for sort, rowkey in rowkeys.iteritems()}
+
 
 class MoreMessages(Printable):
     cachable = False
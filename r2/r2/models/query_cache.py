@@ -33,25 +33,31 @@ jobs.
 """
 
 import json
+import heapq
 import random
 import datetime
 import collections
+from functools import cmp_to_key
+from itertools import islice
 
 from pylons import app_globals as g
 from pycassa.system_manager import ASCII_TYPE, UTF8_TYPE
 from pycassa.batch import Mutator
+from pycassa.cassandra.ttypes import NotFoundException
 
 from r2.models import Thing
 from r2.lib.db import tdb_cassandra
 from r2.lib.db.operators import asc, desc, BooleanOp
 from r2.lib.db.sorts import epoch_seconds
-from r2.lib.utils import flatten, to36
+from r2.lib.utils import to36
 
 
 CONNECTION_POOL = g.cassandra_pools['main']
 PRUNE_CHANCE = g.querycache_prune_chance
 MAX_CACHED_ITEMS = 1000
 LOG = g.log
+# the column holding all of a presorted cached query's items
+SORTED_COLUMN = "sorted"
 
 
 class ThingTupleComparator(object):
@@ -77,11 +83,103 @@ class ThingTupleComparator(object):
         return 0
 
 
+def insort(data, item, comparator):
+    """Insert item into the sorted list data, after any equal items."""
+    lo, hi = 0, len(data)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if comparator(item, data[mid]) < 0:
+            hi = mid
+        else:
+            lo = mid + 1
+    data.insert(lo, item)
+
+
+def _bisect(data, key, sort_key, right):
+    # the position of the first item in data beyond key, counting items
+    # equal to key as before it if right
+    lo, hi = 0, len(data)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        item_key = sort_key(data[mid])
+        if item_key < key or right and not key < item_key:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+
+def _decorate(data, start, stop, step, sort_key, index):
+    for i in xrange(start, stop, step):
+        yield sort_key(data[i]), index, data[i]
+
+
+def merge_sorted(lists, comparator, after=None, reverse=False, limit=None):
+    """Lazily merge lists of item tuples that are each sorted.
+
+    Yields the items in the order that stably sorting the concatenation of
+    the lists by comparator would, but only does as much work as the items
+    consumed need.
+
+    If `after` is the fullname of one of the items, start just after it (or
+    just before it, going backwards, if reverse). Nothing is yielded if it
+    isn't there.  If limit is given the merged listing is cut to that many
+    items before after and reverse are applied.
+
+    """
+
+    sort_key = cmp_to_key(comparator)
+    starts = [0] * len(lists)
+    owner = None
+
+    if after is not None:
+        for owner, data in enumerate(lists):
+            position = next((i for i, item in enumerate(data)
+                             if item[0] == after), None)
+            if position is not None:
+                break
+        else:
+            return iter(())
+
+        # equal items from earlier lists come first, as in a stable sort
+        after_key = sort_key(lists[owner][position])
+        starts = [_bisect(data, after_key, sort_key, right=index < owner)
+                  for index, data in enumerate(lists)]
+        starts[owner] = position + 1
+
+        if limit is not None:
+            if sum(starts) > limit:
+                return iter(())
+            if not reverse:
+                limit -= sum(starts)
+
+    if not reverse:
+        decorated = [_decorate(data, start, len(data), 1, sort_key, index)
+                     for index, (data, start) in enumerate(zip(lists, starts))]
+        merged = (item for key, index, item in heapq.merge(*decorated))
+        return islice(merged, limit) if limit is not None else merged
+
+    if after is None:
+        if limit is not None:
+            items = list(merge_sorted(lists, comparator, limit=limit))
+            return reversed(items)
+        ends = [len(data) for data in lists]
+    else:
+        ends = starts
+        ends[owner] = position
+
+    reverse_key = cmp_to_key(lambda a, b: comparator(b, a))
+    decorated = [_decorate(data, end - 1, -1, -1, reverse_key, -index)
+                 for index, (data, end) in enumerate(zip(lists, ends))]
+    return (item for key, index, item in heapq.merge(*decorated))
+
+
 class _CachedQueryBase(object):
     def __init__(self, sort):
         self.sort = sort
         self.sort_cols = [s.col for s in self.sort]
         self.data = []
+        self._sorted = False
         self._fetched = False
 
     def fetch(self, force=False):
@@ -95,7 +193,8 @@ class _CachedQueryBase(object):
             return
 
         self._fetch()
-        self._sort_data()
+        if not self._sorted:
+            self._sort_data()
         self._fetched = True
 
     def _fetch(self):
@@ -125,6 +224,10 @@ class CachedQuery(_CachedQueryBase):
     can occur (with a configurable probability) which will remove excess items
     from the end of the listing.
 
+    If the model is _presorted the items are instead kept in order as they're
+    written and the listing is cut to MAX_CACHED_ITEMS each time, so fetching
+    it doesn't sort and there's nothing to prune.
+
     Use CachedQueryMutator to make changes to the cached query's item list.
 
     """
@@ -190,7 +293,7 @@ class CachedQuery(_CachedQueryBase):
         for q in queries:
             cached_query = cached_queries.get(q.key)
             if cached_query:
-                q.data, q.timestamps = cached_query
+                q.data, q.timestamps, q._sorted = cached_query
 
     def _cols_from_things(self, things):
         cols = {}
@@ -208,7 +311,7 @@ class CachedQuery(_CachedQueryBase):
 
     def _replace(self, mutator, things, ttl):
         cols = self._cols_from_things(things)
-        self.model.replace(mutator, self.key, cols, ttl)
+        self.model.replace(mutator, self.key, cols, ttl, self.sort_cols)
 
     def _delete(self, mutator, things):
         if not things:
@@ -217,6 +320,16 @@ class CachedQuery(_CachedQueryBase):
         fullnames = [self.filter(x)._fullname for x in things]
         self.model.remove(mutator, self.key, fullnames)
 
+    def _sorted_updates(self, things, delete=False):
+        """Return the (fullname, sort values) updates for a presorted query.
+
+        Deletions have None for their sort values.
+
+        """
+        if delete:
+            return [(self.filter(x)._fullname, None) for x in things]
+        return self._cols_from_things(things).items()
+
     def _prune(self, mutator):
         to_keep = [t[0] for t in self.data[:MAX_CACHED_ITEMS]]
         to_prune = [t[0] for t in self.data[MAX_CACHED_ITEMS:]]
@@ -295,6 +408,9 @@ class MergedCachedQuery(_CachedQueryBase):
     Merged queries can be read, but cannot be modified as it is not easy to
     determine from a given item which sub-query should get modified.
 
+    The sub-queries are sorted separately and merged lazily as they're read,
+    so listing a page of a merge of many queries doesn't sort all of them.
+
     """
 
     def __init__(self, queries):
@@ -309,7 +425,26 @@ class MergedCachedQuery(_CachedQueryBase):
 
     def _fetch(self):
         CachedQuery._fetch_multi(self.queries)
-        self.data = flatten([q.data for q in self.queries])
+        for q in self.queries:
+            if not q._sorted:
+                q._sort_data()
+                q._sorted = True
+        self._sorted = True
+
+    def iter_after(self, after=None, reverse=False):
+        """Return an iterator of the fullnames after `after`."""
+        self.fetch()
+        merged = merge_sorted(
+            lists=[q.data for q in self.queries],
+            comparator=ThingTupleComparator(self.sort_cols),
+            after=after,
+            reverse=reverse,
+            limit=MAX_CACHED_ITEMS,
+        )
+        return (x[0] for x in merged)
+
+    def __iter__(self):
+        return self.iter_after()
 
 
 class CachedQueryMutator(object):
@@ -323,6 +458,7 @@ class CachedQueryMutator(object):
     def __init__(self):
         self.mutator = Mutator(CONNECTION_POOL)
         self.to_prune = set()
+        self.sorted_updates = collections.defaultdict(list)
 
     def __enter__(self):
         return self
@@ -346,6 +482,11 @@ class CachedQueryMutator(object):
         LOG.debug("Inserting %r into query %r", things, query)
 
         assert not query.is_precomputed
+
+        if query.model._presorted:
+            self.sorted_updates[query].extend(query._sorted_updates(things))
+            return
+
         query._insert(self.mutator, things)
 
         if (random.random() / len(things)) < PRUNE_CHANCE:
@@ -373,6 +514,11 @@ class CachedQueryMutator(object):
 
         LOG.debug("Deleting %r from query %r", things, query)
 
+        if query.model._presorted and not query.is_precomputed:
+            self.sorted_updates[query].extend(
+                query._sorted_updates(things, delete=True))
+            return
+
         query._delete(self.mutator, things)
 
     def send(self):
@@ -384,6 +530,10 @@ class CachedQueryMutator(object):
         """
         self.mutator.send()
 
+        for query, updates in self.sorted_updates.iteritems():
+            query.model.update_sorted(query.key, query.sort_cols, updates)
+        self.sorted_updates.clear()
+
         if self.to_prune:
             LOG.debug("Pruning queries %r", self.to_prune)
             CachedQuery._prune_multi(self.to_prune)
@@ -527,6 +677,12 @@ class _BaseQueryCache(object):
     the stuff CachedQuery needs to be able to sort the items (see
     CachedQuery._make_item_tuple).
 
+    A _presorted column family instead keeps all of a cached query's item
+    tuples, in sort order, in the row's SORTED_COLUMN. Rows still in the
+    column-per-item layout, or with item columns written alongside
+    SORTED_COLUMN, are sorted when read and converted the next time they're
+    written to.
+
     """
 
     __metaclass__ = tdb_cassandra.ThingMeta
@@ -537,14 +693,44 @@ class _BaseQueryCache(object):
     _use_db = False
     _type_prefix = None
     _cf_name = None
+    _presorted = g.querycache_presorted
+
+    @classmethod
+    def _from_columns(cls, columns):
+        data = []
+        timestamps = []
+
+        for (key, (value, timestamp)) in columns.iteritems():
+            if key == SORTED_COLUMN:
+                continue
+            value = json.loads(value)
+            data.append((key,) + tuple(value))
+            timestamps.append((key, timestamp))
+
+        if SORTED_COLUMN not in columns:
+            return data, dict(timestamps), False
+
+        value, sorted_timestamp = columns[SORTED_COLUMN]
+        sorted_data = [tuple(item) for item in json.loads(value)]
+        if not data:
+            return sorted_data, {}, True
+
+        # hosts that don't keep the row presorted (during a deploy, say)
+        # still write a column per item. those haven't made it into the
+        # sorted column yet, so they win over its tuples for the same things
+        updated = set(key for key, timestamp in timestamps)
+        timestamps.extend((t[0], sorted_timestamp) for t in sorted_data
+                          if t[0] not in updated)
+        data.extend(t for t in sorted_data if t[0] not in updated)
+        return data, dict(timestamps), False
 
     @classmethod
     def get(cls, keys):
         """Retrieve the items in a set of cached queries.
 
-        For each cached query, this returns the thing tuples and the column
-        timestamps for them.  The latter is useful for conditional removal
-        during pruning.
+        For each cached query, this returns the thing tuples, the column
+        timestamps for them and whether the tuples are already sorted.  The
+        timestamps are useful for conditional removal during pruning.
 
         """
         rows = cls._cf.multiget(keys, include_timestamp=True,
@@ -552,15 +738,7 @@ class _BaseQueryCache(object):
 
         res = {}
         for row, columns in rows.iteritems():
-            data = []
-            timestamps = []
-
-            for (key, (value, timestamp)) in columns.iteritems():
-                value = json.loads(value)
-                data.append((key,) + tuple(value))
-                timestamps.append((key, timestamp))
-
-            res[row] = (data, dict(timestamps))
+            res[row] = cls._from_columns(columns)
 
         return res
 
@@ -597,13 +775,60 @@ class _BaseQueryCache(object):
 
     @classmethod
     @tdb_cassandra.will_write
-    def replace(cls, mutator, key, columns, ttl):
+    def replace(cls, mutator, key, columns, ttl, sort_cols=None):
         # XXX: this assumes that precomputed queries aren't updated at a
         # frequency / simultaneously in a way that could collide.
         job_key = datetime.datetime.now(g.tz).isoformat()
-        cls.insert(mutator, key + "/" + job_key, columns, ttl=ttl)
+        row_key = key + "/" + job_key
+        if cls._presorted:
+            data = [(name,) + tuple(value)
+                    for name, value in columns.iteritems()]
+            data.sort(cmp=ThingTupleComparator(sort_cols))
+            mutator.insert(cls._cf, row_key, {SORTED_COLUMN: json.dumps(data)},
+                           ttl=ttl)
+        else:
+            cls.insert(mutator, row_key, columns, ttl=ttl)
         mutator.insert(cls._cf, key + "/index", {job_key: ""}, ttl=ttl)
 
+    @classmethod
+    @tdb_cassandra.will_write
+    def update_sorted(cls, key, sort_cols, updates):
+        """Apply updates to a presorted cached query.
+
+        `updates` is a list of (fullname, sort values) to upsert, in order,
+        with None as the sort values of things to remove.  The cached query is
+        then cut down to MAX_CACHED_ITEMS.
+
+        """
+        latest = dict(updates)
+        comparator = ThingTupleComparator(sort_cols)
+
+        with g.make_lock("querycache_sorted", "querycache_sorted_" + key):
+            try:
+                columns = cls._cf.get(key, include_timestamp=True,
+                    column_count=tdb_cassandra.max_column_count)
+            except NotFoundException:
+                columns = {}
+
+            data, timestamps, is_sorted = cls._from_columns(columns)
+            if not is_sorted:
+                data.sort(cmp=comparator)
+
+            data = [t for t in data if t[0] not in latest]
+            for name, value in latest.iteritems():
+                if value is not None:
+                    insort(data, (name,) + tuple(value), comparator)
+            del data[MAX_CACHED_ITEMS:]
+
+            cls._cf.insert(key, {SORTED_COLUMN: json.dumps(data)})
+
+            # drop the item columns that have just been merged in, but not
+            # any rewritten since they were read
+            old_columns = [name for name in columns if name != SORTED_COLUMN]
+            if old_columns:
+                newest = max(columns[name][1] for name in old_columns)
+                cls._cf.remove(key, columns=old_columns, timestamp=newest)
+
     @classmethod
     @tdb_cassandra.will_write
     def remove(cls, mutator, key, columns):
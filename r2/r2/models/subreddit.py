@@ -2713,6 +2713,18 @@ class SRMember(Relation(Subreddit, Account)):
     _permission_class = None
     _cache = g.srmembercache
     _rel_cache = g.srmembercache
+    # a subreddit's moderators, banned users etc. are few and most users
+    # aren't one, but it has too many subscribers for a filter to help
+    _negative_filter = True
+    _negative_filter_names = (
+        "moderator",
+        "moderator_invite",
+        "contributor",
+        "banned",
+        "muted",
+        "wikibanned",
+        "wikicontributor",
+    )
 
     @classmethod
     def _cache_prefix(cls):
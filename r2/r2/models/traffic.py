@@ -63,9 +63,12 @@ def memoize_traffic(**memoize_kwargs):
     """Wrap the memoize decorator and automatically determine memoize key.
 
     The memoize key is based off the full name (including class name) of the
-    method being memoized.
+    method being memoized. Traffic queries are slow and their results are
+    only updated hourly, so they're refreshed early rather than under lock.
 
     """
+    memoize_kwargs.setdefault("early_refresh", True)
+
     def memoize_traffic_decorator(fn):
         def memoize_traffic_wrapper(cls, *args, **kwargs):
             method = ".".join((cls.__name__, fn.__name__))
@@ -368,7 +371,7 @@ def campaign_history(cls, codenames, start, stop):
             for r in q.all()]
 
 
-@memoize("traffic_last_modified", time=60 * 10)
+@memoize("traffic_last_modified", time=60 * 10, early_refresh=True)
 def get_traffic_last_modified():
     """Guess how far behind the traffic processing system is."""
     try:
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of
+# the Original Code is reddit Inc.
+#
+# All portions of the code written by reddit are Copyright (c) 2006-2016 reddit
+# Inc. All Rights Reserved.
+###############################################################################
+import unittest
+
+from mock import MagicMock, patch
+
+from r2.lib import access_ledger
+from r2.lib.access_ledger import AccessLedger, key_shape, sql_shape
+
+
+class AccessLedgerTest(unittest.TestCase):
+    def test_key_shape(self):
+        self.assertEqual(key_shape("Link_123"), "Link_N")
+        self.assertEqual(
+            key_shape("memo:d41d8cd98f00b204e9800998ecf8427e"), "memo:N")
+
+    def test_sql_shape(self):
+        statement = ("SELECT reddit_thing_link.thing_id FROM reddit_thing_link"
+                     " WHERE reddit_thing_link.thing_id = :thing_id_1")
+        self.assertEqual(sql_shape(statement), "select:reddit_thing_link")
+
+    def test_duplicates(self):
+        ledger = AccessLedger()
+        ledger.record_cache("thingcache", ["Link_1", "Link_2"])
+        ledger.record_cache("thingcache", ["Link_1"])
+        ledger.record_cache("thingcache", ["Link_1"])
+
+        self.assertEqual(
+            ledger.duplicates(),
+            [("cache", "thingcache:Link_N", "Link_1", 3)],
+        )
+
+    def test_n_plus_one(self):
+        ledger = AccessLedger(n_plus_one_threshold=3)
+        for i in xrange(3):
+            ledger.record_cache("thingcache", ["Account_%d" % i])
+        ledger.record_cache("thingcache", ["Link_1", "Link_2"])
+        ledger.record_cache("thingcache", ["Link_3"])
+
+        self.assertEqual(
+            ledger.n_plus_one(), [("cache", "thingcache:Account_N", 3)])
+        self.assertEqual(ledger.duplicates(), [])
+
+    def test_queries_labelled_by_table(self):
+        ledger = AccessLedger(n_plus_one_threshold=2)
+        statement = "SELECT * FROM reddit_data_link WHERE thing_id = :p"
+        ledger.record_query(statement, {"p": 1})
+        ledger.record_query(statement, {"p": 1})
+
+        self.assertEqual(
+            ledger.n_plus_one(), [("sql", "select:reddit_data_link", 2)])
+        self.assertEqual(
+            ledger.duplicates(),
+            [("sql", "select:reddit_data_link", "[('p', 1)]", 2)],
+        )
+
+    def test_summary(self):
+        ledger = AccessLedger(n_plus_one_threshold=2)
+        ledger.record_cache("thingcache", ["Link_1"])
+        ledger.record_cache("thingcache", ["Link_1"])
+        ledger.record("cassandra", "Vote", ["a", "b"])
+
+        self.assertEqual(
+            ledger.summary(),
+            "cache=2/dup=1; cassandra=1/dup=0; "
+            "n+1 cache thingcache:Link_N x2; "
+            "dup cache thingcache:Link_N x2",
+        )
+
+
+class FinishRequestTest(unittest.TestCase):
+    def setUp(self):
+        self.ledger = AccessLedger()
+        self.ledger.record_cache("thingcache", ["Link_1"])
+        self.c = MagicMock(access_ledger=self.ledger, user_is_loggedin=True,
+                           user_is_admin=False)
+        self.c.user.employee = False
+        self.g = MagicMock(debug=False)
+        self.response = MagicMock(headers={})
+        for name in ("c", "g", "response", "request"):
+            patcher = patch.object(access_ledger, name,
+                                   getattr(self, name, MagicMock()))
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_summary_logged_not_sent(self):
+        access_ledger.finish_request()
+        self.assertTrue(self.g.log.info.called)
+        self.assertEqual(self.response.headers, {})
+        self.assertIsNone(self.c.access_ledger)
+
+    def test_summary_sent_to_employees(self):
+        self.c.user.employee = True
+        access_ledger.finish_request()
+        self.assertEqual(self.response.headers[access_ledger.HEADER_NAME],
+                         self.ledger.summary())
+
+    def test_summary_sent_in_debug(self):
+        self.g.debug = True
+        self.c.user_is_loggedin = False
+        access_ledger.finish_request()
+        self.assertIn(access_ledger.HEADER_NAME, self.response.headers)
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of
+# the Original Code is reddit Inc.
+#
+# All portions of the code written by reddit are Copyright (c) 2006-2016 reddit
+# Inc. All Rights Reserved.
+import cPickle as pickle
+import unittest
+
+from r2.lib.bloom import BloomFilter
+
+
+class BloomFilterTest(unittest.TestCase):
+    def test_no_false_negatives(self):
+        bloom = BloomFilter(1000)
+        for i in xrange(1000):
+            bloom.add(i)
+
+        self.assertEqual(len(bloom), 1000)
+        self.assertTrue(bloom.full)
+        self.assertTrue(all(i in bloom for i in xrange(1000)))
+
+    def test_false_positive_rate(self):
+        bloom = BloomFilter(1000, error_rate=0.01)
+        for i in xrange(1000):
+            bloom.add(i)
+
+        false_positives = sum(1 for i in xrange(1000, 11000) if i in bloom)
+        self.assertLess(false_positives, 200)
+
+    def test_empty(self):
+        bloom = BloomFilter(10)
+        self.assertNotIn(1, bloom)
+        self.assertFalse(bloom.full)
+
+    def test_pickle(self):
+        bloom = BloomFilter(100)
+        bloom.add(5)
+        bloom.add("t2_abc")
+
+        loaded = pickle.loads(pickle.dumps(bloom, pickle.HIGHEST_PROTOCOL))
+        self.assertIn(5, loaded)
+        self.assertIn("t2_abc", loaded)
+        self.assertNotIn(6, loaded)
+        self.assertEqual(loaded.count, 2)
+        self.assertEqual(loaded.bits, bloom.bits)
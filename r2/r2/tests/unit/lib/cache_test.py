@@ -0,0 +1,691 @@
+#!/usr/bin/env python
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of
+# the Original Code is reddit Inc.
+#
+# All portions of the code written by reddit are Copyright (c) 2006-2016 reddit
+# Inc. All Rights Reserved.
+###############################################################################
+import cPickle as pickle
+import threading
+import unittest
+
+from mock import MagicMock, patch
+
+from r2.lib.cache import (
+    CacheChain,
+    CacheCodec,
+    CODEC_MAGIC,
+    CODEC_VERSION,
+    HotKeyTracker,
+    LocalCache,
+    LRUCache,
+    NoneResult,
+    ParallelFetcher,
+    Permacache,
+    SingleFlight,
+    StaleCacheChain,
+)
+from r2.lib.lock import TimeoutExpired
+
+
+class LRUCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000
+        p = patch("r2.lib.cache.unix_time", lambda: self.now)
+        p.start()
+        self.addCleanup(p.stop)
+
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(max_items=3)
+        cache.stats = MagicMock()
+        for i in xrange(3):
+            cache.set("key%d" % i, i)
+
+        # touch key0 so key1 becomes the oldest
+        self.assertEquals(0, cache.get("key0"))
+        cache.set("key3", 3)
+
+        self.assertEquals(["key0", "key2", "key3"], sorted(cache.keys()))
+        cache.stats.cache_eviction.assert_called_once_with(1, "size")
+
+    def test_evicts_by_size(self):
+        cache = LRUCache(max_items=0, max_bytes=1000)
+        for i in xrange(100):
+            cache.set("key%d" % i, "x" * 100)
+
+        self.assertTrue(cache.size_bytes <= 1000)
+        self.assertTrue(0 < len(cache) < 100)
+        self.assertTrue("key99" in cache)
+        self.assertFalse("key0" in cache)
+
+    def test_ttl(self):
+        cache = LRUCache()
+        cache.set("short", 1, time=10)
+        cache.set("forever", 2)
+
+        self.now += 5
+        self.assertEquals(1, cache.get("short"))
+
+        self.now += 5
+        self.assertEquals(None, cache.get("short"))
+        self.assertFalse("short" in cache)
+        self.assertEquals(2, cache.get("forever"))
+
+    def test_absolute_ttl(self):
+        cache = LRUCache()
+        cache.set("key", 1, time=self.now + 60 * 60 * 24 * 31)
+
+        self.now += 60 * 60 * 24 * 30
+        self.assertEquals(1, cache.get("key"))
+
+        self.now += 60 * 60 * 24
+        self.assertEquals(None, cache.get("key"))
+
+    def test_incr_keeps_ttl(self):
+        cache = LRUCache()
+        cache.set("key", 1, time=10)
+        cache.incr("key")
+        self.assertEquals(2, cache.get("key"))
+
+        self.now += 10
+        self.assertEquals(None, cache.get("key"))
+
+    def test_add(self):
+        cache = LRUCache()
+        self.assertTrue(cache.add("key", 1))
+        self.assertFalse(cache.add("key", 2))
+        self.assertEquals(1, cache.get("key"))
+
+    def test_fresh(self):
+        cache = LRUCache(max_items=5, max_bytes=100)
+        cache.stats = MagicMock()
+        cache.set("key", 1)
+
+        fresh = cache.fresh()
+        self.assertEquals(0, len(fresh))
+        self.assertEquals(5, fresh.max_items)
+        self.assertEquals(100, fresh.max_bytes)
+        self.assertIs(cache.stats, fresh.stats)
+
+
+class SingleFlightTest(unittest.TestCase):
+    def setUp(self):
+        self.cache = LocalCache()
+        self.cache.stats = MagicMock()
+        self.single_flight = SingleFlight(timeout=1)
+
+    def test_single_caller(self):
+        load_fn = MagicMock(return_value={"a": 1})
+        ret = self.single_flight.load_multi(self.cache, ["a", "b"], load_fn)
+
+        self.assertEquals({"a": 1}, ret)
+        load_fn.assert_called_once_with(["a", "b"])
+        self.cache.stats.single_flight.assert_called_once_with(
+            loaded=2, coalesced=0)
+
+    def test_concurrent_callers_coalesce(self):
+        loading = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def slow_load(keys):
+            calls.append(keys)
+            loading.set()
+            release.wait()
+            return {key: [key] for key in keys}
+
+        def fast_load(keys):
+            # by now the waiter has found "a" in flight, so let it finish
+            calls.append(keys)
+            release.set()
+            return {key: [key] for key in keys}
+
+        results = {}
+        def load_in_thread():
+            results["first"] = self.single_flight.load_multi(
+                self.cache, ["a", "b"], slow_load)
+        thread = threading.Thread(target=load_in_thread)
+        thread.start()
+        loading.wait()
+
+        # "a" is in flight so only "c" gets loaded by this caller
+        waiter = threading.Thread(target=lambda: results.update(
+            second=self.single_flight.load_multi(
+                self.cache, ["a", "c"], fast_load)))
+        waiter.start()
+        thread.join()
+        waiter.join()
+
+        self.assertEquals([["a", "b"], ["c"]], calls)
+        self.assertEquals({"a": ["a"], "c": ["c"]}, results["second"])
+        # waiters get a copy of the value, not the loader's object
+        self.assertIsNot(results["first"]["a"], results["second"]["a"])
+
+    def test_waiters_unaffected_by_later_changes(self):
+        loading = threading.Event()
+        release = threading.Event()
+        changed = threading.Event()
+
+        def slow_load(keys):
+            loading.set()
+            release.wait()
+            return {"a": ["a"]}
+
+        def fast_load(keys):
+            release.set()
+            # let the loader return and change its value before we look
+            changed.wait(1)
+            return {}
+
+        def load_in_thread():
+            ret = self.single_flight.load_multi(self.cache, ["a"], slow_load)
+            ret["a"].append("changed")
+            changed.set()
+        thread = threading.Thread(target=load_in_thread)
+        thread.start()
+        loading.wait()
+
+        ret = self.single_flight.load_multi(self.cache, ["a", "b"], fast_load)
+        thread.join()
+
+        self.assertEquals({"a": ["a"]}, ret)
+
+    def test_slow_load_falls_back(self):
+        single_flight = SingleFlight(timeout=0.01)
+        loading = threading.Event()
+        release = threading.Event()
+
+        def slow_load(keys):
+            loading.set()
+            release.wait()
+            return {"a": 1}
+
+        thread = threading.Thread(
+            target=single_flight.load_multi,
+            args=(self.cache, ["a"], slow_load),
+        )
+        thread.start()
+        loading.wait()
+
+        load_fn = MagicMock(return_value={"a": 2})
+        ret = single_flight.load_multi(self.cache, ["a"], load_fn)
+        release.set()
+        thread.join()
+
+        self.assertEquals({"a": 2}, ret)
+        load_fn.assert_called_once_with(["a"])
+
+
+class HotKeyTrackerTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000
+        p = patch("r2.lib.cache.unix_time", lambda: self.now)
+        p.start()
+        self.addCleanup(p.stop)
+
+        self.stats = MagicMock()
+        self.tracker = HotKeyTracker(
+            "test", self.stats, sample_rate=1, threshold=10, window=10)
+
+    def test_promotes_hot_keys(self):
+        for i in xrange(100):
+            self.tracker.record(["hot"])
+        self.tracker.record(["cold"])
+
+        self.now += 10
+        self.tracker.record(["cold"])
+        self.assertEquals(frozenset(["hot"]), self.tracker.hot_keys)
+        self.stats.count_string.assert_any_call(
+            "cache.test.top_keys", "hot", count=10)
+
+    def test_replicas(self):
+        self.tracker.hot_keys = frozenset(["hot"])
+        self.tracker.replicate({"hot": [1], "cold": [2]})
+
+        replicas = self.tracker.get_replicas(["hot", "cold"])
+        self.assertEquals({"hot": [1]}, replicas)
+        self.assertIsNot(replicas["hot"], self.tracker.get_replicas(["hot"]))
+
+        self.tracker.invalidate(["hot"])
+        self.assertEquals({}, self.tracker.get_replicas(["hot"]))
+
+    def test_replicas_expire(self):
+        self.tracker.hot_keys = frozenset(["hot"])
+        self.tracker.replicate({"hot": 1})
+
+        self.now += self.tracker.ttl
+        self.assertEquals({}, self.tracker.get_replicas(["hot"]))
+
+
+class CacheCodecTest(unittest.TestCase):
+    def test_round_trip(self):
+        values = [
+            "short",
+            "long" * 1000,
+            u"unicode",
+            {"a": (1, 2.5, None, u"b")},
+            [1, 2, 3],
+            NoneResult,
+        ]
+        for spec in ("pickle", "pickle+zlib", "pickle+snappy"):
+            codec = CacheCodec.from_spec(spec)
+            for val in values:
+                self.assertEquals(val, codec.decode(codec.encode(val)))
+
+    def test_passthrough(self):
+        codec = CacheCodec("pickle", "zlib")
+        self.assertEquals(5, codec.encode(5))
+        self.assertEquals("short", codec.encode("short"))
+
+        decode_only = CacheCodec()
+        self.assertEquals({"a": 1}, decode_only.encode({"a": 1}))
+        self.assertEquals("legacy", decode_only.decode("legacy"))
+
+    def test_compression(self):
+        codec = CacheCodec("pickle", "zlib", min_compress_len=100)
+        val = "x" * 1000
+        self.assertTrue(len(codec.encode(val)) < 100)
+        self.assertEquals(val, codec.decode(codec.encode(val)))
+
+    def test_magic_strings_are_encoded(self):
+        codec = CacheCodec("pickle")
+        val = CODEC_MAGIC + "not really encoded"
+        self.assertEquals(val, codec.decode(codec.encode(val)))
+
+    def test_unknown_version_is_a_miss(self):
+        codec = CacheCodec("pickle")
+        encoded = codec.encode({"a": 1})
+        future = encoded[:2] + chr(CODEC_VERSION + 1) + encoded[3:]
+        self.assertEquals(None, codec.decode(future))
+
+
+class CASCache(object):
+    """An in-process stand-in for memcached's gets and cas."""
+
+    def __init__(self):
+        self.data = {}
+        self.last_cas_id = 0
+
+    def _store(self, key, val):
+        self.last_cas_id += 1
+        self.data[key] = (val, self.last_cas_id)
+        return True
+
+    def gets(self, key):
+        return self.data.get(key, (None, None))
+
+    def get(self, key, default=None):
+        val, cas_id = self.gets(key)
+        return default if val is None else val
+
+    def set(self, key, val, time=0):
+        return self._store(key, val)
+
+    def add(self, key, val, time=0):
+        if key in self.data:
+            return None
+        return self._store(key, val)
+
+    def cas(self, key, val, cas_id, time=0):
+        if self.gets(key)[1] != cas_id:
+            return False
+        return self._store(key, val)
+
+    def delete(self, key, time=0):
+        self.data.pop(key, None)
+
+
+@patch("r2.lib.cache.sleep", MagicMock())
+class PermacacheCASTest(unittest.TestCase):
+    def setUp(self):
+        self.cas_cache = CASCache()
+        self.local_cache = LocalCache()
+        chain = CacheChain((self.local_cache, self.cas_cache))
+        chain.stats = MagicMock()
+        self.stats = chain.stats
+        self.cf = MagicMock()
+        self.cf.multiget.return_value = {}
+        self.permacache = Permacache(
+            chain, self.cf, lock_factory=MagicMock(), cas_cache=self.cas_cache,
+            max_cas_attempts=3)
+
+    def test_mutate(self):
+        self.cas_cache.set("key", [1])
+
+        ret = self.permacache.mutate("key", lambda value: value + [2])
+
+        self.assertEqual(ret, [1, 2])
+        self.assertEqual(self.cas_cache.get("key"), [1, 2])
+        self.assertEqual(self.local_cache.get("key"), [1, 2])
+        self.assertEqual(self.cf.insert.call_count, 1)
+        self.permacache.make_lock.assert_called_once_with(
+            "permacache_mutate", "mutate_key")
+        self.stats.cas_mutation.assert_called_once_with(0, exhausted=False)
+
+    def test_missing_key_is_read_from_backend(self):
+        self.cf.multiget.return_value = {
+            "key": {Permacache.COLUMN_NAME: pickle.dumps([1], protocol=2)},
+        }
+
+        ret = self.permacache.mutate("key", lambda value: value + [2])
+
+        self.assertEqual(ret, [1, 2])
+        self.assertEqual(self.cas_cache.get("key"), [1, 2])
+
+    def test_failed_backend_write_drops_key(self):
+        self.cas_cache.set("key", [1])
+        self.cf.insert.side_effect = ValueError
+
+        with self.assertRaises(ValueError):
+            self.permacache.mutate("key", lambda value: value + [2])
+
+        self.assertNotIn("key", self.cas_cache.data)
+        self.assertIsNone(self.local_cache.get("key"))
+
+    def test_eviction_before_backend_write(self):
+        self.cas_cache.set("key", [1])
+        backend = {"key": {Permacache.COLUMN_NAME: pickle.dumps([1])}}
+        self.cf.multiget.side_effect = lambda keys, columns: {
+            key: backend[key] for key in keys if key in backend}
+
+        locks = {}
+        waiting = threading.Event()
+
+        class Lock(object):
+            def __init__(self, group, key):
+                self.lock = locks.setdefault(key, threading.Lock())
+
+            def __enter__(self):
+                waiting.set()
+                self.lock.acquire()
+
+            def __exit__(self, *exc_info):
+                self.lock.release()
+
+        self.permacache.make_lock = Lock
+        other_writer = threading.Thread(
+            target=self.permacache.mutate, args=("key", lambda v: v + [3]))
+
+        def insert(rowkey, columns, timestamp=None):
+            if other_writer.ident is None:
+                # memcached drops the key after our cas, before we write
+                # cassandra, and another writer comes along
+                self.cas_cache.delete("key")
+                waiting.clear()
+                other_writer.start()
+                self.assertTrue(waiting.wait(1))
+            backend[rowkey] = columns
+        self.cf.insert.side_effect = insert
+
+        self.permacache.mutate("key", lambda v: v + [2])
+        other_writer.join(1)
+
+        self.assertFalse(other_writer.is_alive())
+        self.assertEqual(
+            pickle.loads(backend["key"][Permacache.COLUMN_NAME]), [1, 2, 3])
+
+    def test_conflict_retries_on_latest_value(self):
+        self.cas_cache.set("key", [1])
+        calls = []
+
+        def mutation_fn(value):
+            if not calls:
+                # another writer gets in between our read and write
+                self.cas_cache.set("key", [1, "other"])
+            calls.append(value)
+            return value + [2]
+
+        ret = self.permacache.mutate("key", mutation_fn)
+
+        self.assertEqual(calls, [[1], [1, "other"]])
+        self.assertEqual(ret, [1, "other", 2])
+        self.assertEqual(self.cas_cache.get("key"), [1, "other", 2])
+        self.assertEqual(self.cf.insert.call_count, 1)
+        self.stats.cas_mutation.assert_called_once_with(1, exhausted=False)
+
+    def test_gives_up_after_max_attempts(self):
+        self.cas_cache.set("key", [1])
+
+        def mutation_fn(value):
+            self.cas_cache.set("key", [1])
+            return value + [2]
+
+        with self.assertRaises(TimeoutExpired):
+            self.permacache.mutate("key", mutation_fn)
+
+        self.assertEqual(self.cas_cache.get("key"), [1])
+        self.assertFalse(self.cf.insert.called)
+        self.stats.cas_mutation.assert_called_once_with(2, exhausted=True)
+
+
+class ParallelFetcherTest(unittest.TestCase):
+    def test_run(self):
+        fetcher = ParallelFetcher(pool_size=2)
+        stats = MagicMock()
+        calls = [
+            ("first", lambda x: x + 1, (1,)),
+            ("second", lambda x: x * 2, (5,)),
+        ]
+
+        self.assertEqual(fetcher.run(calls, stats=stats), [2, 10])
+        self.assertEqual(
+            [call[0][0] for call in stats.backend_timing.call_args_list],
+            ["first", "second"],
+        )
+
+    def test_errors_are_raised(self):
+        fetcher = ParallelFetcher(pool_size=2)
+
+        def fail():
+            raise ValueError
+
+        with self.assertRaises(ValueError):
+            fetcher.run([("ok", lambda: None, ()), ("fail", fail, ())])
+
+    def test_hedge(self):
+        fetcher = ParallelFetcher(pool_size=2, hedge_delay=1)
+        second = MagicMock()
+
+        ret = fetcher.hedge(("first", lambda: 1, ()), ("second", second, ()))
+
+        self.assertEqual(ret, [1])
+        self.assertFalse(second.called)
+
+    def test_hedge_slow(self):
+        fetcher = ParallelFetcher(pool_size=2, hedge_delay=0.05)
+        release = threading.Event()
+
+        def slow():
+            release.wait(1)
+            return 1
+
+        def second():
+            release.set()
+            return 2
+
+        self.assertEqual(
+            fetcher.hedge(("first", slow, ()), ("second", second, ())),
+            [1, 2])
+
+    def test_hedge_gives_up_on_stuck_first(self):
+        fetcher = ParallelFetcher(pool_size=2, hedge_delay=0.01)
+        release = threading.Event()
+        self.addCleanup(release.set)
+        stats = MagicMock()
+
+        ret = fetcher.hedge(("first", release.wait, ()),
+                            ("second", lambda: 2, ()), stats=stats)
+
+        self.assertEqual(ret, [None, 2])
+        self.assertEqual(
+            [call[0][0] for call in stats.backend_timing.call_args_list],
+            ["second"])
+
+    def test_serial_when_pool_busy(self):
+        fetcher = ParallelFetcher(pool_size=1, hedge_delay=0.01)
+        release = threading.Event()
+        self.addCleanup(release.set)
+        # the given up call keeps the only thread
+        fetcher.hedge(("stuck", release.wait, ()), ("ok", lambda: 1, ()))
+
+        caller = threading.current_thread()
+        on_caller = lambda: threading.current_thread() is caller
+        second = MagicMock()
+
+        self.assertEqual(
+            fetcher.hedge(("first", on_caller, ()), ("second", second, ())),
+            [True])
+        self.assertFalse(second.called)
+        self.assertEqual(
+            fetcher.run([("a", on_caller, ()), ("b", on_caller, ())]),
+            [True, True])
+
+        # the thread is used again once the call returns
+        release.set()
+        fetcher.pool.apply(lambda: None)
+        self.assertEqual(
+            fetcher.run([("a", on_caller, ()), ("b", on_caller, ())]),
+            [True, False])
+
+    def test_can_run(self):
+        self.assertTrue(ParallelFetcher.can_run(LocalCache(), CASCache()))
+        self.assertFalse(ParallelFetcher.can_run(CacheChain((LocalCache(),))))
+
+
+class SlowCache(LocalCache):
+    """A LocalCache whose reads wait for `release` to be set."""
+    def __init__(self, *a, **kw):
+        LocalCache.__init__(self, *a, **kw)
+        self.release = threading.Event()
+
+    def simple_get_multi(self, keys):
+        self.release.wait(1)
+        return LocalCache.simple_get_multi(self, keys)
+
+
+class ReleasingCache(LocalCache):
+    """A LocalCache whose reads let another cache's reads finish."""
+    def __init__(self, other, *a, **kw):
+        LocalCache.__init__(self, *a, **kw)
+        self.other = other
+        self.reads = 0
+
+    def get(self, key, *a, **kw):
+        self.reads += 1
+        self.other.release.set()
+        return LocalCache.get(self, key, *a, **kw)
+
+    def simple_get_multi(self, keys):
+        self.reads += 1
+        self.other.release.set()
+        return LocalCache.simple_get_multi(self, keys)
+
+
+class StaleCacheChainParallelTest(unittest.TestCase):
+    def setUp(self):
+        self.stalecache = SlowCache()
+        self.realcache = ReleasingCache(self.stalecache)
+        self.chain = StaleCacheChain(
+            LocalCache(), self.stalecache, self.realcache,
+            parallel_fetcher=ParallelFetcher(pool_size=2, hedge_delay=0.05))
+        self.chain.stats = MagicMock()
+
+    def backends(self):
+        return {call[0][0] for call in
+                self.chain.stats.backend_timing.call_args_list}
+
+    def test_slow_stale_cache_hedged(self):
+        self.stalecache.set_multi({"a": "stale a"})
+        self.realcache.set_multi({"a": "real a", "b": "real b"})
+
+        ret = self.chain.simple_get_multi(
+            ["a", "b", "c"], stale=True, use_timer=False)
+
+        self.assertEqual(ret, {"a": "stale a", "b": "real b"})
+        self.assertEqual(self.realcache.reads, 1)
+        # only what came from the real cache goes to the other caches
+        self.assertEqual(self.stalecache.get("b"), "real b")
+        self.assertEqual(self.chain.localcache, {"b": "real b"})
+        self.assertEqual(self.backends(), {"stale", "real"})
+
+    def test_fast_stale_cache_not_hedged(self):
+        self.stalecache.release.set()
+        self.stalecache.set_multi({"a": "stale a"})
+        self.realcache.set_multi({"a": "real a", "b": "real b"})
+
+        ret = self.chain.simple_get_multi(
+            ["a", "b"], stale=True, use_timer=False)
+        self.assertEqual(ret, {"a": "stale a", "b": "real b"})
+        self.assertEqual(self.backends(), {"stale"})
+
+        # nothing is read from the real cache when the stale one has it all
+        self.chain.localcache.clear()
+        self.realcache.reads = 0
+        ret = self.chain.simple_get_multi(["a"], stale=True, use_timer=False)
+        self.assertEqual(ret, {"a": "stale a"})
+        self.assertEqual(self.realcache.reads, 0)
+
+    def test_stuck_stale_cache_skipped(self):
+        self.addCleanup(self.stalecache.release.set)
+        self.chain.realcache = realcache = LocalCache()
+        self.stalecache.set_multi({"a": "stale a"})
+        realcache.set_multi({"a": "real a", "b": "real b"})
+
+        ret = self.chain.simple_get_multi(
+            ["a", "b"], stale=True, use_timer=False)
+
+        self.assertEqual(ret, {"a": "real a", "b": "real b"})
+        self.assertEqual(self.backends(), {"real"})
+
+    def test_get(self):
+        self.realcache.set("a", "real a")
+
+        self.assertEqual(self.chain.get("a", stale=True, use_timer=False), "real a")
+        self.assertEqual(self.stalecache.get("a"), "real a")
+        self.assertEqual(self.backends(), {"stale", "real"})
+
+        self.stalecache.set("b", "stale b")
+        self.realcache.set("b", "real b")
+        self.assertEqual(self.chain.get("b", stale=True, use_timer=False), "stale b")
+
+
+class StaleCacheChainRequireFreshTest(unittest.TestCase):
+    def setUp(self):
+        self.stalecache = LocalCache()
+        self.realcache = LocalCache()
+        self.require_fresh = MagicMock(return_value=False)
+        self.chain = StaleCacheChain(
+            LocalCache(), self.stalecache, self.realcache,
+            require_fresh=self.require_fresh)
+        self.chain.stats = MagicMock()
+        self.stalecache.set("a", "stale a")
+        self.realcache.set("a", "real a")
+
+    def test_stale_allowed(self):
+        self.assertEqual(
+            self.chain.get("a", stale=True, use_timer=False), "stale a")
+
+    def test_fresh_required(self):
+        self.require_fresh.return_value = True
+
+        self.assertEqual(
+            self.chain.get("a", stale=True, use_timer=False), "real a")
+        self.chain.localcache.clear()
+        self.assertEqual(
+            self.chain.simple_get_multi(["a"], stale=True, use_timer=False),
+            {"a": "real a"})
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of
+# the Original Code is reddit Inc.
+#
+# All portions of the code written by reddit are Copyright (c) 2006-2016 reddit
+# Inc. All Rights Reserved.
+###############################################################################
+import unittest
+
+from mock import MagicMock
+
+from r2.lib.db.batch_loader import BatchLoader
+
+
+class BatchLoaderTest(unittest.TestCase):
+    def test_take_returns_pending_ids_once(self):
+        loader = BatchLoader()
+        cls = MagicMock()
+        loader.prefetch(cls, [1, 2])
+        loader.prefetch(cls, [2, 3])
+
+        self.assertEqual(sorted(loader.take(cls, exclude=[3])), [1, 2])
+        self.assertEqual(loader.take(cls), [])
+        self.assertEqual(loader.batches, 1)
+        self.assertEqual(loader.round_trips_saved, 0)
+
+    def test_take_without_pending_ids(self):
+        loader = BatchLoader()
+        self.assertEqual(loader.take(MagicMock()), [])
+        self.assertEqual(loader.batches, 0)
+
+    def test_claim_counts_served_lookups(self):
+        loader = BatchLoader()
+        cls = MagicMock()
+        loader.prefetch(cls, [1, 2])
+        loader.store(cls, {_id: object() for _id in loader.take(cls)})
+
+        # only partly fetched in the batch
+        self.assertEqual(loader.claim(cls, [1, 3]), {})
+        self.assertEqual(loader.round_trips_saved, 0)
+
+        loader.claim(cls, [1, 2])
+        self.assertEqual(loader.round_trips_saved, 1)
+        # the local cache would have answered this anyway
+        loader.claim(cls, [1])
+        self.assertEqual(loader.round_trips_saved, 1)
+
+    def test_claim_stale(self):
+        loader = BatchLoader()
+        cls = MagicMock()
+        thing = object()
+        loader.prefetch(cls, [1])
+        loader.take(cls)
+        loader.store(cls, {1: thing}, stale=True)
+
+        # stale things can't answer lookups that want fresh ones
+        self.assertEqual(loader.claim(cls, [1]), {})
+        self.assertEqual(loader.round_trips_saved, 0)
+
+        self.assertEqual(loader.claim(cls, [1], stale=True), {1: thing})
+        self.assertEqual(loader.round_trips_saved, 1)
+
+    def test_forget(self):
+        loader = BatchLoader()
+        cls = MagicMock()
+        loader.prefetch(cls, [1])
+        loader.take(cls)
+        loader.store(cls, {1: object()}, stale=True)
+
+        loader.forget(cls, [1])
+
+        self.assertEqual(loader.claim(cls, [1], stale=True), {})
+
+    def test_flush(self):
+        loader = BatchLoader()
+        links, accounts = MagicMock(), MagicMock()
+        links._load_prefetched.return_value = {1: object(), 2: object()}
+        accounts._load_prefetched.return_value = {3: object()}
+        loader.prefetch(links, [1])
+        loader.prefetch(links, [2])
+        loader.prefetch(accounts, [3])
+
+        loader.flush()
+
+        self.assertEqual(
+            sorted(links._load_prefetched.call_args[0][0]), [1, 2])
+        accounts._load_prefetched.assert_called_once_with([3])
+        self.assertEqual(loader.batches, 2)
+        # each flush was a round trip of its own
+        self.assertEqual(loader.round_trips_saved, -2)
+
+        loader.claim(links, [1])
+        loader.claim(links, [2])
+        loader.claim(accounts, [3])
+        self.assertEqual(loader.round_trips_saved, 1)
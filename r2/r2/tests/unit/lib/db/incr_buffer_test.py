@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of
+# the Original Code is reddit Inc.
+#
+# All portions of the code written by reddit are Copyright (c) 2006-2016 reddit
+# Inc. All Rights Reserved.
+
+from mock import MagicMock
+
+from r2.lib.db.incr_buffer import IncrBuffer
+from r2.tests import RedditTestCase
+
+
+class IncrBufferTest(RedditTestCase):
+    def test_increments_coalesced(self):
+        write_fn = MagicMock()
+        buf = IncrBuffer(window=1, write_fn=write_fn)
+        self.assertTrue(buf.add((1, 10, "ups", True), 1))
+        self.assertFalse(buf.add((1, 10, "ups", True), 1))
+        buf.add((1, 10, "num_comments", False), 1)
+        buf.add((1, 11, "ups", True), 1)
+        buf.add((1, 11, "ups", True), -1)
+
+        self.assertEqual(buf.flush(), 2)
+        self.assertEqual(
+            sorted(call[0] for call in write_fn.call_args_list),
+            [((1, 10, "num_comments", False), 1),
+             ((1, 10, "ups", True), 2)],
+        )
+
+        write_fn.reset_mock()
+        self.assertEqual(buf.flush(), 0)
+        write_fn.assert_not_called()
+
+    def test_failed_writes_retried(self):
+        write_fn = MagicMock(side_effect=[Exception("db down"), None])
+        buf = IncrBuffer(window=1, write_fn=write_fn)
+        buf.add((1, 10, "ups", True), 3)
+
+        self.assertEqual(buf.flush(), 0)
+        self.assertEqual(buf.flush(), 1)
+        write_fn.assert_called_with((1, 10, "ups", True), 3)
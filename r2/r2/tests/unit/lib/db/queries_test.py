@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of
+# the Original Code is reddit Inc.
+#
+# All portions of the code written by reddit are Copyright (c) 2006-2016 reddit
+# Inc. All Rights Reserved.
+from mock import MagicMock
+
+from r2.lib.db import queries
+from r2.lib.db.queries import CoalescingQueryMutator
+from r2.tests import RedditTestCase
+
+
+def make_query(iden):
+    query = MagicMock(iden=iden, new_query=None)
+    query.filter.side_effect = lambda item: item
+    return query
+
+
+def make_link(fullname, score):
+    return MagicMock(_fullname=fullname, _score=score)
+
+
+class CoalescingQueryMutatorTest(RedditTestCase):
+    def setUp(self):
+        self.autopatch(queries, "CachedQueryMutator")
+        self.time = self.autopatch(queries.time, "time", return_value=100)
+        self.chan = MagicMock()
+
+    def test_coalesces_updates_within_window(self):
+        mutator = CoalescingQueryMutator("test_q", window=10)
+        query = make_query("hot")
+        other = make_query("new")
+
+        mutator.add_queries([query, other], insert_items=[make_link("a", 1)])
+        mutator.flush_if_due(self.chan)
+        self.time.return_value = 105
+        latest = make_link("a", 2)
+        mutator.add_queries([query], insert_items=[latest, make_link("b", 1)])
+        mutator.flush_if_due(self.chan)
+
+        self.assertFalse(query.insert.called)
+        self.assertFalse(self.chan.basic_ack.called)
+
+        self.time.return_value = 110
+        mutator.flush_if_due(self.chan)
+
+        inserted = query.insert.call_args[0][0]
+        self.assertEqual([(l._fullname, l._score) for l in inserted],
+                         [("a", 2), ("b", 1)])
+        self.assertEqual(other.insert.call_count, 1)
+        self.chan.basic_ack.assert_called_once_with(0, multiple=True)
+
+    def test_last_update_wins(self):
+        mutator = CoalescingQueryMutator("test_q", window=10)
+        query = make_query("hot")
+        link = make_link("a", 1)
+
+        mutator.add_queries([query], insert_items=[link])
+        mutator.add_queries([query], delete_items=[link])
+        mutator.flush(self.chan)
+
+        self.assertFalse(query.insert.called)
+        query.delete.assert_called_once_with([link])
+
+    def test_new_queries_written_in_one_batch(self):
+        mutator = CoalescingQueryMutator("test_q", window=0)
+        queries_ = [make_query("hot"), make_query("new")]
+        for query in queries_:
+            query.new_query = MagicMock()
+        link = make_link("a", 1)
+
+        mutator.add_queries(queries_, insert_items=[link])
+        mutator.flush_if_due(self.chan)
+
+        self.assertEqual(queries.CachedQueryMutator.call_count, 1)
+        m = queries.CachedQueryMutator.return_value.__enter__.return_value
+        self.assertEqual(m.insert.call_count, 2)
+
+    def test_stats(self):
+        stats = MagicMock()
+        self.patch_g(stats=stats)
+        mutator = CoalescingQueryMutator("test_q", window=10)
+        query = make_query("hot")
+
+        for score in xrange(5):
+            mutator.add_queries([query], insert_items=[make_link("a", score)])
+        mutator.flush(self.chan)
+
+        stats.simple_event.assert_any_call("query_coalescer.test_q.requested",
+                                           delta=5)
+        stats.simple_event.assert_any_call("query_coalescer.test_q.written",
+                                           delta=1)
+        stats.get_timer.assert_called_once_with("query_coalescer.test_q.flush")
+
+    def test_timer_name(self):
+        stats = MagicMock()
+        self.patch_g(stats=stats)
+        mutator = CoalescingQueryMutator("test_q", window=10,
+                                         timer="test_q.queries")
+
+        mutator.add_queries([make_query("hot")],
+                            insert_items=[make_link("a", 1)])
+        mutator.flush(self.chan)
+
+        stats.get_timer.assert_called_once_with("test_q.queries")
+
+    def test_idle_flush_without_messages(self):
+        mutator = CoalescingQueryMutator("test_q", window=10)
+
+        mutator.flush(self.chan)
+
+        self.assertFalse(self.chan.basic_ack.called)
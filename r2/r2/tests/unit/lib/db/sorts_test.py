@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of
+# the Original Code is reddit Inc.
+#
+# All portions of the code written by reddit are Copyright (c) 2006-2016 reddit
+# Inc. All Rights Reserved.
+
+import random
+import unittest
+from array import array
+
+from mock import MagicMock
+
+from r2.lib.db import sorts
+
+
+class BatchSortsTest(unittest.TestCase):
+    def setUp(self):
+        rand = random.Random(25)
+        # include both sides of the confidence lookup table boundary
+        self.ups = [0, 0, 1, 399, 400, 5000] + [
+            rand.randint(0, 2000) for _ in xrange(500)]
+        self.downs = [0, 3, 0, 99, 100, 10] + [
+            rand.randint(0, 300) for _ in xrange(500)]
+        self.dates = [1400000000 + rand.random() * 10 ** 7 for _ in self.ups]
+
+    def test_score(self):
+        expected = [sorts.score(u, d) for u, d in zip(self.ups, self.downs)]
+        self.assertEqual(list(sorts.batch_score(self.ups, self.downs)),
+                         expected)
+
+    def test_hot(self):
+        expected = [sorts._hot(u, d, date)
+                    for u, d, date in zip(self.ups, self.downs, self.dates)]
+        result = sorts.batch_hot(self.ups, self.downs, self.dates)
+        self.assertEqual(list(result), expected)
+
+    def test_controversy(self):
+        expected = [sorts.controversy(u, d)
+                    for u, d in zip(self.ups, self.downs)]
+        result = sorts.batch_controversy(self.ups, self.downs)
+        self.assertEqual(list(result), expected)
+
+    def test_confidence(self):
+        expected = [sorts.confidence(u, d)
+                    for u, d in zip(self.ups, self.downs)]
+        result = sorts.batch_confidence(self.ups, self.downs)
+        self.assertEqual(list(result), expected)
+
+    def test_qa(self):
+        answer = MagicMock(_ups=12, _downs=3, body="an answer")
+        lengths = [len(str(u)) * 10 for u in self.ups]
+        expected = [sorts.qa(u, d, length, [answer] if u % 2 else [])
+                    for u, d, length in zip(self.ups, self.downs, lengths)]
+
+        answer_score = sorts.confidence(answer._ups, answer._downs)
+        answer_scores = [answer_score if u % 2 else 0 for u in self.ups]
+        answer_lengths = [len(answer.body) if u % 2 else 1 for u in self.ups]
+        result = sorts.batch_qa(
+            self.ups, self.downs, lengths, answer_scores, answer_lengths)
+        self.assertEqual(list(result), expected)
+
+    def test_buffers(self):
+        result = sorts.batch_confidence(array('l', self.ups),
+                                        array('l', self.downs))
+        self.assertEqual(result.typecode, 'd')
+        self.assertEqual(list(result),
+                         list(sorts.batch_confidence(self.ups, self.downs)))
+
+    def test_empty(self):
+        self.assertEqual(list(sorts.batch_controversy([], [])), [])
+
+    def test_mismatched_lengths(self):
+        with self.assertRaises(ValueError):
+            sorts.batch_score([1, 2], [1])
+        with self.assertRaises(ValueError):
+            sorts.batch_hot([1, 2], [1, 2], [1400000000.])
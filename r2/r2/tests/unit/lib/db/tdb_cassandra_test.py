@@ -0,0 +1,284 @@
+#!/usr/bin/env python
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of
+# the Original Code is reddit Inc.
+#
+# All portions of the code written by reddit are Copyright (c) 2006-2016 reddit
+# Inc. All Rights Reserved.
+import threading
+
+from mock import MagicMock
+from pylons import app_globals as g
+
+from r2.lib.cache import LocalCache, ParallelFetcher
+from r2.lib.db import tdb_cassandra
+from r2.tests import RedditTestCase
+
+
+def make_relation(name, rows, last_modified=True):
+    cls = MagicMock()
+    cls.__name__ = name
+    cls._read_timeout = None
+    cls._cf.multiget.side_effect = lambda keys, columns: {
+        key: {c: rows[key][c] for c in columns if c in rows.get(key, {})}
+        for key in keys if key in rows}
+    cls._fast_query_thing2s.side_effect = (
+        lambda thing1, thing2s: thing2s if last_modified else [])
+    return cls
+
+
+def make_thing(id36):
+    thing = MagicMock()
+    thing._id36 = id36
+    return thing
+
+
+class MultigetTest(RedditTestCase):
+    def setUp(self):
+        self.patch_g(cassandra_fetcher=ParallelFetcher(pool_size=2),
+                     cassandra_read_timeout=0, stats=MagicMock())
+        self.autopatch(tdb_cassandra, "get_ledger", return_value=None)
+        self.reads_in_flight = self.autopatch(
+            tdb_cassandra, "_reads_in_flight", tdb_cassandra._ReadsInFlight())
+
+    def test_results_in_request_order(self):
+        saves = make_relation("Saves", {"u1": {"a": "1"}})
+        hides = make_relation("Hides", {"u1": {"b": "1"}})
+
+        results = tdb_cassandra.multiget([
+            (saves, ["u1"], ["a", "b"]),
+            (hides, ["u1"], ["a", "b"]),
+        ])
+
+        self.assertEqual(results, [{"u1": {"a": "1"}}, {"u1": {"b": "1"}}])
+        self.assertEqual(self.reads_in_flight.count, 0)
+
+    def test_reads_run_concurrently(self):
+        # each read waits for the other to start, so neither would see the
+        # other if they were made one after the other
+        started = {"Saves": threading.Event(), "Hides": threading.Event()}
+
+        def make_waiting_relation(name, other):
+            cls = make_relation(name, {})
+
+            def multiget(keys, columns):
+                started[name].set()
+                return {"saw_other": started[other].wait(5)}
+            cls._cf.multiget.side_effect = multiget
+            return cls
+
+        saves = make_waiting_relation("Saves", "Hides")
+        hides = make_waiting_relation("Hides", "Saves")
+
+        results = tdb_cassandra.multiget([
+            (saves, ["u1"], ["a"]),
+            (hides, ["u1"], ["a"]),
+        ])
+
+        self.assertEqual(results, [{"saw_other": True}, {"saw_other": True}])
+
+    def test_slow_read_times_out(self):
+        release = threading.Event()
+        self.addCleanup(release.set)
+        saves = make_relation("Saves", {})
+        hides = make_relation("Hides", {})
+        hides._cf.multiget.side_effect = lambda keys, columns: release.wait()
+        hides._read_timeout = 0.01
+
+        with self.assertRaises(tdb_cassandra.ReadTimeout):
+            tdb_cassandra.multiget([
+                (saves, ["u1"], ["a"]),
+                (hides, ["u1"], ["a"]),
+            ])
+
+        self.assertIn(tdb_cassandra.ReadTimeout,
+                      tdb_cassandra.TRANSIENT_EXCEPTIONS)
+
+    def test_return_exceptions(self):
+        release = threading.Event()
+        self.addCleanup(release.set)
+        saves = make_relation("Saves", {"u1": {"a": "1"}})
+        hides = make_relation("Hides", {})
+        hides._cf.multiget.side_effect = lambda keys, columns: release.wait()
+        hides._read_timeout = 0.01
+
+        saved, hidden = tdb_cassandra.multiget([
+            (saves, ["u1"], ["a"]),
+            (hides, ["u1"], ["a"]),
+        ], return_exceptions=True)
+
+        self.assertEqual(saved, {"u1": {"a": "1"}})
+        self.assertIsInstance(hidden, tdb_cassandra.ReadTimeout)
+
+    def test_serial_return_exceptions(self):
+        self.patch_g(cassandra_fetcher=None)
+        saves = make_relation("Saves", {})
+        saves._cf.multiget.side_effect = tdb_cassandra.ReadTimeout("slow")
+        hides = make_relation("Hides", {"u1": {"a": "1"}})
+
+        saved, hidden = tdb_cassandra.multiget([
+            (saves, ["u1"], ["a"]),
+            (hides, ["u1"], ["a"]),
+        ], return_exceptions=True)
+
+        self.assertIsInstance(saved, tdb_cassandra.ReadTimeout)
+        self.assertEqual(hidden, {"u1": {"a": "1"}})
+
+    def test_serial_when_pool_busy(self):
+        # a timed out read still holds a pool thread until it finishes
+        release = threading.Event()
+        self.addCleanup(release.set)
+        stuck = make_relation("Stuck", {})
+        stuck._cf.multiget.side_effect = lambda keys, columns: release.wait()
+        stuck._read_timeout = 0.01
+        with self.assertRaises(tdb_cassandra.ReadTimeout):
+            tdb_cassandra.multiget([
+                (stuck, ["u1"], ["a"]),
+                (make_relation("Saves", {}), ["u1"], ["a"]),
+            ])
+        self.assertEqual(self.reads_in_flight.count, 1)
+
+        threads = set()
+        def make_recording_relation(name):
+            cls = make_relation(name, {})
+            def multiget(keys, columns):
+                threads.add(threading.current_thread())
+                return {}
+            cls._cf.multiget.side_effect = multiget
+            return cls
+
+        results = tdb_cassandra.multiget([
+            (make_recording_relation("Saves"), ["u1"], ["a"]),
+            (make_recording_relation("Hides"), ["u1"], ["a"]),
+        ])
+
+        self.assertEqual(results, [{}, {}])
+        self.assertEqual(threads, {threading.current_thread()})
+        g.stats.simple_event.assert_any_call("cassandra.multiget.pool_busy")
+
+    def test_serial_without_fetcher(self):
+        self.patch_g(cassandra_fetcher=None)
+        saves = make_relation("Saves", {"u1": {"a": "1"}})
+        hides = make_relation("Hides", {})
+
+        results = tdb_cassandra.multiget([
+            (saves, ["u1"], ["a"]),
+            (hides, ["u1"], ["a"]),
+        ])
+
+        self.assertEqual(results, [{"u1": {"a": "1"}}, {}])
+
+
+class FastQueryMultiTest(RedditTestCase):
+    def setUp(self):
+        self.patch_g(cassandra_fetcher=ParallelFetcher(pool_size=2),
+                     cassandra_read_timeout=0)
+        self.autopatch(tdb_cassandra, "get_ledger", return_value=None)
+
+    def test_fast_query_multi(self):
+        user = make_thing("u1")
+        link1, link2 = make_thing("a"), make_thing("b")
+        saves = make_relation("Saves", {"u1": {"a": "1"}})
+        hides = make_relation("Hides", {"u1": {"a": "1", "b": "1"}})
+        visits = make_relation("Visits", {"u1": {"a": "1"}},
+                               last_modified=False)
+
+        results = tdb_cassandra.DenormalizedRelation.fast_query_multi([
+            (saves, user, [link1, link2]),
+            (visits, user, [link1, link2]),
+            (hides, user, [link1, link2]),
+        ])
+
+        self.assertEqual(results, [
+            {(user, link1): "1"},
+            {},
+            {(user, link1): "1", (user, link2): "1"},
+        ])
+        # nothing has been visited since the last visit was recorded
+        self.assertFalse(visits._cf.multiget.called)
+
+    def test_failures_isolated(self):
+        user = make_thing("u1")
+        link = make_thing("a")
+        saves = make_relation("Saves", {})
+        saves._cf.multiget.side_effect = tdb_cassandra.ReadTimeout("slow")
+        gildings = make_relation("Gildings", {})
+        gildings._fast_query_thing2s.side_effect = (
+            tdb_cassandra.ReadTimeout("slow"))
+        hides = make_relation("Hides", {"u1": {"a": "1"}})
+        queries = [
+            (gildings, user, [link]),
+            (saves, user, [link]),
+            (hides, user, [link]),
+        ]
+
+        gilded, saved, hidden = (
+            tdb_cassandra.DenormalizedRelation.fast_query_multi(
+                queries, return_exceptions=True))
+
+        self.assertIsInstance(gilded, tdb_cassandra.ReadTimeout)
+        self.assertIsInstance(saved, tdb_cassandra.ReadTimeout)
+        self.assertEqual(hidden, {(user, link): "1"})
+
+        with self.assertRaises(tdb_cassandra.ReadTimeout):
+            tdb_cassandra.DenormalizedRelation.fast_query_multi(queries)
+
+
+class ByIDMultiTest(RedditTestCase):
+    def setUp(self):
+        self.cache = LocalCache()
+        self.patch_g(cassandra_fetcher=None,
+                     cassandra_local_cache=self.cache,
+                     cassandra_read_timeout=0)
+        self.autopatch(tdb_cassandra, "get_ledger", return_value=None)
+
+    def make_class(self, prefix, rows):
+        cls = MagicMock()
+        cls._read_timeout = None
+        cls._fetch_all_columns = False
+        cls._cache_prefix.return_value = prefix
+        cls._cf.multiget.side_effect = lambda keys, column_count: {
+            key: rows[key] for key in keys if key in rows}
+
+        def from_columns(t_id, columns):
+            thing = MagicMock(_id=t_id, _partial=None, columns=columns)
+            thing._cache_key.return_value = prefix + t_id
+            return thing
+        cls._from_serialized_columns.side_effect = from_columns
+        return cls
+
+    def test_reads_misses_and_caches_them(self):
+        cached = MagicMock(_partial=None)
+        self.cache.set("p1_a", cached)
+        partial = MagicMock(_partial={"x"})
+        self.cache.set("p2_c", partial)
+        cls1 = self.make_class("p1_", {"b": {"x": "1"}})
+        cls2 = self.make_class("p2_", {"c": {"x": "2"}})
+
+        found1, found2 = tdb_cassandra.byID_multi([
+            (cls1, ["a", "b", "missing"]),
+            (cls2, ["c"]),
+        ])
+
+        self.assertIs(found1["a"], cached)
+        self.assertEqual(found1["b"].columns, {"x": "1"})
+        self.assertNotIn("missing", found1)
+        self.assertEqual(found2["c"].columns, {"x": "2"})
+        cls1._cf.multiget.assert_called_once_with(
+            ["b", "missing"], column_count=tdb_cassandra.max_column_count)
+        self.assertIs(self.cache.get("p1_b"), found1["b"])
+        self.assertIs(self.cache.get("p2_c"), found2["c"])
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of
+# the Original Code is reddit Inc.
+#
+# All portions of the code written by reddit are Copyright (c) 2006-2016 reddit
+# Inc. All Rights Reserved.
+
+from mock import MagicMock
+
+from r2.lib.db import operators, tdb_sql
+from r2.tests import RedditTestCase
+
+
+class DocumentTest(RedditTestCase):
+    def test_round_trip(self):
+        data = {"title": u"caf\xe9", "num_comments": 3, "flag": True,
+                "nothing": None, "list": [1, 2]}
+        loaded = tdb_sql.load_document(tdb_sql.dump_document(data))
+
+        self.assertEqual(loaded.title, "caf\xc3\xa9")
+        self.assertIsInstance(loaded.title, str)
+        self.assertEqual(loaded.num_comments, 3)
+        self.assertIs(loaded.flag, True)
+        self.assertIsNone(loaded.nothing)
+        self.assertEqual(loaded.list, [1, 2])
+
+    def test_missing_documents_read_from_data_table(self):
+        row = MagicMock(thing_id=1, data=tdb_sql.dump_document({"a": 1}))
+        self.autopatch(tdb_sql, "fetch_query", return_value=([row], False))
+        get_data = self.autopatch(
+            tdb_sql, "get_data", return_value={2: {"a": 2}})
+        data_table, document_table = MagicMock(), MagicMock()
+
+        res = tdb_sql.get_document_data(data_table, document_table, [1, 2])
+
+        get_data.assert_called_once_with(data_table, [2])
+        self.assertEqual(res, {1: {"a": 1}, 2: {"a": 2}})
+
+    def test_single_without_document(self):
+        self.autopatch(tdb_sql, "fetch_query", return_value=([], True))
+        self.autopatch(tdb_sql, "get_data", return_value={})
+
+        res = tdb_sql.get_document_data(MagicMock(), MagicMock(), 1)
+        self.assertEqual(res, {})
+
+
+class BulkInsertTest(RedditTestCase):
+    def setUp(self):
+        self.autopatch(tdb_sql, "transactions")
+        self.autopatch(tdb_sql, "BULK_INSERT_ROWS", 2)
+
+    def test_insert_rows_in_chunks(self):
+        table = MagicMock()
+        rows = [{"thing_id": i} for i in xrange(5)]
+
+        tdb_sql.insert_rows(table, rows)
+
+        values = table.insert.return_value.values
+        self.assertEqual([c[0][0] for c in values.call_args_list],
+                         [rows[0:2], rows[2:4], rows[4:5]])
+
+    def test_create_data_multi(self):
+        insert_rows = self.autopatch(tdb_sql, "insert_rows")
+        table = MagicMock()
+
+        tdb_sql.create_data_multi(table, {1: {"a": True}, 2: {"b": 3}})
+
+        rows = insert_rows.call_args[0][1]
+        self.assertEqual(
+            sorted(rows),
+            sorted([dict(thing_id=1, key="a", value="t", kind="bool"),
+                    dict(thing_id=2, key="b", value=3, kind="num")]),
+        )
+
+
+class StatementCacheTest(RedditTestCase):
+    def test_lru(self):
+        cache = tdb_sql.StatementCache(2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+
+        self.assertEqual(cache.get("a"), 1)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("c"), 3)
+
+    def test_disabled(self):
+        cache = tdb_sql.StatementCache(0)
+        cache.set("a", 1)
+        self.assertIsNone(cache.get("a"))
+
+
+class ConstraintsShapeTest(RedditTestCase):
+    def shape(self, *constraints):
+        return tdb_sql.constraints_shape(constraints, tdb_sql.is_data_op)
+
+    def test_values_not_in_shape(self):
+        c = operators.Slots()
+        self.assertEqual(self.shape(c._spam == False, c.sr_id == [1, 2]),
+                         self.shape(c._spam == True, c.sr_id == [3, 4]))
+        self.assertNotEqual(self.shape(c.sr_id == [1, 2]),
+                            self.shape(c.sr_id == [1, 2, 3]))
+        self.assertNotEqual(self.shape(c._spam == False),
+                            self.shape(c._spam == None))
+        self.assertNotEqual(
+            self.shape(c._date > operators.timeago("1 day")),
+            self.shape(c._date > operators.timeago("1 hour")),
+        )
+
+    def test_bind_constraints(self):
+        c = operators.Slots()
+        constraints = [
+            operators.or_(c._ups == 1, c._spam == None),
+            c.sr_id == [2, 3],
+            c._date > operators.timeago("1 day"),
+        ]
+
+        bound, params = tdb_sql.bind_constraints(
+            constraints, tdb_sql.is_data_op)
+
+        self.assertEqual(params, {"p0": 1, "p1": "2", "p2": "3"})
+        ops = list(operators.op_iter(bound))
+        self.assertIsNone(ops[1].rval[0])
+        self.assertIsInstance(ops[3].rval, operators.timeago)
+        # the original constraints are untouched
+        self.assertEqual(constraints[1].rval, [2, 3])
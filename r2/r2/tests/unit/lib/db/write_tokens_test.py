@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of
+# the Original Code is reddit Inc.
+#
+# All portions of the code written by reddit are Copyright (c) 2006-2016 reddit
+# Inc. All Rights Reserved.
+
+import unittest
+
+from r2.lib.db.write_tokens import MAX_KINDS, WriteTokens
+
+
+SECRET = "secret"
+
+
+def sign(value):
+    return "%s|%s" % (value, WriteTokens._mac(value, SECRET))
+
+
+class WriteTokensTest(unittest.TestCase):
+    def test_cookie_round_trip(self):
+        tokens = WriteTokens()
+        tokens.record("t1", 1000.2)
+        tokens.record("r5", 990)
+        self.assertTrue(tokens.dirty)
+
+        value = tokens.to_cookie(SECRET)
+        self.assertEqual(value, sign("r5:990.000,t1:1000.200"))
+
+        loaded = WriteTokens.from_cookie(value, now=1005, window=30,
+                                         secret=SECRET)
+        self.assertEqual(loaded.writes, {"t1": 1000.2, "r5": 990})
+        self.assertFalse(loaded.dirty)
+
+    def test_token_from_just_now_kept(self):
+        # the next request may come in the same second as the write, or
+        # be handled by a server whose clock is slightly behind
+        tokens = WriteTokens()
+        tokens.record("t1", 1000.2004)
+        loaded = WriteTokens.from_cookie(
+            tokens.to_cookie(SECRET), now=1000.1, window=30, secret=SECRET)
+        self.assertEqual(loaded.writes, {"t1": 1000.201})
+
+    def test_bad_and_expired_tokens_ignored(self):
+        value = sign("t1:1000,t2:900,t3:2000,t4:junk,junk,:1000")
+        loaded = WriteTokens.from_cookie(value, now=1005, window=30,
+                                         secret=SECRET)
+        self.assertEqual(loaded.writes, {"t1": 1000})
+
+    def test_kinds_limited(self):
+        value = sign(",".join("t%d:%d" % (i, 1000 + i) for i in xrange(50)))
+        loaded = WriteTokens.from_cookie(value, now=1100, window=300,
+                                         secret=SECRET)
+        self.assertEqual(len(loaded.writes), MAX_KINDS)
+        self.assertIn("t49", loaded.writes)
+        self.assertNotIn("t0", loaded.writes)
+
+    def test_unsigned_tokens_ignored(self):
+        tokens = WriteTokens({"t1": 1000})
+        value = tokens.to_cookie(SECRET)
+        forged = value.replace("t1:", "t3:")
+        for cookie in (value, forged, "t1:1000.000", "t1:1000.000|"):
+            loaded = WriteTokens.from_cookie(cookie, now=1005, window=30,
+                                             secret="other secret")
+            self.assertEqual(loaded.writes, {})
+
+        loaded = WriteTokens.from_cookie(forged, now=1005, window=30,
+                                         secret=SECRET)
+        self.assertEqual(loaded.writes, {})
+
+    def test_last_write(self):
+        tokens = WriteTokens({"t1": 1000})
+        self.assertEqual(tokens.last_write("t1", now=1010, window=30), 1000)
+        self.assertIsNone(tokens.last_write("t1", now=1031, window=30))
+        self.assertIsNone(tokens.last_write("t2", now=1010, window=30))
+        self.assertTrue(tokens.wrote_recently(now=1010, window=30))
+        self.assertFalse(tokens.wrote_recently(now=1031, window=30))
@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of
+# the Original Code is reddit Inc.
+#
+# All portions of the code written by reddit are Copyright (c) 2006-2016 reddit
+# Inc. All Rights Reserved.
+
+import collections
+import random
+import unittest
+
+from mock import MagicMock
+
+from r2.lib.manager.db_manager import db_manager
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.
+
+    def __call__(self):
+        return self.now
+
+
+class FakeEngine(object):
+    """An engine that reports a set replication lag."""
+
+    def __init__(self, name, lag=0.):
+        self.name = name
+        self.lag = lag
+        self.lag_checks = 0
+        self.statements = []
+
+    def connect(self):
+        conn = MagicMock()
+        conn.execute.side_effect = self.execute
+        return conn
+
+    def execute(self, query):
+        self.statements.append(query)
+        if query.startswith("SET"):
+            return MagicMock()
+        self.lag_checks += 1
+        if self.lag is None:
+            raise Exception("connection refused")
+        return MagicMock(scalar=MagicMock(return_value=self.lag))
+
+    def __repr__(self):
+        return self.name
+
+
+def make_tables(*engines):
+    # table tuples are bound to their engine through their first element
+    return [(MagicMock(bind=engine),) for engine in engines]
+
+
+class ReadRoutingSimulationTest(unittest.TestCase):
+    def setUp(self):
+        random.seed(0)
+        self.clock = FakeClock()
+        self.dbm = db_manager(lag_check_interval=5, max_lag=30,
+                              clock=self.clock)
+        self.master = FakeEngine("master")
+        self.replica1 = FakeEngine("replica1")
+        self.replica2 = FakeEngine("replica2")
+        self.tables = make_tables(self.master, self.replica1, self.replica2)
+
+    def read(self, n=1000, tables=None, last_write=None):
+        counts = collections.Counter()
+        for i in xrange(n):
+            table = self.dbm.get_read_table(tables or self.tables,
+                                            last_write=last_write)
+            counts[table[0].bind.name] += 1
+        return counts
+
+    def test_random_without_lag_checks(self):
+        dbm = db_manager()
+        counts = collections.Counter(
+            dbm.get_read_table(self.tables)[0].bind.name
+            for i in xrange(300))
+        self.assertEqual(len(counts), 3)
+        self.assertEqual(self.replica1.lag_checks, 0)
+
+    def test_lagging_replica_avoided(self):
+        self.replica2.lag = 120
+        counts = self.read()
+        self.assertEqual(counts["replica2"], 0)
+        self.assertTrue(counts["master"] and counts["replica1"])
+
+        # it's used again once it catches up and its lag is rechecked
+        self.replica2.lag = 0
+        self.clock.now += 6
+        self.assertTrue(self.read()["replica2"])
+
+    def test_lag_checked_once_per_interval(self):
+        self.read(n=50)
+        self.assertEqual(self.replica1.lag_checks, 1)
+        self.clock.now += 6
+        self.read(n=50)
+        self.assertEqual(self.replica1.lag_checks, 2)
+
+    def test_failed_lag_check_avoided(self):
+        self.replica1.lag = None
+        self.assertEqual(self.read()["replica1"], 0)
+
+    def test_lag_check_timeout(self):
+        self.read(n=1)
+        self.assertEqual(self.replica1.statements[0],
+                         "SET LOCAL statement_timeout = 250")
+
+    def test_weighted_by_latency(self):
+        for i in xrange(20):
+            self.dbm.record_latency(self.master, 0.002)
+            self.dbm.record_latency(self.replica1, 0.002)
+            self.dbm.record_latency(self.replica2, 0.050)
+        counts = self.read(n=3000)
+        self.assertGreater(counts["replica1"], 10 * counts["replica2"])
+        self.assertGreater(counts["replica2"], 0)
+
+    def test_all_lagging_uses_least_behind(self):
+        tables = make_tables(self.replica1, self.replica2)
+        self.replica1.lag = 100
+        self.replica2.lag = 50
+        self.assertEqual(self.read(tables=tables), {"replica2": 1000})
+
+    def test_reads_after_write_need_fresh_replicas(self):
+        self.replica1.lag = 3
+        self.replica2.lag = 20
+        last_write = self.clock.now
+
+        self.clock.now += 1
+        self.assertEqual(self.read(last_write=last_write), {"master": 1000})
+
+        # replica1 caught up three seconds after the write, but that isn't
+        # known until its lag is checked again
+        self.clock.now += 3
+        self.assertEqual(self.read(last_write=last_write), {"master": 1000})
+
+        self.clock.now += 2
+        counts = self.read(last_write=last_write)
+        self.assertEqual(counts["replica2"], 0)
+        self.assertTrue(counts["replica1"])
+
+        # reads without a recent write use any replica within max_lag
+        self.assertTrue(self.read()["replica2"])
+
+    def test_fresh_fallback_with_avoid_master(self):
+        self.replica1.lag = 3
+        self.replica2.lag = 3
+        master_table = self.tables[0]
+        last_write = self.clock.now
+        self.clock.now += 1
+
+        table = self.dbm.get_read_table(
+            self.tables[1:], master=master_table, last_write=last_write)
+        self.assertIs(table, master_table)
+
+        self.clock.now += 5
+        table = self.dbm.get_read_table(
+            self.tables[1:], master=master_table, last_write=last_write)
+        self.assertIsNot(table, master_table)
+
+    def test_users_recent_write_without_lag_checks(self):
+        dbm = db_manager()
+        table = dbm.get_read_table(
+            self.tables[1:], master=self.tables[0],
+            last_write=self.clock.now)
+        self.assertIs(table, self.tables[0])
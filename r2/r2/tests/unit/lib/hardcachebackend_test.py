@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of
+# the Original Code is reddit Inc.
+#
+# All portions of the code written by reddit are Copyright (c) 2006-2016 reddit
+# Inc. All Rights Reserved.
+import unittest
+from datetime import datetime, timedelta
+
+import pytz
+import sqlalchemy as sa
+
+from r2.lib import hardcachebackend
+from r2.lib.hardcachebackend import HardCacheBackend, _union
+
+
+class AwareDateTime(sa.types.TypeDecorator):
+    """Keep the time zone that SQLite (unlike Postgres) drops."""
+    impl = sa.DateTime
+
+    def process_bind_param(self, value, dialect):
+        if value is not None and value.tzinfo is not None:
+            value = value.astimezone(pytz.utc).replace(tzinfo=None)
+        return value
+
+    def process_result_value(self, value, dialect):
+        if value is not None and value.tzinfo is None:
+            value = value.replace(tzinfo=pytz.utc)
+        return value
+
+
+class FakeGlobals(object):
+    def __init__(self, engine):
+        self.engine = engine
+        self.db_app_name = "test"
+        self.db_create_tables = True
+        self.sqlprinting = False
+        self.display_tz = hardcachebackend.TZ
+        self.hardcache_categories = ["*:db:db", "part:db:db:!partitioned"]
+        self.config = {
+            "hardcache_partition_hours": 3,
+            "hardcache_partition_count": 2,
+        }
+
+    @property
+    def dbm(self):
+        return self
+
+    def get_engine(self, name):
+        return self.engine
+
+
+def make_backend():
+    engine = sa.create_engine("sqlite://", poolclass=sa.pool.StaticPool)
+    backend = HardCacheBackend(FakeGlobals(engine))
+
+    make_table = backend._make_table
+    def _make_table(metadata, name=None):
+        table = make_table(metadata, name)
+        table.c.expiration.type = AwareDateTime()
+        return table
+    backend._make_table = _make_table
+    for table in backend.mapping["*"] + backend._partitions.values():
+        table.c.expiration.type = AwareDateTime()
+    return backend
+
+
+class PartitionRoutingTest(unittest.TestCase):
+    def setUp(self):
+        self.backend = make_backend()
+        self.main = self.backend.mapping["*"][0]
+
+    def test_unpartitioned_category(self):
+        expiration = datetime.now(pytz.utc) + timedelta(hours=1)
+        self.assertFalse(self.backend.is_partitioned("other"))
+        self.assertEqual(self.backend.tables("other"), [self.main])
+        self.assertEqual(
+            self.backend.table_for_expiration("other", expiration), self.main)
+
+    def test_tables_cover_live_buckets(self):
+        tables = self.backend.tables("part")
+        self.assertEqual(len(tables), 1 + 3)
+        self.assertEqual(tables[0], self.main)
+
+        bucket = self.backend.live_buckets()[0]
+        self.assertEqual(tables[1].name,
+                         "test_hardcache_" + bucket.strftime("%Y%m%d%H"))
+
+    def test_expiration_picks_bucket(self):
+        bucket = self.backend.live_buckets()[1]
+        expiration = bucket + timedelta(minutes=90)
+        table = self.backend.table_for_expiration("part", expiration)
+        self.assertEqual(table, self.backend.partition(self.main, bucket))
+
+    def test_far_expiration_stays_in_main_table(self):
+        expiration = datetime.now(pytz.utc) + timedelta(days=2)
+        table = self.backend.table_for_expiration("part", expiration)
+        self.assertEqual(table, self.main)
+
+    def test_bucket(self):
+        self.assertEqual(
+            self.backend.bucket(datetime(2016, 1, 1, 5, 30, tzinfo=pytz.utc)),
+            datetime(2016, 1, 1, 3, tzinfo=pytz.utc))
+
+
+class HardCacheBackendTest(unittest.TestCase):
+    def setUp(self):
+        self.backend = make_backend()
+        self.main = self.backend.mapping["*"][0]
+
+    def count_rows(self, category, ids):
+        count = 0
+        for table in self.backend.tables(category):
+            count += len(sa.select(
+                [table.c.ids],
+                sa.and_(table.c.category == category, table.c.ids == ids),
+            ).execute().fetchall())
+        return count
+
+    def test_set_and_get(self):
+        self.backend.set("part", "a", "value", time=60)
+        self.backend.set("other", "a", 5, time=60)
+        self.assertEqual(self.backend.get("part", "a"), "value")
+        self.assertEqual(self.backend.get("other", "a"), 5)
+        self.assertIsNone(self.backend.get("part", "b"))
+
+    def test_get_multi_by_category(self):
+        self.backend.set("part", "a", 1, time=60)
+        self.backend.set("part", "b", 2, time=86400 * 3)
+        self.backend.set("other", "a", "three", time=60)
+
+        results = self.backend.get_multi_by_category({
+            "part": ["a", "b", "missing"],
+            "other": ["a"],
+        })
+        self.assertEqual(results, {
+            "part-a": 1,
+            "part-b": 2,
+            "other-a": "three",
+        })
+
+    def test_get_multi_by_category_latest_wins(self):
+        soon = datetime.now(pytz.utc) + timedelta(minutes=1)
+        later = datetime.now(pytz.utc) + timedelta(days=3)
+        self.backend.table_for_expiration("part", soon).insert().execute(
+            category="part", ids="a", value="old", kind="str",
+            expiration=soon)
+        self.main.insert().execute(
+            category="part", ids="a", value="new", kind="str",
+            expiration=later)
+
+        results = self.backend.get_multi_by_category({"part": ["a"]})
+        self.assertEqual(results, {"part-a": "new"})
+        self.assertEqual(self.backend.get("part", "a"), "new")
+
+    def test_get_skips_expired(self):
+        past = datetime.now(pytz.utc) - timedelta(minutes=1)
+        self.main.insert().execute(
+            category="part", ids="a", value="gone", kind="str",
+            expiration=past)
+        self.assertIsNone(self.backend.get("part", "a"))
+        self.assertEqual(
+            self.backend.get_multi_by_category({"part": ["a"]}), {})
+
+    def test_move(self):
+        self.backend.set("part", "a", "value", time=86400 * 3)
+        target = self.backend.tables("part")[1]
+
+        self.backend.move(self.main, target, "part", "a")
+
+        rows = sa.select([target.c.value]).execute().fetchall()
+        self.assertEqual([row.value for row in rows], ["value"])
+        self.assertEqual(sa.select([self.main]).execute().fetchall(), [])
+
+    def test_move_missing(self):
+        target = self.backend.tables("part")[1]
+        self.backend.move(self.main, target, "part", "a")
+        self.assertEqual(sa.select([target]).execute().fetchall(), [])
+
+    def test_union(self):
+        tables = self.backend.tables("part")[:2]
+        selects = [sa.select([table.c.ids]) for table in tables]
+        self.assertIs(_union(selects[:1]), selects[0])
+
+        tables[0].insert().execute(
+            category="part", ids="a", value="1", kind="num",
+            expiration=datetime.now(pytz.utc))
+        tables[1].insert().execute(
+            category="part", ids="b", value="2", kind="num",
+            expiration=datetime.now(pytz.utc))
+        rows = _union(selects).execute().fetchall()
+        self.assertEqual(sorted(row.ids for row in rows), ["a", "b"])
+        rows = _union(selects, limit=1).execute().fetchall()
+        self.assertEqual(len(rows), 1)
+
+    def test_add(self):
+        self.assertEqual(self.backend.add("part", "a", 1, time=60), 1)
+        self.assertEqual(self.backend.add("part", "a", 2, time=60), 1)
+        self.assertEqual(self.backend.get("part", "a"), 1)
+        self.assertEqual(self.count_rows("part", "a"), 1)
+
+    def test_add_across_partitions(self):
+        self.backend.add("part", "a", "first", time=60)
+        # would go in the main table rather than the partition
+        self.assertEqual(
+            self.backend.add("part", "a", "second", time=86400 * 3), "first")
+        self.assertEqual(self.count_rows("part", "a"), 1)
+
+    def test_add_unpartitioned(self):
+        self.assertEqual(self.backend.add("other", "a", 1, time=60), 1)
+        self.assertEqual(self.backend.add("other", "a", 2, time=60), 1)
+        self.assertEqual(self.count_rows("other", "a"), 1)
+
+    def test_lock_key(self):
+        key = hardcachebackend._lock_key("part", "a")
+        self.assertEqual(key, hardcachebackend._lock_key("part", u"a"))
+        self.assertNotEqual(key, hardcachebackend._lock_key("part", "b"))
+        self.assertTrue(-2 ** 63 <= key < 2 ** 63)
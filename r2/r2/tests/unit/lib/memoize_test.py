@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of
+# the Original Code is reddit Inc.
+#
+# All portions of the code written by reddit are Copyright (c) 2006-2016 reddit
+# Inc. All Rights Reserved.
+###############################################################################
+import unittest
+
+from mock import MagicMock, patch
+from pylons import app_globals as g
+
+from r2.lib import memoize as memoize_module
+from r2.lib.cache import NoneResult
+from r2.lib.memoize import memoize, should_refresh_early
+from r2.tests import RedditTestCase
+
+
+class ShouldRefreshEarlyTest(unittest.TestCase):
+    @patch("random.random", return_value=0.5)
+    def test_refresh_window(self, random):
+        # -log(0.5) is about 0.69, so a value that took 10 seconds to compute
+        # is refreshed once it's within 6.9 seconds of expiring
+        self.assertFalse(should_refresh_early(10, 100, now=93))
+        self.assertTrue(should_refresh_early(10, 100, now=94))
+
+    @patch("random.random", return_value=0.5)
+    def test_beta(self, random):
+        self.assertFalse(should_refresh_early(10, 100, beta=0.5, now=96))
+        self.assertTrue(should_refresh_early(10, 100, beta=2, now=87))
+
+    @patch("random.random", return_value=0.0)
+    def test_expired(self, random):
+        self.assertFalse(should_refresh_early(10, 100, now=99))
+        self.assertTrue(should_refresh_early(10, 100, now=100))
+
+
+class MemoizeEarlyRefreshTest(RedditTestCase):
+    def setUp(self):
+        self.cached = {}
+        cache = MagicMock()
+        cache.get.side_effect = lambda key, stale=False: self.cached.get(key)
+        cache.set.side_effect = (
+            lambda key, val, time=0: self.cached.__setitem__(key, val))
+        self.patch_g(memoizecache=cache, make_lock=MagicMock(),
+                     stats=MagicMock())
+        self.unix_time = self.autopatch(memoize_module, "unix_time")
+        self.should_refresh_early = self.autopatch(
+            memoize_module, "should_refresh_early", return_value=False)
+
+        self.fn = MagicMock(return_value="result")
+        self.memoized = memoize("fn", time=60, early_refresh=True)(self.fn)
+
+    def only_key(self):
+        self.assertEqual(len(self.cached), 1)
+        return self.cached.keys()[0]
+
+    def test_stores_compute_time_and_expiry(self):
+        self.unix_time.side_effect = [100, 102]
+
+        self.assertEqual(self.memoized(1), "result")
+
+        self.assertEqual(self.cached[self.only_key()], ("result", 2, 162))
+
+    def test_cached(self):
+        self.unix_time.side_effect = [100, 102]
+        self.memoized(1)
+
+        self.assertEqual(self.memoized(1), "result")
+
+        self.assertEqual(self.fn.call_count, 1)
+        self.should_refresh_early.assert_called_once_with(2, 162, 1.0)
+
+    def test_refreshes_early_without_lock(self):
+        self.unix_time.side_effect = [100, 102, 150, 151]
+        self.memoized(1)
+        self.fn.return_value = "new result"
+        self.should_refresh_early.return_value = True
+        g.make_lock.reset_mock()
+
+        self.assertEqual(self.memoized(1), "new result")
+
+        self.assertFalse(g.make_lock.called)
+        self.assertEqual(self.cached[self.only_key()],
+                         ("new result", 1, 211))
+        g.stats.simple_event.assert_called_with("memoize.early_refresh")
+
+    def test_none_result(self):
+        self.unix_time.side_effect = [100, 102]
+        self.fn.return_value = None
+
+        self.assertIsNone(self.memoized(1))
+        self.assertIsNone(self.memoized(1))
+
+        self.assertEqual(self.fn.call_count, 1)
+        self.assertEqual(self.cached[self.only_key()], (NoneResult, 2, 162))
+
+    def test_ignores_plain_values(self):
+        # a value stored before early_refresh was turned on isn't a tuple,
+        # so it's left to expire rather than unpacked
+        legacy = memoize("fn", time=60)(self.fn)
+        legacy(1)
+        legacy_key = self.only_key()
+        self.unix_time.side_effect = [100, 102]
+        self.fn.return_value = "new result"
+
+        self.assertEqual(self.memoized(1), "new result")
+
+        self.assertEqual(self.cached[legacy_key], "result")
+        self.assertEqual(len(self.cached), 2)
+
+    def test_needs_time(self):
+        with self.assertRaises(ValueError):
+            memoize("fn", early_refresh=True)
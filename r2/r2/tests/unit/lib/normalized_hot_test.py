@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of
+# the Original Code is reddit Inc.
+#
+# All portions of the code written by reddit are Copyright (c) 2006-2016 reddit
+# Inc. All Rights Reserved.
+from mock import MagicMock
+
+from r2.lib import normalized_hot
+from r2.lib.cache import LocalCache
+from r2.lib.db.queries import hot_links_version_key
+from r2.tests import RedditTestCase
+
+
+class MaterializedHotTest(RedditTestCase):
+    def setUp(self):
+        self.cache = LocalCache()
+        self.stats = MagicMock()
+        self.patch_g(gencache=self.cache, stats=self.stats,
+                     normalized_hot_cache_time=60,
+                     normalized_hot_refresh_interval=0)
+        self.listings = {
+            1: [("t3_a", 30, 10), ("t3_b", 10, 10)],
+            2: [("t3_c", 20, 10)],
+            3: [("t3_d", 25, 10)],
+        }
+        self.get_hot_tuples = self.autopatch(
+            normalized_hot, "get_hot_tuples", side_effect=self.hot_tuples)
+
+    def hot_tuples(self, sr_ids, ageweight=None, now_seconds=None):
+        return {sr_id: [(-hot, -hot, name, timestamp, sr_id)
+                        for name, hot, timestamp in self.listings[sr_id]]
+                for sr_id in sr_ids}
+
+    def names(self, sr_ids):
+        tuples = normalized_hot.get_merged_hot_tuples(
+            sr_ids, oldest=0, obey_age_limit=True, ageweight=None)
+        return [t[2] for t in tuples]
+
+    def events(self):
+        return [c[0][0] for c in self.stats.simple_event.call_args_list]
+
+    def test_shared_between_orderings(self):
+        self.assertEqual(self.names([1, 2, 3]), ["t3_a", "t3_d", "t3_c", "t3_b"])
+        self.assertEqual(self.names([3, 2, 1]), ["t3_a", "t3_d", "t3_c", "t3_b"])
+
+        self.assertEqual(self.get_hot_tuples.call_count, 1)
+        self.assertEqual(self.events(), ["normalized_hot.cache.miss",
+                                         "normalized_hot.cache.hit"])
+
+    def test_only_changed_subreddits_refetched(self):
+        self.names([1, 2, 3])
+
+        self.listings[2] = [("t3_c", 40, 10), ("t3_e", 5, 10)]
+        self.cache.set(hot_links_version_key(2), 1234.5)
+
+        self.assertEqual(self.names([1, 2, 3]),
+                         ["t3_c", "t3_a", "t3_d", "t3_b", "t3_e"])
+        now_seconds = self.get_hot_tuples.call_args_list[0][1]["now_seconds"]
+        self.get_hot_tuples.assert_called_with(
+            {2}, ageweight=None, now_seconds=now_seconds)
+        self.assertEqual(self.names([1, 2, 3]),
+                         ["t3_c", "t3_a", "t3_d", "t3_b", "t3_e"])
+        self.assertEqual(self.events()[1:], ["normalized_hot.cache.partial",
+                                             "normalized_hot.cache.hit"])
+
+    def test_refresh_interval(self):
+        self.patch_g(normalized_hot_refresh_interval=60)
+        self.names([1, 2, 3])
+
+        self.listings[2] = [("t3_c", 40, 10)]
+        self.cache.set(hot_links_version_key(2), 1234.5)
+
+        self.assertEqual(self.names([1, 2, 3]),
+                         ["t3_a", "t3_d", "t3_c", "t3_b"])
+        self.assertEqual(self.get_hot_tuples.call_count, 1)
+        self.assertEqual(self.events()[1:], ["normalized_hot.cache.deferred"])
+
+    def test_disabled(self):
+        self.patch_g(normalized_hot_cache_time=0)
+
+        self.names([1, 2])
+        self.names([1, 2])
+
+        self.assertEqual(self.get_hot_tuples.call_count, 2)
+        self.assertFalse(self.stats.simple_event.called)
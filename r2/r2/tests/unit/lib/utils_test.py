@@ -436,6 +436,32 @@ class UtilsTest(unittest.TestCase):
         )
 
 
+class TestStreamThings(unittest.TestCase):
+    def setUp(self):
+        self.query = MagicMock(_sort="ascending")
+        self.query._stream.return_value = iter([[1, 2], [3]])
+
+    def test_items(self):
+        checkpoints = []
+        items = []
+        for item in utils.stream_things(self.query, batch_size=2,
+                                        checkpoint_fn=checkpoints.append):
+            # checkpoints are only made once a batch has been handled
+            self.assertEqual(checkpoints, [2] if item == 3 else [])
+            items.append(item)
+
+        self.assertEqual(items, [1, 2, 3])
+        self.assertEqual(checkpoints, [2, 3])
+        self.query._stream.assert_called_once_with(2, use_cache=False)
+
+    def test_chunks(self):
+        chunks = list(utils.stream_things(self.query, chunks=True,
+                                          use_cache=True))
+
+        self.assertEqual(chunks, [[1, 2], [3]])
+        self.query._stream.assert_called_once_with(1000, use_cache=True)
+
+
 class TestCanonicalizeEmail(unittest.TestCase):
     def test_empty_string(self):
         canonical = utils.canonicalize_email("")
@@ -27,8 +27,8 @@ from mock import MagicMock
 from r2.lib.utils.comment_tree_utils import get_tree_details, calc_num_children
 from r2.lib.db import operators
 from r2.models import builder
-from r2.models import Comment
-from r2.models.builder import CommentBuilder
+from r2.models import Account, Comment
+from r2.models.builder import Builder, CommentBuilder
 from r2.models.comment_tree import CommentTree
 from r2.tests import RedditTestCase
 
@@ -337,3 +337,21 @@ class CommentOrderTest(RedditTestCase):
             [100, 102, 104, 105, 106, 103, 107, 108, 109])
         self.assertEqual(builder.missing_root_comments, set())
         self.assertEqual(builder.missing_root_count, 0)
+
+
+class CommentWrapTest(RedditTestCase):
+    def test_link_author_prefetched(self):
+        link = MagicMock()
+        link.author_id = 5
+        prefetch = self.autopatch(Account, "_prefetch")
+
+        def wrap_items(builder, items):
+            # in time to be fetched along with the comments' authors
+            prefetch.assert_called_once_with(5)
+            return []
+        wrap = self.autopatch(Builder, "wrap_items", side_effect=wrap_items)
+
+        builder = CommentBuilder(link, operators.desc("_confidence"))
+        builder.comments = []
+        self.assertEqual(builder.make_wrapped_items([]), [])
+        self.assertTrue(wrap.called)
@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of
+# the Original Code is reddit Inc.
+#
+# All portions of the code written by reddit are Copyright (c) 2006-2016 reddit
+# Inc. All Rights Reserved.
+import json
+import random
+import unittest
+
+from mock import MagicMock, patch
+
+from r2.lib.db.operators import asc, desc
+from r2.models import query_cache
+from r2.models.query_cache import (
+    CachedQuery,
+    CachedQueryMutator,
+    MergedCachedQuery,
+    SORTED_COLUMN,
+    SubredditQueryCache,
+    ThingTupleComparator,
+    insort,
+    merge_sorted,
+)
+
+
+class InsortTest(unittest.TestCase):
+    def test_keeps_sort_order(self):
+        sort_cols = [desc("_score"), asc("_date")]
+        comparator = ThingTupleComparator(sort_cols)
+        data = [("a", 10, 1), ("b", 5, 1), ("c", 5, 3)]
+
+        insort(data, ("d", 5, 2), comparator)
+        insort(data, ("e", 11, 0), comparator)
+        insort(data, ("f", 0, 0), comparator)
+
+        self.assertEqual([t[0] for t in data], ["e", "a", "b", "d", "c", "f"])
+
+
+class MergeSortedTest(unittest.TestCase):
+    def setUp(self):
+        self.comparator = ThingTupleComparator([desc("_hot"), asc("_date")])
+        rand = random.Random(1)
+        self.lists = []
+        for i in xrange(5):
+            items = [("t3_%d_%d" % (i, j), rand.randint(0, 5), rand.randint(0, 3))
+                     for j in xrange(rand.randint(0, 20))]
+            items.sort(cmp=self.comparator)
+            self.lists.append(items)
+        self.lists.append([])
+
+    def expected(self, after=None, reverse=False, limit=None):
+        # what sorting everything and looking for `after` would give
+        items = sorted(sum(self.lists, []), cmp=self.comparator)[:limit]
+        names = [item[0] for item in items]
+        if reverse:
+            names.reverse()
+        if after:
+            if after not in names:
+                return []
+            names = names[names.index(after) + 1:]
+        return names
+
+    def merged(self, **kw):
+        return [item[0]
+                for item in merge_sorted(self.lists, self.comparator, **kw)]
+
+    def test_merge(self):
+        self.assertEqual(self.merged(), self.expected())
+        self.assertEqual(self.merged(reverse=True),
+                         self.expected(reverse=True))
+
+    def test_after(self):
+        for name in self.expected():
+            for reverse in (False, True):
+                self.assertEqual(
+                    self.merged(after=name, reverse=reverse),
+                    self.expected(after=name, reverse=reverse),
+                )
+        self.assertEqual(self.merged(after="t3_missing"), [])
+
+    def test_limit(self):
+        for after in [None] + self.expected():
+            for reverse in (False, True):
+                self.assertEqual(
+                    self.merged(after=after, reverse=reverse, limit=10),
+                    self.expected(after=after, reverse=reverse, limit=10),
+                )
+
+    def test_lazy(self):
+        calls = []
+
+        def comparator(a, b):
+            calls.append(1)
+            return self.comparator(a, b)
+
+        lists = [[(str(j), i, 0) for i in xrange(1000, 0, -1)]
+                 for j in xrange(10)]
+        merged = merge_sorted(lists, comparator)
+        first = [next(merged) for _ in xrange(25)]
+
+        self.assertEqual([item[1] for item in first[:10]], [1000] * 10)
+        self.assertLess(len(calls), 500)
+
+
+class PresortedQueryCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.sort = [desc("_score")]
+        self.cf = MagicMock()
+        patches = [
+            patch.object(SubredditQueryCache, "_cf", self.cf, create=True),
+            patch.object(SubredditQueryCache, "_presorted", True),
+            patch.object(query_cache.g, "make_lock", MagicMock()),
+            patch.object(query_cache, "Mutator", MagicMock()),
+        ]
+        for p in patches:
+            p.start()
+            self.addCleanup(p.stop)
+
+    def stored(self, items):
+        value = json.dumps([list(item) for item in items])
+        return {SORTED_COLUMN: (value, 1)}
+
+    def written(self):
+        key, columns = self.cf.insert.call_args[0]
+        return [tuple(item) for item in json.loads(columns[SORTED_COLUMN])]
+
+    def test_update_sorted(self):
+        self.cf.get.return_value = self.stored(
+            [("t3_a", 10), ("t3_b", 5), ("t3_c", 1)])
+
+        SubredditQueryCache.update_sorted("key", self.sort, [
+            ("t3_c", [20]),
+            ("t3_d", [7]),
+            ("t3_b", None),
+        ])
+
+        self.assertEqual(self.written(),
+                         [("t3_c", 20), ("t3_a", 10), ("t3_d", 7)])
+        self.assertFalse(self.cf.remove.called)
+
+    def test_update_sorted_truncates(self):
+        items = [("t3_%d" % i, i) for i in xrange(query_cache.MAX_CACHED_ITEMS)]
+        items.reverse()
+        self.cf.get.return_value = self.stored(items)
+
+        SubredditQueryCache.update_sorted("key", self.sort, [
+            ("t3_new", [-1]),
+            ("t3_top", [10000]),
+        ])
+
+        written = self.written()
+        self.assertEqual(len(written), query_cache.MAX_CACHED_ITEMS)
+        self.assertEqual(written[0], ("t3_top", 10000))
+        self.assertEqual(written[-1], ("t3_1", 1))
+
+    def test_update_sorted_converts_old_rows(self):
+        self.cf.get.return_value = {
+            "t3_a": (json.dumps([1]), 1),
+            "t3_b": (json.dumps([3]), 1),
+        }
+
+        SubredditQueryCache.update_sorted("key", self.sort, [("t3_c", [2])])
+
+        self.assertEqual(self.written(),
+                         [("t3_b", 3), ("t3_c", 2), ("t3_a", 1)])
+        key = self.cf.remove.call_args[0][0]
+        columns = self.cf.remove.call_args[1]["columns"]
+        self.assertEqual((key, sorted(columns)), ("key", ["t3_a", "t3_b"]))
+
+    def test_update_sorted_merges_item_columns(self):
+        # item columns written by a host that doesn't presort
+        columns = self.stored([("t3_a", 10), ("t3_b", 5)])
+        columns["t3_b"] = (json.dumps([20]), 2)
+        columns["t3_c"] = (json.dumps([7]), 3)
+        self.cf.get.return_value = columns
+
+        SubredditQueryCache.update_sorted("key", self.sort, [("t3_d", [1])])
+
+        self.assertEqual(self.written(),
+                         [("t3_b", 20), ("t3_a", 10), ("t3_c", 7), ("t3_d", 1)])
+        # columns written after the read must survive the removal
+        (key,), kw = self.cf.remove.call_args
+        self.assertEqual((key, sorted(kw["columns"]), kw["timestamp"]),
+                         ("key", ["t3_b", "t3_c"], 3))
+
+    def test_fetch_merges_item_columns(self):
+        columns = self.stored([("t3_a", 10), ("t3_b", 5)])
+        columns["t3_b"] = (json.dumps([20]), 2)
+        self.cf.multiget.return_value = {"key": columns}
+        query = CachedQuery(SubredditQueryCache, "key", self.sort,
+                            query_cache.filter_identity, False)
+
+        self.assertEqual(list(query), ["t3_b", "t3_a"])
+
+    def test_fetch_does_not_sort(self):
+        self.cf.multiget.return_value = {
+            "key": self.stored([("t3_a", 1), ("t3_b", 2)]),
+        }
+        query = CachedQuery(SubredditQueryCache, "key", self.sort,
+                            query_cache.filter_identity, False)
+
+        # stored in order, so it isn't re-sorted even if it looks wrong
+        self.assertEqual(list(query), ["t3_a", "t3_b"])
+
+    def test_mutator_batches_updates(self):
+        query = CachedQuery(SubredditQueryCache, "key", self.sort,
+                            query_cache.filter_identity, False)
+        link = MagicMock(_fullname="t3_a", _score=3)
+        self.cf.get.return_value = self.stored([("t3_b", 5)])
+
+        with CachedQueryMutator() as m:
+            m.insert(query, [link])
+            m.delete(query, [MagicMock(_fullname="t3_b")])
+
+        self.assertEqual(self.cf.get.call_count, 1)
+        self.assertEqual(self.written(), [("t3_a", 3)])
+
+    def test_merged_query(self):
+        self.cf.multiget.return_value = {
+            "sr1": {
+                "t3_a": (json.dumps([1]), 1),
+                "t3_b": (json.dumps([4]), 1),
+            },
+            "sr2": self.stored([("t3_c", 3), ("t3_d", 2)]),
+        }
+        queries = [CachedQuery(SubredditQueryCache, key, self.sort,
+                               query_cache.filter_identity, False)
+                   for key in ("sr1", "sr2")]
+        merged = MergedCachedQuery(queries)
+
+        self.assertEqual(list(merged), ["t3_b", "t3_c", "t3_d", "t3_a"])
+        self.assertEqual(list(merged.iter_after("t3_c")), ["t3_d", "t3_a"])
+        self.assertEqual(list(merged.iter_after("t3_d", reverse=True)),
+                         ["t3_c", "t3_b"])
@@ -21,14 +21,24 @@
 # Inc. All Rights Reserved.
 ###############################################################################
 
+import time
+
 from mock import MagicMock, patch
 
+from r2.lib.bloom import BloomFilter
+from r2.lib.db import operators
+from r2.lib.db.batch_loader import BatchLoader
 from r2.lib.db.thing import (
     CreationError,
+    DataThing,
     hooks,
+    incr_buffer,
+    NEGATIVE_FILTER_DIRTY,
     NotFound,
+    Relation,
     tdb,
     Thing,
+    Things,
 )
 from r2.lib.lock import TimeoutExpired
 from r2.tests import RedditTestCase
@@ -199,6 +209,148 @@ class TestThingReadCaching(RedditTestCase):
         self.assertEqual(ret, "one")
 
 
+class TestThingPrefetch(RedditTestCase):
+    def setUp(self):
+        self.get_things_from_cache = self.autopatch(
+            Thing, "get_things_from_cache")
+        self.autopatch(Thing, "_load_missing", return_value={})
+        self.cached = {}
+        self.get_things_from_cache.side_effect = (
+            lambda ids, stale: {_id: self.cached[_id] for _id in ids})
+        self.loader = BatchLoader()
+        loader_patch = patch("r2.lib.db.thing.get_loader",
+                             return_value=self.loader)
+        loader_patch.start()
+        self.addCleanup(loader_patch.stop)
+
+    def test_prefetched_with_next_lookup(self):
+        SimpleThing._prefetch([2, 3])
+        self.cached.update({1: "one", 2: "two", 3: "three"})
+
+        ret = SimpleThing._byID([1], stale=False)
+
+        self.assertEqual(ret, {1: "one"})
+        self.assertEqual(
+            sorted(self.get_things_from_cache.call_args[0][0]), [1, 2, 3])
+        self.assertEqual(self.loader.batches, 1)
+
+    def test_stale_lookup_served_from_batch(self):
+        SimpleThing._prefetch(2)
+        self.cached.update({1: "one", 2: "two"})
+        SimpleThing._byID([1], stale=True)
+        self.get_things_from_cache.reset_mock()
+
+        ret = SimpleThing._byID(2, stale=True)
+
+        self.assertEqual(ret, "two")
+        self.assertFalse(self.get_things_from_cache.called)
+        self.assertEqual(self.loader.round_trips_saved, 1)
+
+    def test_fresh_lookup_not_served_stale_batch(self):
+        SimpleThing._prefetch(2)
+        self.cached.update({1: "one", 2: "two"})
+        SimpleThing._byID([1], stale=True)
+
+        SimpleThing._byID(2, stale=False)
+
+        self.get_things_from_cache.assert_called_with([2], stale=False)
+        self.assertEqual(self.loader.round_trips_saved, 0)
+
+
+class OtherThing(Thing):
+    _nodb = True
+    _type_name = "otherthing"
+    _type_id = 101
+    _cache = SimpleThing._cache
+
+
+class TestThingByFullname(RedditTestCase):
+    def setUp(self):
+        self.get_things_from_db = self.autopatch(Thing, "get_things_from_db")
+        self.write_things_to_cache = self.autopatch(Thing, "write_things_to_cache")
+        self.patch_g(thing_lookup_fetcher=None)
+        self.cache = self.autopatch(SimpleThing, "_cache")
+        self.autopatch(OtherThing, "_cache", self.cache)
+        self.patch_dict = patch.dict(
+            "r2.lib.db.thing.thing_types",
+            {SimpleThing._type_id: SimpleThing, OtherThing._type_id: OtherThing},
+        )
+        self.patch_dict.start()
+        self.addCleanup(self.patch_dict.stop)
+
+    def test_shared_cache_read_once(self):
+        self.cache.simple_get_multi.return_value = {"SimpleThing_1": "one"}
+        self.get_things_from_db.return_value = {2: "two"}
+
+        ret = Thing._by_fullname(["t2t_2", "t2s_1"], return_dict=False)
+        self.assertEqual(self.cache.simple_get_multi.call_count, 1)
+        keys = self.cache.simple_get_multi.call_args[0][0]
+        self.assertEqual(sorted(keys), ["OtherThing_2", "SimpleThing_1"])
+        self.get_things_from_db.assert_called_once_with([2])
+        self.write_things_to_cache.assert_called_once_with({2: "two"})
+        self.assertEqual(ret, ["two", "one"])
+
+    def test_not_found(self):
+        self.cache.simple_get_multi.return_value = {"SimpleThing_1": "one"}
+        self.get_things_from_db.return_value = {}
+
+        with self.assertRaises(NotFound):
+            Thing._by_fullname(["t2s_1", "t2t_2"])
+
+        ret = Thing._by_fullname(["t2s_1", "t2t_2"], ignore_missing=True)
+        self.assertEqual(ret, {"t2s_1": "one"})
+
+
+class TestThingsStream(RedditTestCase):
+    def setUp(self):
+        self.things = {}
+        for _id in xrange(1, 6):
+            thing = SimpleThing()
+            thing._id = _id
+            thing._date = 100 - _id
+            self.things[_id] = thing
+        self.autopatch(Thing, "get_things_from_db",
+            side_effect=lambda ids: {_id: self.things[_id] for _id in ids})
+
+        self.opened = []
+        def stream_thing_ids(constraints, batch_size, **kw):
+            self.opened.append(list(constraints))
+            ids = sorted(self.things)
+            if len(constraints) > 1:
+                after = constraints[-1].ops[0].ops[0].rval
+                ids = [_id for _id in ids if self.things[_id]._date < after]
+            for i in xrange(0, len(ids), batch_size):
+                yield ids[i:i + batch_size]
+        self.autopatch(tdb, "stream_thing_ids", side_effect=stream_thing_ids)
+
+        self.query = Things(SimpleThing, SimpleThing.c._spam == False,
+                            sort=operators.desc("_date"))
+
+    def stream_ids(self, **kw):
+        return [[thing._id for thing in things]
+                for things in self.query._stream(**kw)]
+
+    def test_single_cursor(self):
+        self.assertEqual(self.stream_ids(batch_size=2), [[1, 2], [3, 4], [5]])
+        self.assertEqual(len(self.opened), 1)
+
+    def test_reopens_after_last_thing(self):
+        ids = self.stream_ids(batch_size=2, cursor_rows=2)
+        self.assertEqual(ids, [[1, 2], [3, 4], [5]])
+        self.assertEqual(len(self.opened), 3)
+
+        # each cursor starts after the last thing, not after every one so far
+        self.assertEqual([len(rules) for rules in self.opened], [1, 2, 2])
+        self.assertEqual(len(self.query._rules), 2)
+
+    def test_reopens_after_time(self):
+        ids = self.stream_ids(batch_size=2, cursor_seconds=0)
+        self.assertEqual(ids, [[1, 2], [3, 4], [5]])
+
+        # the last cursor is only known to be the last when it comes up empty
+        self.assertEqual(len(self.opened), 4)
+
+
 class FakeLock(object):
     def __init__(self):
         self.have_lock = True
@@ -273,6 +425,30 @@ class TestThingWrite(RedditTestCase):
         SimpleThing.write_props_to_db.assert_called_once_with({'ups': 12}, {'other_prop': 101}, False)
         SimpleThing.write_thing_to_cache.assert_called_once_with(self.lock)
 
+    @patch("r2.lib.db.thing.tdb.create_things_data")
+    @patch("r2.lib.db.thing.tdb.make_things")
+    def test_bulk_create(self, make_things, create_things_data):
+        make_things.return_value = [10, 11]
+        cache = self.autopatch(SimpleThing, "_cache")
+        things = [SimpleThing(ups=1), SimpleThing(ups=2)]
+        things[0].other_prop = 100
+
+        SimpleThing._bulk_create(things)
+
+        rows = make_things.call_args[0][1]
+        self.assertEqual([row["ups"] for row in rows], [1, 2])
+        create_things_data.assert_called_once_with(
+            SimpleThing._type_id, {10: {"other_prop": 100}})
+        self.assertEqual([thing._id for thing in things], [10, 11])
+        self.assertFalse(any(thing._dirty for thing in things))
+        SimpleThing.write_new_thing_to_db.assert_not_called()
+        cache.set_multi.assert_called_once_with(
+            {10: things[0], 11: things[1]},
+            prefix=SimpleThing._cache_prefix(),
+            time=SimpleThing._cache_ttl,
+        )
+        self.assertEqual(hooks.get_hook.return_value.call.call_count, 2)
+
 
 class TestThingIncr(RedditTestCase):
     def setUp(self):
@@ -355,6 +531,43 @@ class TestThingIncr(RedditTestCase):
             prop_for_data=1,
         )
 
+    @patch("r2.lib.db.tdb_sql.incr_thing_prop")
+    def test_incr_buffered(self, incr_thing_prop):
+        buf = MagicMock()
+        buf.add.return_value = True
+        cache = self.autopatch(SimpleThing, "_cache")
+        self.patch_g(incr_buffer_window=1)
+        self.autopatch(incr_buffer, "get_buffer", return_value=buf)
+        self.autopatch(SimpleThing, "_buffered_incr_props", ("_ups",))
+        thing = SimpleThing(
+            ups=1,
+            downs=0,
+            spam=False,
+            deleted=False,
+        )
+        thing._commit()
+
+        self.reset_mocks()
+
+        thing._incr("_ups")
+        self.assertEqual(thing._ups, 2)
+        buf.add.assert_called_once_with(
+            (SimpleThing._type_id, thing._id, "ups", True), 1)
+        incr_thing_prop.assert_not_called()
+        self.assertEqual(SimpleThing.write_thing_to_cache.call_count, 1)
+        cache.set.assert_called_once_with(
+            "incr_pending_SimpleThing_%d" % thing._id, True, time=3)
+
+        # the pending marker is only set once per flush
+        buf.add.return_value = False
+        thing._incr("_ups")
+        self.assertEqual(cache.set.call_count, 1)
+
+        # props that aren't buffered are written right away
+        thing._incr("_downs")
+        self.assertEqual(buf.add.call_count, 2)
+        self.assertEqual(incr_thing_prop.call_count, 1)
+
     def test_incr_dirty(self):
         thing = SimpleThing(
             ups=1,
@@ -372,6 +585,59 @@ class TestThingIncr(RedditTestCase):
             thing._incr("_ups")
 
 
+class TestThingUnsettledLoad(RedditTestCase):
+    def setUp(self):
+        self.patch_g(incr_buffer_window=1, stats=MagicMock())
+        self.cache = self.autopatch(SimpleThing, "_cache")
+        self.autopatch(SimpleThing, "_buffered_incr_props", ("_ups",))
+        self.autopatch(Thing, "record_cache_write")
+        self.write_things_to_cache = self.autopatch(
+            Thing, "write_things_to_cache")
+        self.things = {
+            1: SimpleThing(ups=1, downs=0),
+            2: SimpleThing(ups=5, downs=0),
+        }
+        for _id, thing in self.things.iteritems():
+            thing._id = _id
+
+    def test_settled_load(self):
+        self.cache.get_multi.return_value = {}
+        SimpleThing._loaded_from_db(self.things)
+        self.write_things_to_cache.assert_called_once_with(self.things)
+
+    def test_load_with_buffered_increments(self):
+        self.cache.get_multi.return_value = {2: True}
+        SimpleThing._loaded_from_db(self.things)
+
+        self.cache.get_multi.assert_called_once_with(
+            [1, 2], prefix="incr_pending_SimpleThing_")
+        self.assertEqual(self.write_things_to_cache.call_args_list, [
+            (({1: self.things[1]},), {}),
+            (({2: self.things[2]},), {"time": 3}),
+        ])
+        self.assertAlmostEqual(
+            self.things[2]._incr_unsettled_until, time.time() + 3, delta=1)
+
+    def test_unsettled_copy_expires(self):
+        thing = self.things[2]
+        thing._incr_unsettled_until = time.time() + 2.5
+        thing.write_thing_to_cache(FakeLock())
+        self.cache.set.assert_called_once_with(
+            "SimpleThing_2", thing, time=2)
+
+        # once the increments are written it's cached as usual
+        thing._incr_unsettled_until = None
+        thing.write_thing_to_cache(FakeLock())
+        self.cache.set.assert_called_with(
+            "SimpleThing_2", thing, time=SimpleThing._cache_ttl)
+
+    def test_unbuffered_class(self):
+        self.autopatch(SimpleThing, "_buffered_incr_props", ())
+        SimpleThing._loaded_from_db(self.things)
+        self.cache.get_multi.assert_not_called()
+        self.write_things_to_cache.assert_called_once_with(self.things)
+
+
 class TestThingWriteConflict(RedditTestCase):
     def setUp(self):
         self.lock = FakeLock()
@@ -482,3 +748,107 @@ class TestThingWriteConflict(RedditTestCase):
             thing._commit()
 
         tdb.transactions.rollback.assert_called_once_with()
+
+
+class SimpleRelation(Relation(SimpleThing, OtherThing)):
+    _negative_filter = True
+    _negative_filter_cache = MagicMock()
+    _rel_cache = MagicMock()
+
+
+class TestRelationNegativeFilter(RedditTestCase):
+    def setUp(self):
+        self.patch_g(rel_negative_filters=True, stats=MagicMock(),
+                     make_lock=MagicMock(), disallow_db_writes=False)
+        self.cache = self.autopatch(SimpleRelation, "_negative_filter_cache")
+        self.autopatch(SimpleRelation, "_rel_cache")
+        self.autopatch(SimpleRelation, "_byID_rel", return_value={})
+        sgm_patch = patch("r2.lib.db.thing.sgm")
+        self.sgm = sgm_patch.start()
+        self.addCleanup(sgm_patch.stop)
+
+    def test_fast_query_skips_negatives(self):
+        negative_filter = BloomFilter(10)
+        negative_filter.add(2)
+        key = SimpleRelation._negative_filter_key(1, "friend")
+        self.cache.get_multi.return_value = {key: negative_filter}
+        self.sgm.return_value = {}
+
+        thing1 = SimpleThing(id=1)
+        thing2s = [OtherThing(id=2), OtherThing(id=3)]
+        ret = SimpleRelation._fast_query(thing1, thing2s, "friend")
+
+        keys = self.sgm.call_args[1]["keys"]
+        self.assertEqual(keys, ["rel:SimpleRelation_1_2_friend"])
+        self.assertIsNone(ret[(thing1, thing2s[1], "friend")])
+
+    def test_built_filter_added_to_memcache(self):
+        self.cache.get_multi.return_value = {}
+        memcache = self.cache.caches[-1]
+        memcache.add.return_value = True
+        self.autopatch(SimpleRelation, "_build_negative_filter",
+                       return_value=BloomFilter(10))
+
+        filters = SimpleRelation._get_negative_filters([1], ["friend"])
+
+        self.assertEqual(memcache.add.call_args[0][0],
+                         SimpleRelation._negative_filter_key(1, "friend"))
+        self.assertIn((1, "friend"), filters)
+
+    def test_filter_built_from_master(self):
+        query = self.autopatch(SimpleRelation, "_simple_query",
+                               return_value=[MagicMock(_thing2_id=2)])
+
+        negative_filter = SimpleRelation._build_negative_filter(1, "friend")
+
+        self.assertTrue(query.call_args[1]["master"])
+        self.assertIn(2, negative_filter)
+        self.assertNotIn(3, negative_filter)
+
+    def test_no_filter_without_master(self):
+        self.patch_g(disallow_db_writes=True)
+        self.cache.get_multi.return_value = {}
+        query = self.autopatch(SimpleRelation, "_simple_query")
+
+        filters = SimpleRelation._get_negative_filters([1], ["friend"])
+
+        self.assertEqual(filters, {})
+        self.assertFalse(query.called)
+        self.assertFalse(self.cache.caches[-1].add.called)
+
+    def test_built_filter_unused_if_add_fails(self):
+        self.cache.get_multi.return_value = {}
+        self.cache.caches[-1].add.return_value = False
+        self.autopatch(SimpleRelation, "_build_negative_filter",
+                       return_value=BloomFilter(10))
+
+        filters = SimpleRelation._get_negative_filters([1], ["friend"])
+
+        self.assertEqual(filters, {})
+
+    @patch.object(DataThing, "_commit")
+    def test_commit_adds_to_filter(self, _commit):
+        negative_filter = BloomFilter(10)
+        self.cache.get.return_value = negative_filter
+
+        rel = SimpleRelation(1, 2, "friend")
+        rel._id = 1
+        rel._commit()
+
+        self.cache.get.assert_called_once_with(
+            SimpleRelation._negative_filter_key(1, "friend"),
+            allow_local=False)
+        args = self.cache.set.call_args[0]
+        self.assertEqual(args[0], SimpleRelation._negative_filter_key(1, "friend"))
+        self.assertIn(2, args[1])
+
+    @patch.object(DataThing, "_commit")
+    def test_commit_without_filter_marks_dirty(self, _commit):
+        self.cache.get.return_value = None
+
+        rel = SimpleRelation(1, 2, "friend")
+        rel._id = 1
+        rel._commit()
+
+        args = self.cache.set.call_args[0]
+        self.assertEqual(args[1], NEGATIVE_FILTER_DIRTY)
@@ -0,0 +1,112 @@
+#!/usr/bin/python
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of
+# the Original Code is reddit Inc.
+#
+# All portions of the code written by reddit are Copyright (c) 2006-2015 reddit
+# Inc. All Rights Reserved.
+###############################################################################
+"""Compare creating things one at a time with Thing._bulk_create.
+
+Creates throwaway things with a few data props in benchmark tables of their
+own (on the link database) and reports the rows written per second by
+_commit in a loop and by _bulk_create.
+
+    paster run run.ini scripts/benchmark_bulk_create.py -c "benchmark()"
+
+The benchmark tables are dropped afterwards.
+
+"""
+
+import time
+
+from r2.lib.cache import LocalCache
+from r2.lib.db import tdb_sql
+from r2.lib.db.thing import Thing
+from r2.lib.utils import storage
+from r2.models import Link
+
+
+BENCH_NAME = "bulkbench"
+
+
+class BulkBenchThing(Thing):
+    _nodb = True
+    _type_name = BENCH_NAME
+    _type_id = max(tdb_sql.types_id) + 1000
+    _cache = LocalCache()
+
+
+def make_tables():
+    engine = tdb_sql.get_write_table(
+        tdb_sql.types_id[Link._type_id].tables)[0].bind
+    metadata = tdb_sql.make_metadata(engine)
+    thing_table = tdb_sql.get_thing_table(metadata, BENCH_NAME)
+    data_table = tdb_sql.get_data_table(metadata, BENCH_NAME)
+    thing_table.create(checkfirst=True)
+    data_table.create(checkfirst=True)
+    return thing_table, data_table
+
+
+def make_things(count, num_props):
+    things = []
+    for i in xrange(count):
+        thing = BulkBenchThing(ups=1)
+        for prop in xrange(num_props):
+            setattr(thing, "prop_%d" % prop, u"value %d" % i)
+        things.append(thing)
+    return things
+
+
+def time_create(create, count, num_props):
+    things = make_things(count, num_props)
+    start = time.time()
+    create(things)
+    return time.time() - start
+
+
+def commit_each(things):
+    for thing in things:
+        thing._commit()
+
+
+def benchmark(count=2000, num_props=4):
+    thing_table, data_table = make_tables()
+    tdb_sql.types_id[BulkBenchThing._type_id] = storage(
+        type_id=BulkBenchThing._type_id,
+        name=BENCH_NAME,
+        avoid_master_reads=False,
+        data_documents=None,
+        tables=[(thing_table, data_table, None)],
+    )
+    rows = count * (1 + num_props)
+
+    try:
+        commit_time = time_create(commit_each, count, num_props)
+        bulk_time = time_create(BulkBenchThing._bulk_create, count, num_props)
+    finally:
+        del tdb_sql.types_id[BulkBenchThing._type_id]
+        data_table.drop()
+        thing_table.drop()
+
+    print "%d things with %d data props (%d rows), %d rows per INSERT" % (
+        count, num_props, rows, tdb_sql.BULK_INSERT_ROWS)
+    print "%-14s %10s %12s" % ("method", "seconds", "rows/sec")
+    for name, elapsed in (("_commit", commit_time),
+                          ("_bulk_create", bulk_time)):
+        print "%-14s %10.2f %12.0f" % (name, elapsed, rows / elapsed)
+    print "speedup %.1fx" % (commit_time / bulk_time)
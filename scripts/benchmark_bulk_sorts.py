@@ -0,0 +1,132 @@
+#!/usr/bin/python
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of
+# the Original Code is reddit Inc.
+#
+# All portions of the code written by reddit are Copyright (c) 2006-2015 reddit
+# Inc. All Rights Reserved.
+###############################################################################
+"""Time scoring a comment thread per item and in batches.
+
+Builds fake threads of comments and reports the time to compute every
+comment's sort value with the per-item sort functions and with the batch
+functions in r2.lib.db.sorts, both for the bare formulas and including
+reading the votes off the comments as calculate_comment_scores does.
+
+    paster run run.ini scripts/benchmark_bulk_sorts.py -c "benchmark()"
+
+"""
+
+import random
+import time
+
+from r2.lib.db import sorts
+
+
+class FakeComment(object):
+    """Just the vote counts and sort properties of a Thing."""
+
+    def __init__(self, ups, downs, date):
+        self._ups = ups
+        self._downs = downs
+        self._date = date
+
+    @property
+    def _hot(self):
+        return sorts._hot(self._ups, self._downs, self._date)
+
+    @property
+    def _score(self):
+        return sorts.score(self._ups, self._downs)
+
+    @property
+    def _controversy(self):
+        return sorts.controversy(self._ups, self._downs)
+
+    @property
+    def _confidence(self):
+        return sorts.confidence(self._ups, self._downs)
+
+
+def make_comments(count):
+    return [FakeComment(int(random.paretovariate(1.2)) - 1,
+                        int(random.paretovariate(1.5)) - 1,
+                        1400000000 + random.random() * 10 ** 7)
+            for _ in xrange(count)]
+
+
+def per_item(sort, comments):
+    return [getattr(c, sort) for c in comments]
+
+
+def batch(batch_fn, comments):
+    return batch_fn([c._ups for c in comments], [c._downs for c in comments])
+
+
+def batch_hot(comments):
+    return sorts.batch_hot([c._ups for c in comments],
+                           [c._downs for c in comments],
+                           [c._date for c in comments])
+
+
+def best_time(fn, rounds):
+    best = None
+    for _ in xrange(rounds):
+        start = time.time()
+        fn()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def benchmark(size=100000, rounds=5):
+    comments = make_comments(size)
+    ups = [c._ups for c in comments]
+    downs = [c._downs for c in comments]
+    dates = [c._date for c in comments]
+
+    print "%d comments" % size
+    print "%14s %12s %12s %12s %8s" % ("sort", "inputs", "per item ms",
+                                       "batch ms", "speedup")
+
+    cases = [
+        ("_score", sorts.score, sorts.batch_score),
+        ("_controversy", sorts.controversy, sorts.batch_controversy),
+        ("_confidence", sorts.confidence, sorts.batch_confidence),
+        ("_hot", sorts._hot, sorts.batch_hot),
+    ]
+    for sort, sort_fn, batch_fn in cases:
+        args = (ups, downs, dates) if sort == "_hot" else (ups, downs)
+        if sort == "_hot":
+            from_comments = batch_hot
+        else:
+            from_comments = lambda comments: batch(batch_fn, comments)
+        assert per_item(sort, comments) == list(from_comments(comments))
+
+        old = best_time(lambda: map(sort_fn, *args), rounds)
+        new = best_time(lambda: batch_fn(*args), rounds)
+        print "%14s %12s %12.1f %12.1f %7.1fx" % (
+            sort, "lists", old * 1000, new * 1000, old / new)
+
+        old = best_time(lambda: per_item(sort, comments), rounds)
+        new = best_time(lambda: from_comments(comments), rounds)
+        print "%14s %12s %12.1f %12.1f %7.1fx" % (
+            sort, "comments", old * 1000, new * 1000, old / new)
+
+
+if __name__ == "__main__":
+    benchmark()
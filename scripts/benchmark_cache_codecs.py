@@ -0,0 +1,121 @@
+#!/usr/bin/python
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of
+# the Original Code is reddit Inc.
+#
+# All portions of the code written by reddit are Copyright (c) 2006-2015 reddit
+# Inc. All Rights Reserved.
+###############################################################################
+"""Compare the size and speed of cache codecs on real cache values.
+
+Samples recent things from each thing cache namespace, encodes them with
+every available codec and reports the bytes and CPU time compared to what
+pylibmc does by default (pickle protocol 2, zlib compressed above
+min_compress_len).
+
+    paster run run.ini scripts/benchmark_cache_codecs.py -c "benchmark()"
+
+Other values can be measured by passing them in:
+
+    benchmark({"rendercache": g.rendercache.get_multi(keys).values()})
+
+"""
+
+import cPickle as pickle
+import time
+import zlib
+
+from r2.lib.cache import CacheCodec, lz4, msgpack
+from r2.lib.db.operators import desc
+from r2.models import Account, Comment, Link, Subreddit
+
+
+THING_NAMESPACES = (Account, Comment, Link, Subreddit)
+MIN_COMPRESS_LEN = 1400
+
+
+def available_codecs():
+    serializers = ["pickle"]
+    if msgpack:
+        serializers.append("msgpack")
+
+    compressors = [None, "zlib", "snappy"]
+    if lz4:
+        compressors.append("lz4")
+
+    for serializer in serializers:
+        for compressor in compressors:
+            spec = serializer + ("+" + compressor if compressor else "")
+            yield spec, CacheCodec(serializer, compressor,
+                                   min_compress_len=MIN_COMPRESS_LEN)
+
+
+def sample_things(limit):
+    samples = {}
+    for cls in THING_NAMESPACES:
+        q = cls._query(sort=desc("_date"), limit=limit, data=True)
+        samples[cls.__name__] = list(q)
+    return samples
+
+
+def pylibmc_size(val):
+    # approximately what pylibmc stores for a value
+    if isinstance(val, str):
+        data = val
+    else:
+        data = pickle.dumps(val, protocol=2)
+    if len(data) >= MIN_COMPRESS_LEN:
+        data = zlib.compress(data)
+    return len(data)
+
+
+def measure(codec, values):
+    start = time.time()
+    encoded = [codec.encode(val) for val in values]
+    encode_time = time.time() - start
+
+    start = time.time()
+    for data in encoded:
+        codec.decode(data)
+    decode_time = time.time() - start
+
+    size = sum(len(data) if isinstance(data, str) else 8
+               for data in encoded)
+    return size, encode_time, decode_time
+
+
+def benchmark(samples=None, limit=1000):
+    if samples is None:
+        samples = sample_things(limit)
+
+    codecs = list(available_codecs())
+    for namespace, values in sorted(samples.iteritems()):
+        if not values:
+            continue
+
+        baseline = sum(pylibmc_size(val) for val in values)
+        print "%s: %d values, %d bytes with pylibmc defaults" % (
+            namespace, len(values), baseline)
+        print "    %-16s %10s %8s %12s %12s" % (
+            "codec", "bytes", "saved", "encode ms", "decode ms")
+
+        for spec, codec in codecs:
+            size, encode_time, decode_time = measure(codec, values)
+            print "    %-16s %10d %7.1f%% %12.2f %12.2f" % (
+                spec, size, 100. * (baseline - size) / baseline,
+                encode_time * 1000, decode_time * 1000)
+        print
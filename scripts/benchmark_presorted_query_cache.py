@@ -0,0 +1,97 @@
+#!/usr/bin/python
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of
+# the Original Code is reddit Inc.
+#
+# All portions of the code written by reddit are Copyright (c) 2006-2015 reddit
+# Inc. All Rights Reserved.
+###############################################################################
+"""Time reading cached query listings stored each way.
+
+Builds rows like Cassandra returns them for listings of a few sizes, in
+the column-per-item layout and in the presorted layout, and reports the
+time per fetch to turn each into the sorted list of item tuples.
+
+    paster run run.ini scripts/benchmark_presorted_query_cache.py -c "benchmark()"
+
+"""
+
+import json
+import random
+import time
+
+from r2.models.query_cache import (
+    SORTED_COLUMN,
+    SubredditQueryCache,
+    ThingTupleComparator,
+)
+
+
+SORT_COLS = ["_hot", "_date"]
+
+
+def make_items(count):
+    items = []
+    for i in xrange(count):
+        fullname = "t3_%s" % i
+        hot = round(random.uniform(0, 10000), 7)
+        date = 1400000000 + random.randint(0, 10 ** 7)
+        items.append((fullname, hot, date))
+    return items
+
+
+def unsorted_row(items):
+    # columns come back ordered by name, not by sort
+    return {item[0]: (json.dumps(item[1:]), 1) for item in sorted(items)}
+
+
+def presorted_row(items):
+    items = sorted(items, cmp=ThingTupleComparator(SORT_COLS))
+    return {SORTED_COLUMN: (json.dumps(items), 1)}
+
+
+def read(row):
+    data, timestamps, is_sorted = SubredditQueryCache._from_columns(row)
+    if not is_sorted:
+        data.sort(cmp=ThingTupleComparator(SORT_COLS))
+    return data
+
+
+def time_read(row, rounds):
+    start = time.time()
+    for _ in xrange(rounds):
+        read(row)
+    return (time.time() - start) / rounds
+
+
+def benchmark(sizes=(25, 100, 500, 1000), rounds=200):
+    print "%8s %14s %14s %8s" % ("items", "unsorted ms", "presorted ms",
+                                 "speedup")
+    for size in sizes:
+        items = make_items(size)
+        old = unsorted_row(items)
+        new = presorted_row(items)
+        assert read(old) == read(new)
+
+        unsorted = time_read(old, rounds)
+        presorted = time_read(new, rounds)
+        print "%8d %14.3f %14.3f %7.1fx" % (
+            size, unsorted * 1000, presorted * 1000, unsorted / presorted)
+
+
+if __name__ == "__main__":
+    benchmark()
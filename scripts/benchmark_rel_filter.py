@@ -0,0 +1,112 @@
+#!/usr/bin/python
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of
+# the Original Code is reddit Inc.
+#
+# All portions of the code written by reddit are Copyright (c) 2006-2015 reddit
+# Inc. All Rights Reserved.
+###############################################################################
+"""Estimate the relation cache traffic saved by negative filters.
+
+Builds synthetic subreddit membership (a few moderators and banned users per
+subreddit, with a long tail of bigger lists) and replays page views that ask
+which of a page's authors are moderators of or banned from its subreddit, as
+SRMember._fast_query does. Compares the cache keys fetched with and without
+Bloom filters in front of the relation cache.
+
+    python scripts/benchmark_rel_filter.py [page views] [authors per page]
+
+Filters only save cache traffic when each thing1 is checked against several
+thing2s: with one author per page the filter key replaces the relation key
+rather than saving it.
+
+"""
+
+import cPickle as pickle
+import random
+import sys
+
+from r2.lib.bloom import BloomFilter
+
+
+NAMES = ("moderator", "banned")
+
+
+def make_relations(num_srs, num_users, rand):
+    relations = {}
+    for sr_id in xrange(num_srs):
+        for name in NAMES:
+            # most lists are short, a few are long
+            size = min(int(rand.paretovariate(1.2)) * 3, num_users)
+            relations[(sr_id, name)] = set(rand.sample(xrange(num_users), size))
+    return relations
+
+
+def make_filters(relations, capacity):
+    filters = {}
+    for key, thing2_ids in relations.iteritems():
+        if len(thing2_ids) > capacity:
+            continue
+        bloom = BloomFilter(capacity)
+        for thing2_id in thing2_ids:
+            bloom.add(thing2_id)
+        filters[key] = bloom
+    return filters
+
+
+def benchmark(page_views=20000, authors_per_page=50, num_srs=2000,
+              num_users=100000, capacity=1000, seed=1):
+    rand = random.Random(seed)
+    relations = make_relations(num_srs, num_users, rand)
+    filters = make_filters(relations, capacity)
+
+    lookups = related = filter_keys = fetched = false_positives = 0
+    for _ in xrange(page_views):
+        sr_id = rand.randrange(num_srs)
+        authors = rand.sample(xrange(num_users), authors_per_page)
+        for name in NAMES:
+            key = (sr_id, name)
+            bloom = filters.get(key)
+            filter_keys += 1
+            for author_id in authors:
+                lookups += 1
+                is_related = author_id in relations[key]
+                related += is_related
+                if bloom is None or author_id in bloom:
+                    fetched += 1
+                    false_positives += not is_related
+
+    sizes = [len(pickle.dumps(bloom, pickle.HIGHEST_PROTOCOL))
+             for bloom in filters.itervalues()]
+    with_filter = filter_keys + fetched
+    negatives = lookups - related
+
+    print "%d page views, %d authors each, %d subreddits" % (
+        page_views, authors_per_page, num_srs)
+    print "%-32s %10d" % ("cache keys without filters", lookups)
+    print "%-32s %10d (%d filter, %d relation), %.1f%%" % (
+        "cache keys with filters", with_filter, filter_keys, fetched,
+        100. * with_filter / lookups)
+    print "%-32s %9.3f%%" % (
+        "false positive rate", 100. * false_positives / max(negatives, 1))
+    print "%-32s %10d of %d" % (
+        "saturated filters", len(relations) - len(filters), len(relations))
+    print "%-32s %10d" % ("bytes per filter", sum(sizes) / len(sizes))
+
+
+if __name__ == "__main__":
+    benchmark(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,85 @@
+#!/usr/bin/python
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of
+# the Original Code is reddit Inc.
+#
+# All portions of the code written by reddit are Copyright (c) 2006-2015 reddit
+# Inc. All Rights Reserved.
+###############################################################################
+"""Time preparing listing queries with and without the statement cache.
+
+Builds the selects that find_things, find_data and find_rels would run
+for a few typical listing queries (without executing them) and reports
+the time per query when each is compiled from scratch and when its
+compiled statement is reused.
+
+    paster run run.ini scripts/benchmark_statement_cache.py -c "benchmark()"
+
+"""
+
+import time
+
+from r2.lib.db import operators, tdb_sql
+
+
+def listing_queries():
+    c = operators.Slots()
+    link = tdb_sql.types_name["link"].type_id
+    srmember = tdb_sql.rel_types_name["srmember"].type_id
+    newest = [operators.desc("_date")]
+    hot = [operators.desc("_hot"), operators.desc("_date")]
+
+    return [
+        ("recent links", tdb_sql.prepare_things, (link, hot, 1000, None, [
+            c._spam == False,
+            c._deleted == False,
+            c._date > operators.timeago("1 day"),
+        ])),
+        ("subreddit links", tdb_sql.prepare_data, (link, newest, 1000, None, [
+            c.sr_id == [1, 2, 3, 4, 5],
+            c._spam == False,
+            c._deleted == False,
+        ])),
+        ("moderators", tdb_sql.prepare_rels, (["_thing2_id"], srmember, newest,
+                                              None, None, [
+            c._thing1_id == 1,
+            c._name == "moderator",
+        ])),
+    ]
+
+
+def time_prepare(prepare, args, rounds, cached):
+    start = time.time()
+    for _ in xrange(rounds):
+        if not cached:
+            tdb_sql.statement_cache.clear()
+        prepare(*args)
+    return (time.time() - start) / rounds
+
+
+def benchmark(rounds=2000):
+    print "%-16s %14s %14s %8s" % ("query", "compiled ms", "cached ms",
+                                   "speedup")
+    for name, prepare, args in listing_queries():
+        compiled = time_prepare(prepare, args, rounds, cached=False)
+        cached = time_prepare(prepare, args, rounds, cached=True)
+        print "%-16s %14.3f %14.3f %7.1fx" % (
+            name, compiled * 1000, cached * 1000, compiled / cached)
+
+
+if __name__ == "__main__":
+    benchmark()
@@ -0,0 +1,106 @@
+#!/usr/bin/python
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of
+# the Original Code is reddit Inc.
+#
+# All portions of the code written by reddit are Copyright (c) 2006-2015 reddit
+# Inc. All Rights Reserved.
+###############################################################################
+"""Compare loading thing data from the data table and from documents.
+
+Copies the data of recent links, comments and accounts into document tables
+of their own, then times the database half of _byID (get_things_from_db)
+reading data props from each.
+
+    paster run run.ini scripts/benchmark_thing_data.py -c "benchmark()"
+
+The thing types don't need !data_documents set; the benchmark tables are
+dropped afterwards.
+
+"""
+
+import time
+
+import sqlalchemy as sa
+
+from r2.lib.db import tdb_sql
+from r2.lib.utils import storage
+from r2.models import Account, Comment, Link
+
+
+def recent_ids(thing_table, count):
+    q = sa.select([thing_table.c.thing_id],
+                  order_by=sa.desc(thing_table.c.thing_id),
+                  limit=count)
+    return [row.thing_id for row in q.execute()]
+
+
+def make_document_table(thing_table, data_table, thing_ids):
+    metadata = tdb_sql.make_metadata(thing_table.bind)
+    document_table = tdb_sql.get_document_table(
+        metadata, thing_table.thing_name + "_bench")
+    document_table.create(checkfirst=True)
+
+    data_by_id = tdb_sql.get_data(data_table, thing_ids)
+    document_table.insert().execute([
+        dict(thing_id=_id, data=tdb_sql.dump_document(data))
+        for _id, data in data_by_id.iteritems()
+    ])
+    return document_table
+
+
+def time_loads(cls, thing_ids, batch_size, rounds):
+    batches = [thing_ids[i:i + batch_size]
+               for i in xrange(0, len(thing_ids), batch_size)]
+    start = time.time()
+    for _ in xrange(rounds):
+        for batch in batches:
+            cls.get_things_from_db(batch)
+    return (time.time() - start) / (rounds * len(batches))
+
+
+def benchmark(count=1000, batch_size=100, rounds=5):
+    print "%d things per type, loaded %d at a time" % (count, batch_size)
+    print "%-10s %10s %14s %14s %8s" % (
+        "type", "data rows", "data table ms", "documents ms", "speedup")
+
+    for cls in (Link, Comment, Account):
+        info = tdb_sql.types_id[cls._type_id]
+        thing_table, data_table = tdb_sql.get_write_table(info.tables)[:2]
+        thing_ids = recent_ids(thing_table, count)
+        rows = sa.select([sa.func.count()],
+                         data_table.c.thing_id.in_(thing_ids)).scalar()
+
+        document_table = make_document_table(
+            thing_table, data_table, thing_ids)
+        try:
+            tdb_sql.types_id[cls._type_id] = storage(
+                info, data_documents=None,
+                tables=[(thing_table, data_table, None)])
+            data_time = time_loads(cls, thing_ids, batch_size, rounds)
+
+            tdb_sql.types_id[cls._type_id] = storage(
+                info, data_documents="read",
+                tables=[(thing_table, data_table, document_table)])
+            document_time = time_loads(cls, thing_ids, batch_size, rounds)
+        finally:
+            tdb_sql.types_id[cls._type_id] = info
+            document_table.drop()
+
+        print "%-10s %10d %14.2f %14.2f %7.1fx" % (
+            cls.__name__, rows, data_time * 1000, document_time * 1000,
+            data_time / document_time if document_time else 0)